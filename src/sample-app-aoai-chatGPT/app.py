@@ -1,5 +1,6 @@
 import copy
 import json
+import asyncio
 import os
 import logging
 import uuid
@@ -7,6 +8,7 @@ import httpx
 from quart import (
     Blueprint,
     Quart,
+    current_app,
     jsonify,
     make_response,
     request,
@@ -15,11 +17,12 @@ from quart import (
 )
 
 from openai import AsyncAzureOpenAI
-from azure.identity.aio import (
-    DefaultAzureCredential,
-    get_bearer_token_provider
-)
+from azure.identity.aio import get_bearer_token_provider
 from backend.auth.auth_utils import get_authenticated_user_details
+from backend.auth.credential_cache import (
+    AsyncCachedTokenCredential,
+    COGNITIVE_SERVICES_SCOPE
+)
 from backend.security.ms_defender_utils import get_msdefender_user_json
 from backend.history.cosmosdbservice import CosmosConversationClient
 from backend.settings import (
@@ -29,6 +32,7 @@ from backend.settings import (
 from backend.utils import (
     format_as_ndjson,
     format_stream_response,
+    coalesce_stream_response,
     format_non_streaming_response,
     convert_to_pf_format,
     format_pf_non_streaming_response,
@@ -41,6 +45,39 @@ def create_app():
     app = Quart(__name__)
     app.register_blueprint(bp)
     app.config["TEMPLATES_AUTO_RELOAD"] = True
+
+    @app.before_serving
+    async def init():
+        try:
+            app.azure_openai_client = init_openai_client()
+        except Exception:
+            logging.exception("Failed to initialize Azure OpenAI client")
+            app.azure_openai_client = None
+
+        try:
+            app.cosmos_conversation_client = init_cosmosdb_client()
+        except Exception:
+            logging.exception("Failed to initialize CosmosDB client")
+            app.cosmos_conversation_client = None
+
+    @app.after_serving
+    async def shutdown():
+        azure_openai_client = getattr(app, "azure_openai_client", None)
+        if azure_openai_client:
+            await azure_openai_client.close()
+        app.azure_openai_client = None
+
+        cosmos_conversation_client = getattr(app, "cosmos_conversation_client", None)
+        if cosmos_conversation_client:
+            await cosmos_conversation_client.close()
+        app.cosmos_conversation_client = None
+
+        azure_credential = getattr(app, "azure_credential", None)
+        if azure_credential:
+            logging.info(f"Token cache stats: {azure_credential.stats}")
+            await azure_credential.close()
+        app.azure_credential = None
+
     return app
 
 
@@ -70,6 +107,9 @@ if DEBUG.lower() == "true":
 
 USER_AGENT = "GitHubSampleWebApp/AsyncAzureOpenAI/1.0.0"
 
+# A new conversation is titled with (the start of) the user's message until its title is generated
+PROVISIONAL_TITLE_LENGTH = 50
+
 
 # Frontend Settings via Environment Variables
 frontend_settings = {
@@ -94,6 +134,16 @@ frontend_settings = {
 MS_DEFENDER_ENABLED = os.environ.get("MS_DEFENDER_ENABLED", "true").lower() == "true"
 
 
+def get_azure_credential():
+    # One Entra ID credential and token cache per worker, shared by the
+    # Azure OpenAI and CosmosDB clients
+    azure_credential = getattr(current_app, "azure_credential", None)
+    if azure_credential is None:
+        azure_credential = AsyncCachedTokenCredential()
+        current_app.azure_credential = azure_credential
+    return azure_credential
+
+
 # Initialize Azure OpenAI Client
 def init_openai_client():
     azure_openai_client = None
@@ -128,7 +178,7 @@ def init_openai_client():
         if not aoai_api_key:
             logging.debug("No AZURE_OPENAI_KEY found, using Azure Entra ID auth")
             ad_token_provider = get_bearer_token_provider(
-                DefaultAzureCredential(), "https://cognitiveservices.azure.com/.default"
+                get_azure_credential(), COGNITIVE_SERVICES_SCOPE
             )
 
         # Deployment
@@ -139,12 +189,24 @@ def init_openai_client():
         # Default Headers
         default_headers = {"x-ms-useragent": USER_AGENT}
 
+        # Pooled HTTP transport, shared by every request served by this worker
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=app_settings.azure_openai.http_max_connections,
+                max_keepalive_connections=app_settings.azure_openai.http_max_keepalive_connections,
+                keepalive_expiry=app_settings.azure_openai.http_keepalive_expiry,
+            ),
+            timeout=httpx.Timeout(timeout=600.0, connect=5.0),
+            http2=app_settings.azure_openai.http2,
+        )
+
         azure_openai_client = AsyncAzureOpenAI(
             api_version=app_settings.azure_openai.preview_api_version,
             api_key=aoai_api_key,
             azure_ad_token_provider=ad_token_provider,
             default_headers=default_headers,
             azure_endpoint=endpoint,
+            http_client=http_client,
         )
 
         return azure_openai_client
@@ -154,6 +216,16 @@ def init_openai_client():
         raise e
 
 
+def get_openai_client():
+    # The client is normally created once per worker in before_serving; fall
+    # back to creating it on first use (e.g. under the Quart test client).
+    azure_openai_client = getattr(current_app, "azure_openai_client", None)
+    if azure_openai_client is None:
+        azure_openai_client = init_openai_client()
+        current_app.azure_openai_client = azure_openai_client
+    return azure_openai_client
+
+
 def init_cosmosdb_client():
     cosmos_conversation_client = None
     if app_settings.chat_history:
@@ -163,7 +235,7 @@ def init_cosmosdb_client():
             )
 
             if not app_settings.chat_history.account_key:
-                credential = DefaultAzureCredential()
+                credential = get_azure_credential()
             else:
                 credential = app_settings.chat_history.account_key
 
@@ -173,6 +245,11 @@ def init_cosmosdb_client():
                 database_name=app_settings.chat_history.database,
                 container_name=app_settings.chat_history.conversations_container,
                 enable_message_feedback=app_settings.chat_history.enable_feedback,
+                connection_pool_size=app_settings.chat_history.connection_pool_size,
+                connection_timeout=app_settings.chat_history.connection_timeout,
+                retry_total=app_settings.chat_history.retry_total,
+                retry_backoff_max=app_settings.chat_history.retry_backoff_max,
+                retry_fixed_interval=app_settings.chat_history.retry_fixed_interval,
             )
         except Exception as e:
             logging.exception("Exception in CosmosDB initialization", e)
@@ -184,6 +261,15 @@ def init_cosmosdb_client():
     return cosmos_conversation_client
 
 
+def get_cosmos_conversation_client():
+    # Shared per worker like the Azure OpenAI client, see get_openai_client
+    cosmos_conversation_client = getattr(current_app, "cosmos_conversation_client", None)
+    if cosmos_conversation_client is None:
+        cosmos_conversation_client = init_cosmosdb_client()
+        current_app.cosmos_conversation_client = cosmos_conversation_client
+    return cosmos_conversation_client
+
+
 def prepare_model_args(request_body, request_headers):
     request_messages = request_body.get("messages", [])
     messages = []
@@ -313,7 +399,7 @@ async def send_chat_request(request_body, request_headers):
     model_args = prepare_model_args(request_body, request_headers)
 
     try:
-        azure_openai_client = init_openai_client()
+        azure_openai_client = get_openai_client()
         raw_response = await azure_openai_client.chat.completions.with_raw_response.create(**model_args)
         response = raw_response.parse()
         apim_request_id = raw_response.headers.get("apim-request-id") 
@@ -343,7 +429,16 @@ async def complete_chat_request(request_body, request_headers):
 async def stream_chat_request(request_body, request_headers):
     response, apim_request_id = await send_chat_request(request_body, request_headers)
     history_metadata = request_body.get("history_metadata", {})
-    
+
+    if app_settings.azure_openai.stream_coalesce_interval > 0:
+        return coalesce_stream_response(
+            response,
+            history_metadata,
+            apim_request_id,
+            interval=app_settings.azure_openai.stream_coalesce_interval,
+            max_bytes=app_settings.azure_openai.stream_coalesce_bytes,
+        )
+
     async def generate():
         async for completionChunk in response:
             yield format_stream_response(completionChunk, history_metadata, apim_request_id)
@@ -401,20 +496,35 @@ async def add_conversation():
 
     try:
         # make sure cosmos is configured
-        cosmos_conversation_client = init_cosmosdb_client()
+        cosmos_conversation_client = get_cosmos_conversation_client()
         if not cosmos_conversation_client:
             raise Exception("CosmosDB is not configured or not working")
 
         # check for the conversation_id, if the conversation is not set, we will create a new one
         history_metadata = {}
         if not conversation_id:
-            title = await generate_title(request_json["messages"])
-            conversation_dict = await cosmos_conversation_client.create_conversation(
-                user_id=user_id, title=title
-            )
+            # The title is generated alongside the chat completion; the conversation
+            # is created under the user's message as a provisional title until then
+            title_task = asyncio.create_task(generate_title(request_json["messages"]))
+            title = provisional_title(request_json["messages"][-1]["content"])
+            try:
+                conversation_dict = await cosmos_conversation_client.create_conversation(
+                    user_id=user_id, title=title
+                )
+            except Exception:
+                title_task.cancel()
+                raise
             conversation_id = conversation_dict["id"]
             history_metadata["title"] = title
             history_metadata["date"] = conversation_dict["createdAt"]
+            current_app.add_background_task(
+                update_conversation_title,
+                cosmos_conversation_client,
+                user_id,
+                conversation_id,
+                title_task,
+                history_metadata,
+            )
 
         ## Format the incoming message object in the "chat/completions" messages format
         ## then write it to the conversation history in cosmos
@@ -435,8 +545,6 @@ async def add_conversation():
         else:
             raise Exception("No user message found")
 
-        await cosmos_conversation_client.cosmosdb_client.close()
-
         # Submit request to Chat Completions for response
         request_body = await request.get_json()
         history_metadata["conversation_id"] = conversation_id
@@ -459,7 +567,7 @@ async def update_conversation():
 
     try:
         # make sure cosmos is configured
-        cosmos_conversation_client = init_cosmosdb_client()
+        cosmos_conversation_client = get_cosmos_conversation_client()
         if not cosmos_conversation_client:
             raise Exception("CosmosDB is not configured or not working")
 
@@ -471,26 +579,21 @@ async def update_conversation():
         ## then write it to the conversation history in cosmos
         messages = request_json["messages"]
         if len(messages) > 0 and messages[-1]["role"] == "assistant":
+            new_messages = []
             if len(messages) > 1 and messages[-2].get("role", None) == "tool":
                 # write the tool message first
-                await cosmos_conversation_client.create_message(
-                    uuid=str(uuid.uuid4()),
-                    conversation_id=conversation_id,
-                    user_id=user_id,
-                    input_message=messages[-2],
-                )
+                new_messages.append((str(uuid.uuid4()), messages[-2]))
             # write the assistant message
-            await cosmos_conversation_client.create_message(
-                uuid=messages[-1]["id"],
+            new_messages.append((messages[-1]["id"], messages[-1]))
+            await cosmos_conversation_client.create_messages(
                 conversation_id=conversation_id,
                 user_id=user_id,
-                input_message=messages[-1],
+                input_messages=new_messages,
             )
         else:
             raise Exception("No bot messages found")
 
         # Submit request to Chat Completions for response
-        await cosmos_conversation_client.cosmosdb_client.close()
         response = {"success": True}
         return jsonify(response), 200
 
@@ -503,7 +606,7 @@ async def update_conversation():
 async def update_message():
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
     user_id = authenticated_user["user_principal_id"]
-    cosmos_conversation_client = init_cosmosdb_client()
+    cosmos_conversation_client = get_cosmos_conversation_client()
 
     ## check request for message_id
     request_json = await request.get_json()
@@ -560,7 +663,7 @@ async def delete_conversation():
             return jsonify({"error": "conversation_id is required"}), 400
 
         ## make sure cosmos is configured
-        cosmos_conversation_client = init_cosmosdb_client()
+        cosmos_conversation_client = get_cosmos_conversation_client()
         if not cosmos_conversation_client:
             raise Exception("CosmosDB is not configured or not working")
 
@@ -574,8 +677,6 @@ async def delete_conversation():
             user_id, conversation_id
         )
 
-        await cosmos_conversation_client.cosmosdb_client.close()
-
         return (
             jsonify(
                 {
@@ -597,7 +698,7 @@ async def list_conversations():
     user_id = authenticated_user["user_principal_id"]
 
     ## make sure cosmos is configured
-    cosmos_conversation_client = init_cosmosdb_client()
+    cosmos_conversation_client = get_cosmos_conversation_client()
     if not cosmos_conversation_client:
         raise Exception("CosmosDB is not configured or not working")
 
@@ -605,7 +706,6 @@ async def list_conversations():
     conversations = await cosmos_conversation_client.get_conversations(
         user_id, offset=offset, limit=25
     )
-    await cosmos_conversation_client.cosmosdb_client.close()
     if not isinstance(conversations, list):
         return jsonify({"error": f"No conversations for {user_id} were found"}), 404
 
@@ -627,7 +727,7 @@ async def get_conversation():
         return jsonify({"error": "conversation_id is required"}), 400
 
     ## make sure cosmos is configured
-    cosmos_conversation_client = init_cosmosdb_client()
+    cosmos_conversation_client = get_cosmos_conversation_client()
     if not cosmos_conversation_client:
         raise Exception("CosmosDB is not configured or not working")
 
@@ -663,7 +763,6 @@ async def get_conversation():
         for msg in conversation_messages
     ]
 
-    await cosmos_conversation_client.cosmosdb_client.close()
     return jsonify({"conversation_id": conversation_id, "messages": messages}), 200
 
 
@@ -680,7 +779,7 @@ async def rename_conversation():
         return jsonify({"error": "conversation_id is required"}), 400
 
     ## make sure cosmos is configured
-    cosmos_conversation_client = init_cosmosdb_client()
+    cosmos_conversation_client = get_cosmos_conversation_client()
     if not cosmos_conversation_client:
         raise Exception("CosmosDB is not configured or not working")
 
@@ -707,7 +806,6 @@ async def rename_conversation():
         conversation
     )
 
-    await cosmos_conversation_client.cosmosdb_client.close()
     return jsonify(updated_conversation), 200
 
 
@@ -720,7 +818,7 @@ async def delete_all_conversations():
     # get conversations for user
     try:
         ## make sure cosmos is configured
-        cosmos_conversation_client = init_cosmosdb_client()
+        cosmos_conversation_client = get_cosmos_conversation_client()
         if not cosmos_conversation_client:
             raise Exception("CosmosDB is not configured or not working")
 
@@ -741,7 +839,6 @@ async def delete_all_conversations():
             deleted_conversation = await cosmos_conversation_client.delete_conversation(
                 user_id, conversation["id"]
             )
-        await cosmos_conversation_client.cosmosdb_client.close()
         return (
             jsonify(
                 {
@@ -771,7 +868,7 @@ async def clear_messages():
             return jsonify({"error": "conversation_id is required"}), 400
 
         ## make sure cosmos is configured
-        cosmos_conversation_client = init_cosmosdb_client()
+        cosmos_conversation_client = get_cosmos_conversation_client()
         if not cosmos_conversation_client:
             raise Exception("CosmosDB is not configured or not working")
 
@@ -800,14 +897,16 @@ async def ensure_cosmos():
         return jsonify({"error": "CosmosDB is not configured"}), 404
 
     try:
-        cosmos_conversation_client = init_cosmosdb_client()
+        cosmos_conversation_client = get_cosmos_conversation_client()
+        if not cosmos_conversation_client:
+            return jsonify({"error": "CosmosDB is not configured or not working"}), 500
+
         success, err = await cosmos_conversation_client.ensure()
-        if not cosmos_conversation_client or not success:
+        if not success:
             if err:
                 return jsonify({"error": err}), 422
             return jsonify({"error": "CosmosDB is not configured or not working"}), 500
 
-        await cosmos_conversation_client.cosmosdb_client.close()
         return jsonify({"message": "CosmosDB is configured and working"}), 200
     except Exception as e:
         logging.exception("Exception in /history/ensure")
@@ -836,6 +935,32 @@ async def ensure_cosmos():
             return jsonify({"error": "CosmosDB is not working"}), 500
 
 
+async def update_conversation_title(cosmos_conversation_client, user_id, conversation_id, title_task, history_metadata):
+    try:
+        title = await title_task
+        if title == history_metadata["title"]:
+            return
+
+        # Responses still being streamed pick the final title up from history_metadata,
+        # which coalesced streams send again with their last frame
+        history_metadata["title"] = title
+        await cosmos_conversation_client.update_conversation_title(user_id, conversation_id, title)
+    except asyncio.CancelledError:
+        logging.warning(f"Title update for conversation {conversation_id} cancelled, the provisional title is kept")
+        raise
+    except Exception:
+        logging.exception("Exception while updating the conversation title")
+
+
+def provisional_title(content) -> str:
+    ## the first line of the user's message, cut to PROVISIONAL_TITLE_LENGTH characters
+    lines = str(content).strip().splitlines()
+    title = lines[0].strip() if lines else ""
+    if len(title) > PROVISIONAL_TITLE_LENGTH:
+        title = title[:PROVISIONAL_TITLE_LENGTH - 3].rstrip() + "..."
+    return title
+
+
 async def generate_title(conversation_messages) -> str:
     ## make sure the messages are sorted by _ts descending
     title_prompt = "Summarize the conversation so far into a 4-word or less title. Do not use any quotation marks or punctuation. Do not include any other commentary or description."
@@ -847,7 +972,7 @@ async def generate_title(conversation_messages) -> str:
     messages.append({"role": "user", "content": title_prompt})
 
     try:
-        azure_openai_client = init_openai_client()
+        azure_openai_client = get_openai_client()
         response = await azure_openai_client.chat.completions.create(
             model=app_settings.azure_openai.model, messages=messages, temperature=1, max_tokens=64
         )
@@ -856,7 +981,7 @@ async def generate_title(conversation_messages) -> str:
         return title
     except Exception as e:
         logging.exception("Exception while generating title", e)
-        return messages[-2]["content"]
+        return provisional_title(messages[-2]["content"])
 
 
 app = create_app()
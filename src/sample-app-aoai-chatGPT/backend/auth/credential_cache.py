@@ -0,0 +1,190 @@
+import asyncio
+import logging
+import threading
+import time
+
+from azure.core.credentials import AccessToken
+from azure.identity import DefaultAzureCredential
+from azure.identity.aio import DefaultAzureCredential as AsyncDefaultAzureCredential
+
+COGNITIVE_SERVICES_SCOPE = "https://cognitiveservices.azure.com/.default"
+
+# Tokens closer than this to expiry are refreshed in the background while the
+# cached token keeps being served.
+DEFAULT_REFRESH_MARGIN = 300
+
+# Tokens closer than this to expiry are never served from the cache.
+MIN_TOKEN_VALIDITY = 30
+
+
+class _TokenCache:
+    def __init__(self, refresh_margin: int = DEFAULT_REFRESH_MARGIN):
+        self.refresh_margin = refresh_margin
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self._tokens = {}
+
+    @staticmethod
+    def _cache_key(scopes, kwargs):
+        return tuple(scopes), kwargs.get("tenant_id")
+
+    def _lookup(self, key, kwargs):
+        '''
+        Returns (token, needs_refresh). token is None when it has to be
+        fetched synchronously: not cached, about to expire, or the caller
+        passed a claims challenge.
+        '''
+        token = None if kwargs.get("claims") else self._tokens.get(key)
+        now = time.time()
+        if token is None or token.expires_on <= now + MIN_TOKEN_VALIDITY:
+            self.misses += 1
+            return None, False
+
+        self.hits += 1
+        return token, token.expires_on <= now + self.refresh_margin
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+            "cached_tokens": len(self._tokens),
+        }
+
+
+class CachedTokenCredential(_TokenCache):
+    '''
+    Token cache in front of a synchronous azure-identity credential.
+    Safe to share between threads. Pickles with its cached tokens; as a
+    DefaultAzureCredential holds locks it is not pickled but re-created,
+    with its default options, when the copy is loaded.
+    '''
+
+    def __init__(self, credential=None, refresh_margin: int = DEFAULT_REFRESH_MARGIN):
+        super().__init__(refresh_margin)
+        self.credential = credential or DefaultAzureCredential()
+        self._lock = threading.Lock()
+        self._refreshing = set()
+
+    def get_token(self, *scopes, **kwargs) -> AccessToken:
+        key = self._cache_key(scopes, kwargs)
+        with self._lock:
+            token, needs_refresh = self._lookup(key, kwargs)
+            if needs_refresh and key not in self._refreshing:
+                self._refreshing.add(key)
+                threading.Thread(
+                    target=self._refresh, args=(key, scopes, kwargs), daemon=True
+                ).start()
+
+        if token:
+            return token
+
+        token = self.credential.get_token(*scopes, **kwargs)
+        with self._lock:
+            self._tokens[key] = token
+        return token
+
+    def _refresh(self, key, scopes, kwargs):
+        try:
+            token = self.credential.get_token(*scopes, **kwargs)
+            with self._lock:
+                self._tokens[key] = token
+                self.refreshes += 1
+        except Exception:
+            logging.exception("Background token refresh failed")
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def close(self):
+        self.credential.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        del state["_refreshing"]
+        if isinstance(self.credential, DefaultAzureCredential):
+            state["credential"] = None
+        with self._lock:
+            state["_tokens"] = dict(self._tokens)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.credential is None:
+            self.credential = DefaultAzureCredential()
+        self._lock = threading.Lock()
+        self._refreshing = set()
+
+
+class AsyncCachedTokenCredential(_TokenCache):
+    '''
+    Token cache in front of an asynchronous azure-identity credential.
+    Concurrent misses for the same scope share a single token request.
+    '''
+
+    def __init__(self, credential=None, refresh_margin: int = DEFAULT_REFRESH_MARGIN):
+        super().__init__(refresh_margin)
+        self.credential = credential or AsyncDefaultAzureCredential()
+        self._locks = {}
+        self._refresh_tasks = {}
+
+    async def get_token(self, *scopes, **kwargs) -> AccessToken:
+        key = self._cache_key(scopes, kwargs)
+        token, needs_refresh = self._lookup(key, kwargs)
+        if token:
+            if needs_refresh and key not in self._refresh_tasks:
+                self._refresh_tasks[key] = asyncio.create_task(
+                    self._refresh(key, scopes, kwargs)
+                )
+            return token
+
+        async with self._locks.setdefault(key, asyncio.Lock()):
+            token = self._tokens.get(key)
+            if (
+                kwargs.get("claims")
+                or token is None
+                or token.expires_on <= time.time() + MIN_TOKEN_VALIDITY
+            ):
+                token = await self.credential.get_token(*scopes, **kwargs)
+                self._tokens[key] = token
+            return token
+
+    async def _refresh(self, key, scopes, kwargs):
+        try:
+            self._tokens[key] = await self.credential.get_token(*scopes, **kwargs)
+            self.refreshes += 1
+        except Exception:
+            logging.exception("Background token refresh failed")
+        finally:
+            self._refresh_tasks.pop(key, None)
+
+    async def close(self):
+        for task in list(self._refresh_tasks.values()):
+            task.cancel()
+        self._refresh_tasks.clear()
+        await self.credential.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+
+def as_cached_credential(credential, refresh_margin: int = DEFAULT_REFRESH_MARGIN):
+    '''
+    Wraps a synchronous credential in a CachedTokenCredential, unless it is
+    one already.
+    '''
+    if credential is None or isinstance(credential, CachedTokenCredential):
+        return credential
+    return CachedTokenCredential(credential, refresh_margin=refresh_margin)
@@ -1,18 +1,34 @@
 import uuid
-from datetime import datetime
+import asyncio
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+import aiohttp
+from azure.core.pipeline.transport import AioHttpTransport
 from azure.cosmos.aio import CosmosClient
 from azure.cosmos import exceptions
   
 class CosmosConversationClient():
     
-    def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, container_name: str, enable_message_feedback: bool = False):
+    def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, container_name: str, enable_message_feedback: bool = False, connection_pool_size: Optional[int] = None, **client_options):
         self.cosmosdb_endpoint = cosmosdb_endpoint
         self.credential = credential
         self.database_name = database_name
         self.container_name = container_name
         self.enable_message_feedback = enable_message_feedback
+        # retry_* / connection_timeout options are passed straight to CosmosClient
+        client_options = {k: v for k, v in client_options.items() if v is not None}
+        # a session of our own only when the pool size is set; otherwise the SDK's default session is used
+        if connection_pool_size:
+            client_options['transport'] = AioHttpTransport(
+                session=aiohttp.ClientSession(
+                    connector=aiohttp.TCPConnector(limit=connection_pool_size),
+                    cookie_jar=aiohttp.DummyCookieJar(),
+                    auto_decompress=False,
+                    trust_env=True
+                )
+            )
         try:
-            self.cosmosdb_client = CosmosClient(self.cosmosdb_endpoint, credential=credential)
+            self.cosmosdb_client = CosmosClient(self.cosmosdb_endpoint, credential=credential, **client_options)
         except exceptions.CosmosHttpResponseError as e:
             if e.status_code == 401:
                 raise ValueError("Invalid credentials") from e
@@ -30,6 +46,9 @@ class CosmosConversationClient():
             raise ValueError("Invalid CosmosDB container name") 
         
 
+    async def close(self):
+        await self.cosmosdb_client.close()
+
     async def ensure(self):
         if not self.cosmosdb_client or not self.database_client or not self.container_client:
             return False, "CosmosDB client not initialized correctly"
@@ -68,6 +87,18 @@ class CosmosConversationClient():
         else:
             return False
 
+    async def update_conversation_title(self, user_id, conversation_id, title):
+        # Patch only the title so that it cannot overwrite a concurrent updatedAt change
+        resp = await self.container_client.patch_item(
+            item=conversation_id,
+            partition_key=user_id,
+            patch_operations=[{'op': 'set', 'path': '/title', 'value': title}]
+        )
+        if resp:
+            return resp
+        else:
+            return False
+
     async def delete_conversation(self, user_id, conversation_id):
         conversation = await self.container_client.read_item(item=conversation_id, partition_key=user_id)        
         if conversation:
@@ -128,32 +159,49 @@ class CosmosConversationClient():
             return conversations[0]
  
     async def create_message(self, uuid, conversation_id, user_id, input_message: dict):
-        message = {
-            'id': uuid,
-            'type': 'message',
-            'userId' : user_id,
-            'createdAt': datetime.utcnow().isoformat(),
-            'updatedAt': datetime.utcnow().isoformat(),
-            'conversationId' : conversation_id,
-            'role': input_message['role'],
-            'content': input_message['content']
-        }
+        resp = await self.create_messages(conversation_id, user_id, [(uuid, input_message)])
+        if isinstance(resp, list):
+            return resp[0]
+        return resp
 
-        if self.enable_message_feedback:
-            message['feedback'] = ''
-        
-        resp = await self.container_client.upsert_item(message)  
-        if resp:
-            ## update the parent conversations's updatedAt field with the current message's createdAt datetime value
-            conversation = await self.get_conversation(user_id, conversation_id)
-            if not conversation:
-                return "Conversation not found"
-            conversation['updatedAt'] = message['createdAt']
-            await self.upsert_conversation(conversation)
-            return resp
-        else:
+    async def create_messages(self, conversation_id, user_id, input_messages: List[Tuple[str, dict]]):
+        ## the messages are written concurrently, so their order comes from createdAt alone
+        ## (see get_messages), which is made strictly increasing within the call
+        now = datetime.utcnow()
+        messages = []
+        for position, (message_id, input_message) in enumerate(input_messages):
+            created_at = (now + timedelta(microseconds=position)).isoformat(timespec='microseconds')
+            message = {
+                'id': message_id,
+                'type': 'message',
+                'userId' : user_id,
+                'createdAt': created_at,
+                'updatedAt': created_at,
+                'conversationId' : conversation_id,
+                'role': input_message['role'],
+                'content': input_message['content']
+            }
+            if self.enable_message_feedback:
+                message['feedback'] = ''
+            messages.append(message)
+
+        ## azure-cosmos 4.5.0 has no transactional batch (execute_item_batch), so the parent conversation's updatedAt
+        ## is patched first, which also checks that the conversation exists, and the messages are only written after that
+        try:
+            await self.container_client.patch_item(
+                item=conversation_id,
+                partition_key=user_id,
+                patch_operations=[{'op': 'set', 'path': '/updatedAt', 'value': messages[-1]['createdAt']}],
+                filter_predicate="from c where c.type = 'conversation'"
+            )
+        except (exceptions.CosmosResourceNotFoundError, exceptions.CosmosAccessConditionFailedError):
+            return "Conversation not found"
+
+        resps = await asyncio.gather(*(self.container_client.upsert_item(message) for message in messages))
+        if not all(resps):
             return False
-    
+        return resps
+
     async def update_message_feedback(self, user_id, message_id, feedback):
         message = await self.container_client.read_item(item=message_id, partition_key=user_id)
         if message:
@@ -174,7 +222,7 @@ class CosmosConversationClient():
                 'value': user_id
             }
         ]
-        query = f"SELECT * FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.userId = @userId ORDER BY c.timestamp ASC"
+        query = f"SELECT * FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.userId = @userId ORDER BY c.createdAt ASC"
         messages = []
         async for item in self.container_client.query_items(query=query, parameters=parameters):
             messages.append(item)
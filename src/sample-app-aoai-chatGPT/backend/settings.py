@@ -63,6 +63,12 @@ class _ChatHistorySettings(BaseSettings):
     account_key: Optional[str] = None
     conversations_container: str
     enable_feedback: bool = False
+    # Connections per worker to CosmosDB. Unset keeps the SDK's own aiohttp pool, which also allows 100
+    connection_pool_size: Optional[int] = None
+    connection_timeout: Optional[int] = None
+    retry_total: Optional[int] = None
+    retry_backoff_max: Optional[int] = None
+    retry_fixed_interval: Optional[int] = None
 
 
 class _PromptflowSettings(BaseSettings):
@@ -122,6 +128,12 @@ class _AzureOpenAISettings(BaseSettings):
     embedding_endpoint: Optional[str] = None
     embedding_key: Optional[str] = None
     embedding_name: Optional[str] = None
+    http_max_connections: int = 100
+    http_max_keepalive_connections: int = 20
+    http_keepalive_expiry: float = 30.0
+    http2: bool = False
+    stream_coalesce_interval: float = 0.0
+    stream_coalesce_bytes: int = 256
     
     @field_validator('tools', mode='before')
     @classmethod
@@ -1,5 +1,7 @@
 import os
 import json
+import time
+import asyncio
 import logging
 import requests
 import dataclasses
@@ -22,10 +24,14 @@ class JSONEncoder(json.JSONEncoder):
         return super().default(o)
 
 
+# One encoder for every event rather than one per json.dumps(cls=...) call
+_ndjson_encoder = JSONEncoder()
+
+
 async def format_as_ndjson(r):
     try:
         async for event in r:
-            yield json.dumps(event, cls=JSONEncoder) + "\n"
+            yield _ndjson_encoder.encode(event) + "\n"
     except Exception as error:
         logging.exception("Exception while generating response stream: %s", error)
         yield json.dumps({"error": str(error)})
@@ -143,6 +149,86 @@ def format_stream_response(chatCompletionChunk, history_metadata, apim_request_i
     return {}
 
 
+async def coalesce_stream_response(chatCompletionChunks, history_metadata, apim_request_id, interval, max_bytes):
+    """Formats a chat completion stream into frames that each carry the deltas received over `interval` seconds
+    or up to `max_bytes` of content. The first frame carries the envelope (id, model, created, object,
+    history_metadata and apim-request-id) and later ones just the id and the choices, except for the last one which
+    repeats history_metadata as it may have changed meanwhile (e.g. the generated title of a new conversation).
+    The first content is sent as soon as it arrives so that time to first token is unchanged; after that the latest
+    delta is held back until the next one arrives so that the stream always ends on a frame with content."""
+    envelope = None
+    sent_envelope = False
+    messages = []
+    content = []
+    content_bytes = 0
+    flushed_content = False
+    last_flush = time.monotonic()
+
+    def frame(keep_last=False):
+        nonlocal sent_envelope, messages, content, content_bytes, flushed_content, last_flush
+        held = content[-1:] if keep_last else []
+        buffered = content[:len(content) - len(held)]
+        if buffered:
+            messages.append({"role": "assistant", "content": "".join(buffered)})
+            flushed_content = True
+        response_obj = {"id": envelope["id"], "choices": [{"messages": messages}]}
+        if not sent_envelope:
+            response_obj = {**envelope, **response_obj}
+            sent_envelope = True
+        messages, content, last_flush = [], held, time.monotonic()
+        content_bytes = sum(len(delta.encode()) for delta in held)
+        return response_obj
+
+    chunks = chatCompletionChunks.__aiter__()
+    next_chunk = asyncio.ensure_future(chunks.__anext__())
+    try:
+        while True:
+            if len(content) > 1:
+                # Flush what is buffered, bar the latest delta, if the next chunk does not arrive in time
+                done, _ = await asyncio.wait({next_chunk}, timeout=last_flush + interval - time.monotonic())
+                if not done:
+                    yield frame(keep_last=True)
+            try:
+                chatCompletionChunk = await next_chunk
+            except StopAsyncIteration:
+                break
+            next_chunk = asyncio.ensure_future(chunks.__anext__())
+
+            if envelope is None:
+                envelope = {
+                    "id": chatCompletionChunk.id,
+                    "model": chatCompletionChunk.model,
+                    "created": chatCompletionChunk.created,
+                    "object": chatCompletionChunk.object,
+                    "history_metadata": history_metadata,
+                    "apim-request-id": apim_request_id,
+                }
+            if len(chatCompletionChunk.choices) == 0 or not chatCompletionChunk.choices[0].delta:
+                continue
+
+            delta = chatCompletionChunk.choices[0].delta
+            if hasattr(delta, "context"):
+                if content:
+                    messages.append({"role": "assistant", "content": "".join(content)})
+                    content, content_bytes = [], 0
+                messages.append({"role": "tool", "content": json.dumps(delta.context)})
+                yield frame()
+            elif delta.content:
+                if content and (content_bytes >= max_bytes or time.monotonic() - last_flush >= interval):
+                    yield frame()
+                content.append(delta.content)
+                content_bytes += len(delta.content.encode())
+                if not flushed_content:
+                    yield frame()
+
+        if content:
+            response_obj = frame()
+            response_obj["history_metadata"] = history_metadata
+            yield response_obj
+    finally:
+        next_chunk.cancel()
+
+
 def format_pf_non_streaming_response(
     chatCompletion, history_metadata, response_field_name, citations_field_name, message_uuid=None
 ):
@@ -1,33 +1,58 @@
 """Data utilities for index preparation."""
 import ast
+import asyncio
+import base64
+import bisect
+import contextlib
+import hashlib
 import html
+import io
 import json
+import multiprocessing
 import os
+import queue
+import random
 import re
+import shutil
+import signal
+import sqlite3
 import ssl
 import subprocess
+import sys
 import tempfile
+import threading
 import time
+import urllib.error
 import urllib.request
+import zlib
 from abc import ABC, abstractmethod
-from concurrent.futures import ProcessPoolExecutor
-from dataclasses import dataclass
-from functools import partial
-from typing import Any, Callable, Dict, Generator, List, Optional, Tuple, Union
+from array import array
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import asdict, dataclass, field, fields
+from functools import lru_cache, partial
+from typing import Any, AsyncGenerator, Callable, Dict, Generator, Iterable, List, Optional, Tuple, Union
 
 import markdown
 import requests
 import tiktoken
 from azure.ai.formrecognizer import DocumentAnalysisClient
+from azure.ai.formrecognizer.aio import DocumentAnalysisClient as AsyncDocumentAnalysisClient
+from azure.core import MatchConditions
 from azure.core.credentials import AzureKeyCredential
-from azure.identity import DefaultAzureCredential
 from azure.storage.blob import ContainerClient
 from bs4 import BeautifulSoup
 from dotenv import load_dotenv
-from langchain.text_splitter import TextSplitter, MarkdownTextSplitter, RecursiveCharacterTextSplitter, PythonCodeTextSplitter
-from openai import AzureOpenAI
+from langchain.text_splitter import TextSplitter, MarkdownTextSplitter, PythonCodeTextSplitter
+from openai import APIConnectionError, AzureOpenAI
 from tqdm import tqdm
 
+# Add parent directory to sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from backend.auth.credential_cache import COGNITIVE_SERVICES_SCOPE, as_cached_credential
+
 # Configure environment variables  
 load_dotenv() # take environment variables from .env.
 
@@ -44,6 +69,50 @@ FILE_FORMAT_DICT = {
     }
 
 RETRY_COUNT = 5
+RETRY_BACKOFF_BASE = 2 # seconds, doubled on every retry
+RETRY_BACKOFF_MAX = 60 # seconds
+
+# Embedding deployment quota. Unset means no client-side limit; the service's
+# x-ratelimit-remaining-* headers are still honored.
+EMBEDDING_TPM_LIMIT = os.getenv("EMBEDDING_TPM_LIMIT")
+EMBEDDING_RPM_LIMIT = os.getenv("EMBEDDING_RPM_LIMIT")
+
+# Upper bounds for a single embedding request, see get_embeddings
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", 16))
+EMBEDDING_BATCH_MAX_TOKENS = int(os.getenv("EMBEDDING_BATCH_MAX_TOKENS", 32000))
+# Embedding requests in flight while chunk_directory runs with njobs > 1
+EMBEDDING_CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", 8))
+
+# Local embedding cache, disabled unless a path is given
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH")
+EMBEDDING_CACHE_MAX_MB = int(os.getenv("EMBEDDING_CACHE_MAX_MB", 2048))
+
+# Local cache of Form Recognizer analyses, disabled unless a path is given
+FORM_RECOGNIZER_CACHE_PATH = os.getenv("FORM_RECOGNIZER_CACHE_PATH")
+FORM_RECOGNIZER_CACHE_MAX_MB = int(os.getenv("FORM_RECOGNIZER_CACHE_MAX_MB", 4096))
+# Documents analysed at once while chunk_directory runs with njobs > 1
+FORM_RECOGNIZER_CONCURRENCY = int(os.getenv("FORM_RECOGNIZER_CONCURRENCY", 16))
+FORM_RECOGNIZER_FORMATS = ["pdf", "docx", "pptx"]
+# Blob downloads in flight, and parallel ranges for blobs larger than BLOB_LARGE_SIZE bytes
+BLOB_DOWNLOAD_CONCURRENCY = int(os.getenv("BLOB_DOWNLOAD_CONCURRENCY", 8))
+BLOB_MAX_CONCURRENCY = int(os.getenv("BLOB_MAX_CONCURRENCY", 4))
+BLOB_LARGE_SIZE = int(os.getenv("BLOB_LARGE_SIZE", 64 * 1024 * 1024))
+# Downloads queued per download thread, so that the queue does not grow with the container
+BLOB_DOWNLOAD_WINDOW = 4
+# Blobs are downloaded to a file with this suffix and renamed once complete
+PARTIAL_DOWNLOAD_SUFFIX = ".part"
+# In pipelined mode, downloaded blobs on disk waiting to be chunked
+BLOB_PIPELINE_MAX_LOCAL_FILES = int(os.getenv("BLOB_PIPELINE_MAX_LOCAL_FILES", 64))
+
+# Scheduling of files on the worker processes while chunk_directory runs with njobs > 1: files taking longer
+# than FILE_TIMEOUT seconds to chunk are quarantined (0, the default, disables the timeout), and files smaller
+# than SMALL_FILE_SIZE bytes are sent to the workers SMALL_FILE_BATCH_SIZE at a time
+FILE_TIMEOUT = float(os.getenv("FILE_TIMEOUT", 0))
+SMALL_FILE_SIZE = int(os.getenv("SMALL_FILE_SIZE", 32 * 1024))
+SMALL_FILE_BATCH_SIZE = int(os.getenv("SMALL_FILE_BATCH_SIZE", 16))
+
+# PDFs with more pages are analysed as several page ranges of this size in parallel
+PDF_PAGE_RANGE_SIZE = int(os.getenv("PDF_PAGE_RANGE_SIZE", 100))
 
 SENTENCE_ENDINGS = [".", "!", "?"]
 WORDS_BREAKS = list(reversed([",", ";", ":", " ", "(", ")", "[", "]", "{", "}", "\t", "\n"]))
@@ -62,6 +131,23 @@ class TokenEstimator(object):
 
         return len(self.GPT2_TOKENIZER.encode(text, allowed_special="all"))
 
+    def encode(self, text: str) -> List[int]:
+        return self.GPT2_TOKENIZER.encode(text, allowed_special="all")
+
+    def token_char_offsets(self, tokens: List[int]) -> List[int]:
+        """Returns the offset in the decoded text at which each token starts.
+        A token that ends inside a multi-byte character is counted as ending after it."""
+        offsets = []
+        num_chars = 0
+        for token_bytes in self.GPT2_TOKENIZER.decode_tokens_bytes(tokens):
+            offsets.append(num_chars)
+            if token_bytes.isascii():
+                num_chars += len(token_bytes)
+            else:
+                # count the bytes that start a UTF-8 character
+                num_chars += sum(1 for byte in token_bytes if byte & 0xC0 != 0x80)
+        return offsets
+
     def construct_tokens_with_size(self, tokens: str, numofTokens: int) -> str:
         newTokens = self.GPT2_TOKENIZER.decode(
             self.GPT2_TOKENIZER.encode(tokens, allowed_special="all")[:numofTokens]
@@ -76,9 +162,40 @@ class PdfTextSplitter(TextSplitter):
         super().__init__(**kwargs)
         self._table_tags = HTML_TABLE_TAGS
         self._separators = separator or ["\n\n", "\n", " ", ""]
-        self._length_function = length_function
+        self._measure = length_function
+        # chunk_rest and _merge_splits measure the same splits over and over, so sizes are
+        # cached for the duration of one split_text call
+        self._length_cache = {}
+        self._length_function = self._cached_length
         self._noise = 50 # tokens to accommodate differences in token calculation, we don't want the chunking-on-the-fly to inadvertently chunk anything due to token calc mismatch
 
+    def _cached_length(self, text: str) -> int:
+        size = self._length_cache.get(text)
+        if size is None:
+            size = self._length_cache[text] = self._measure(text)
+        return size
+
+    @staticmethod
+    def _last_tag_content(text, tag):
+        # the content of the last <tag>, up to its closing tag or the end of the text
+        start = text.rfind(f"<{tag}>")
+        if start < 0:
+            return ""
+        start += len(tag) + 2
+        end = text.find(f"</{tag}>", start)
+        return text[start:] if end < 0 else text[start:end]
+
+    @staticmethod
+    def _find_headers(table):
+        # same match as re.search("<th.*>.*</th>", table), which backtracks quadratically on long
+        # single-line tables: from the first <th on a line to the last </th> on it, with a > in between
+        for line in table.split("\n"):
+            start = line.find("<th")
+            end = line.rfind("</th>")
+            if start >= 0 and end >= start + 3 and line.find(">", start + 3, end) >= 0:
+                return line[start:end + len("</th>")]
+        return ""
+
     def extract_caption(self, text):
         separator = self._separators[-1]
         for _s in self._separators:
@@ -89,22 +206,24 @@ class PdfTextSplitter(TextSplitter):
                 separator = _s
                 break
         
-        # Now that we have the separator, split the text
+        # Find the last non-empty line, scanning back from the end of the text
+        last_line = ""
         if separator:
-            lines = text.split(separator)
+            end = len(text)
+            while end > 0:
+                start = text.rfind(separator, 0, end)
+                last_line = text[start + len(separator):end] if start >= 0 else text[:end]
+                if last_line != "" or start < 0:
+                    break
+                end = start
         else:
-            lines = list(text)
-        
-        # remove empty lines
-        lines = [line for line in lines if line!='']
+            last_line = text[-1:]
+
         caption = ""
+        caption += self._last_tag_content(text, PDF_HEADERS['title'])
+        caption += self._last_tag_content(text, PDF_HEADERS['sectionHeading'])
         
-        if len(text.split(f"<{PDF_HEADERS['title']}>"))>1:
-            caption +=  text.split(f"<{PDF_HEADERS['title']}>")[-1].split(f"</{PDF_HEADERS['title']}>")[0]
-        if len(text.split(f"<{PDF_HEADERS['sectionHeading']}>"))>1:
-            caption +=  text.split(f"<{PDF_HEADERS['sectionHeading']}>")[-1].split(f"</{PDF_HEADERS['sectionHeading']}>")[0]
-        
-        caption += "\n"+ lines[-1].strip()
+        caption += "\n"+ last_line.strip()
 
         return caption
     
@@ -124,6 +243,16 @@ class PdfTextSplitter(TextSplitter):
         return url_dict, masked_text
 
     def split_text(self, text: str) -> List[str]:
+        return [chunk for chunk, chunk_size in self.split_text_with_sizes(text)]
+
+    def split_text_with_sizes(self, text: str) -> List[Tuple[str, int]]:
+        """Same as split_text, but pairs each chunk with its token count."""
+        try:
+            return self._split_text(text)
+        finally:
+            self._length_cache = {}
+
+    def _split_text(self, text: str) -> List[Tuple[str, int]]:
         url_dict, masked_text = self.mask_urls(text)
         start_tag = self._table_tags["table_open"]
         end_tag = self._table_tags["table_close"]
@@ -148,9 +277,7 @@ class PdfTextSplitter(TextSplitter):
                 table_caption_prefix = ""
             
 
-        final_final_chunks = [chunk for chunk, chunk_size in merge_chunks_serially(final_chunks, self._chunk_size, url_dict)]
-
-        return final_final_chunks
+        return list(merge_chunks_serially(final_chunks, self._chunk_size, url_dict, length_function=self._length_function))
 
 
 
@@ -188,18 +315,25 @@ class PdfTextSplitter(TextSplitter):
         if self._length_function("\n".join([caption, table])) < self._chunk_size - self._noise:
             return ["\n".join([caption, table])]
         else:
-            headers = ""
-            if re.search("<th.*>.*</th>", table):
-                headers += re.search("<th.*>.*</th>", table).group() # extract the header out. Opening tag may contain rowspan/colspan
+            headers = self._find_headers(table) # extract the header out. Opening tag may contain rowspan/colspan
             splits = table.split(self._table_tags["row_open"]) #split by row tag
             tables = []
+            # keep running token counts instead of re-measuring the whole mini-table for every row
+            row_open_size = self._measure(self._table_tags["row_open"])
+            new_table_prefix = "\n".join([caption, self._table_tags["table_open"], headers])
+            new_table_prefix_size = self._measure(new_table_prefix)
             current_table = caption + "\n"
+            current_table_size = self._measure(current_table)
             for part in splits:
                 if len(part)>0:
-                    if self._length_function(current_table + self._table_tags["row_open"] + part) < self._chunk_size: # if current table length is within permissible limit, keep adding rows
-                        if part not in [self._table_tags["table_open"], self._table_tags["table_close"]]: # need add the separator (row tag) when the part is not a table tag
+                    part_size = self._measure(part)
+                    is_table_tag = part in [self._table_tags["table_open"], self._table_tags["table_close"]]
+                    if current_table_size + row_open_size + part_size < self._chunk_size: # if current table length is within permissible limit, keep adding rows
+                        if not is_table_tag: # need add the separator (row tag) when the part is not a table tag
                             current_table += self._table_tags["row_open"]
+                            current_table_size += row_open_size
                         current_table += part
+                        current_table_size += part_size
                         
                     else:
                         
@@ -208,10 +342,13 @@ class PdfTextSplitter(TextSplitter):
                         tables.append(current_table)
 
                         # start a new table
-                        current_table = "\n".join([caption, self._table_tags["table_open"], headers])
-                        if part not in [self._table_tags["table_open"], self._table_tags["table_close"]]:
+                        current_table = new_table_prefix
+                        current_table_size = new_table_prefix_size
+                        if not is_table_tag:
                             current_table += self._table_tags["row_open"]
+                            current_table_size += row_open_size
                         current_table += part
+                        current_table_size += part_size
 
             
             # TO DO: fix the case where the last mini table only contain tags
@@ -224,7 +361,23 @@ class PdfTextSplitter(TextSplitter):
             return tables
 
     
-@dataclass
+def decode_vector(vector: Union[str, List[float], array]) -> array:
+    """Returns an embedding as a float32 array. Strings are read as base64 of little-endian float32."""
+    if isinstance(vector, str):
+        decoded = array("f", base64.b64decode(vector))
+        if sys.byteorder == "big":
+            decoded.byteswap()
+        return decoded
+    return vector if isinstance(vector, array) and vector.typecode == "f" else array("f", vector)
+
+def encode_vector(vector: array) -> str:
+    """Encodes a float32 array as base64 of little-endian float32, the inverse of decode_vector."""
+    if sys.byteorder == "big":
+        vector = array("f", vector)
+        vector.byteswap()
+    return base64.b64encode(vector.tobytes()).decode("ascii")
+
+@dataclass(slots=True)
 class Document(object):
     """A data class for storing documents
 
@@ -235,6 +388,7 @@ class Document(object):
         filepath (Optional[str]): The filepath of the document.
         url (Optional[str]): The url of the document.
         metadata (Optional[Dict]): The metadata of the document.    
+        contentVector (Optional[array]): The embedding of the content, as float32.
     """
 
     content: str
@@ -243,7 +397,20 @@ class Document(object):
     filepath: Optional[str] = None
     url: Optional[str] = None
     metadata: Optional[Dict] = None
-    contentVector: Optional[List[float]] = None
+    contentVector: Optional[array] = None
+
+    def to_dict(self, vector_encoding: str = "float") -> Dict[str, Any]:
+        """Returns the document as a JSON-serializable dict.
+        Args:
+            vector_encoding (str): "float" writes contentVector as a list of floats, "base64" as base64 float32.
+        """
+        document = {name: getattr(self, name) for name in self.__slots__}
+        if self.contentVector is not None:
+            if vector_encoding == "base64":
+                document["contentVector"] = encode_vector(self.contentVector)
+            else:
+                document["contentVector"] = self.contentVector.tolist()
+        return document
 
 def cleanup_content(content: str) -> str:
     """Cleans up the given content using regexes
@@ -457,6 +624,11 @@ class UnsupportedFormatError(Exception):
 
     pass
 
+class FileTimeoutError(Exception):
+    """Exception raised when a worker takes longer than the timeout to chunk a file."""
+
+    pass
+
 @dataclass
 class ChunkingResult:
     """Data model for chunking result
@@ -467,6 +639,12 @@ class ChunkingResult:
         num_unsupported_format_files (int): Number of files with unsupported format.
         num_files_with_errors (int): Number of files with errors.
         skipped_chunks (int): Number of chunks skipped.
+        token_counts (List[int]): Number of tokens in each chunk, aligned with chunks.
+        num_unchanged_files (int): Number of files skipped by incremental ingestion.
+        deleted_chunk_ids (List[str]): Ids of chunks of removed or shrunk files, to delete from the index.
+        quarantined_files (List[str]): Files given up on because they timed out or crashed their worker.
+        file_statuses (Dict[str, str]): What became of each file, by path relative to the directory: chunked, empty
+            (no chunks), unsupported, error, quarantined or unchanged (skipped by incremental ingestion).
     """
     chunks: List[Document]
     total_files: int
@@ -474,6 +652,11 @@ class ChunkingResult:
     num_files_with_errors: int = 0
     # some chunks might be skipped to small number of tokens
     skipped_chunks: int = 0
+    token_counts: List[int] = field(default_factory=list)
+    num_unchanged_files: int = 0
+    deleted_chunk_ids: List[str] = field(default_factory=list)
+    quarantined_files: List[str] = field(default_factory=list)
+    file_statuses: Dict[str, str] = field(default_factory=dict)
 
 def extractStorageDetailsFromUrl(url):
     matches = re.fullmatch(r'https:\/\/([^\/.]*)\.blob\.core\.windows\.net\/([^\/]*)\/(.*)', url)
@@ -481,25 +664,224 @@ def extractStorageDetailsFromUrl(url):
         raise Exception(f"Not a valid blob storage URL: {url}")
     return (matches.group(1), matches.group(2), matches.group(3))
 
-def downloadBlobUrlToLocalFolder(blob_url, local_folder, credential):
+def _download_blob(container_client, blob, destination_path):
+    # large blobs are fetched in several ranges at once; everything is streamed to disk
+    max_concurrency = BLOB_MAX_CONCURRENCY if blob.size and blob.size > BLOB_LARGE_SIZE else 1
+    partial_path = destination_path + PARTIAL_DOWNLOAD_SUFFIX
+    os.makedirs(os.path.dirname(destination_path), exist_ok=True)
+    try:
+        with open(file=partial_path, mode='wb') as local_file:
+            stream = container_client.get_blob_client(blob.name).download_blob(
+                max_concurrency=max_concurrency, etag=blob.etag, match_condition=MatchConditions.IfNotModified)
+            stream.readinto(local_file)
+    except Exception:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(partial_path)
+        raise
+    os.replace(partial_path, destination_path)
+
+def downloadBlobUrlToLocalFolder(blob_url, local_folder, credential, concurrency: int = BLOB_DOWNLOAD_CONCURRENCY, index_path: Optional[str] = None,
+                                 shard_index: int = 0, num_shards: int = 1):
+    """Downloads the blobs under blob_url to local_folder, concurrency blobs at a time.
+    Args:
+        index_path (str): Optional file recording the ETag of every downloaded blob. Blobs whose ETag and
+            local file are unchanged since the last run are skipped, and local files of deleted blobs removed.
+        shard_index (int), num_shards (int): Only download the blobs of this shard, see get_shard_index.
+    """
+    _check_shard(shard_index, num_shards)
     (storage_account, container_name, path) = extractStorageDetailsFromUrl(blob_url)
     container_url = f'https://{storage_account}.blob.core.windows.net/{container_name}'
     container_client = ContainerClient.from_container_url(container_url, credential=credential)
     if path and not path.endswith('/'):
         path = path + '/'
 
-    last_destination_folder = None
-    for blob in container_client.list_blobs(name_starts_with=path):
-        relative_path = blob.name[len(path):]
-        destination_path = os.path.join(local_folder, relative_path)
-        destination_folder = os.path.dirname(destination_path)
-        if destination_folder != last_destination_folder:
-            os.makedirs(destination_folder, exist_ok=True)
-            last_destination_folder = destination_folder
-        blob_client = container_client.get_blob_client(blob.name)
-        with open(file=destination_path, mode='wb') as local_file:
-            stream = blob_client.download_blob()
-            local_file.write(stream.readall())
+    index = {}
+    if index_path and os.path.exists(index_path):
+        with open(index_path, "r", encoding="utf-8") as f:
+            index = json.load(f)
+    index_lock = threading.Lock()
+
+    def save_index():
+        if index_path:
+            with index_lock:
+                data = json.dumps(index)
+            with open(index_path + ".tmp", "w", encoding="utf-8") as f:
+                f.write(data)
+            os.replace(index_path + ".tmp", index_path)
+
+    def download(blob, destination_path):
+        _download_blob(container_client, blob, destination_path)
+        with index_lock:
+            index[blob.name] = {"etag": blob.etag, "size": blob.size,
+                                "last_modified": blob.last_modified.isoformat() if blob.last_modified else None}
+
+    listed_blobs = set()
+    num_skipped = 0
+    num_downloads = 0
+    num_done = 0
+    errors = []
+    in_flight = set()
+
+    def wait_for_downloads(max_in_flight):
+        nonlocal in_flight, num_done
+        while len(in_flight) > max_in_flight:
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    future.result()
+                except Exception as e:
+                    errors.append(e)
+                num_done += 1
+                # save progress now and then, so that an interrupted download resumes where it stopped
+                if num_done % 100 == 0:
+                    save_index()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for blob in container_client.list_blobs(name_starts_with=path):
+            if not in_shard(blob.name[len(path):], shard_index, num_shards):
+                continue
+            listed_blobs.add(blob.name)
+            destination_path = os.path.join(local_folder, blob.name[len(path):])
+            entry = index.get(blob.name)
+            if entry and entry["etag"] == blob.etag and os.path.isfile(destination_path) \
+                    and os.path.getsize(destination_path) == blob.size:
+                num_skipped += 1
+                continue
+            wait_for_downloads(concurrency * BLOB_DOWNLOAD_WINDOW - 1)
+            in_flight.add(executor.submit(download, blob, destination_path))
+            num_downloads += 1
+        wait_for_downloads(0)
+
+    for blob_name in [blob_name for blob_name in index if blob_name not in listed_blobs]:
+        destination_path = os.path.join(local_folder, blob_name[len(path):])
+        if os.path.isfile(destination_path):
+            os.remove(destination_path)
+        del index[blob_name]
+    save_index()
+
+    print(f"Downloaded {num_downloads - len(errors)} blobs, skipped {num_skipped} unchanged blobs")
+    if errors:
+        raise Exception(f"Failed to download {len(errors)} blobs, first error: {errors[0]}") from errors[0]
+
+class BlobDownloadStream:
+    """Downloads the blobs under blob_url to local_folder in the background, yielding the local path of each blob
+    as soon as it lands. At most max_local_files blobs are on disk at a time: pass each path to release once the
+    file has been processed to delete it and let the next blob in.
+
+    Use as a context manager; download errors are raised on exit, once every other blob has been yielded.
+    """
+
+    def __init__(self, blob_url: str, local_folder: str, credential,
+                 concurrency: int = BLOB_DOWNLOAD_CONCURRENCY,
+                 max_local_files: int = BLOB_PIPELINE_MAX_LOCAL_FILES,
+                 shard_index: int = 0, num_shards: int = 1):
+        _check_shard(shard_index, num_shards)
+        (storage_account, container_name, path) = extractStorageDetailsFromUrl(blob_url)
+        container_url = f'https://{storage_account}.blob.core.windows.net/{container_name}'
+        self.container_client = ContainerClient.from_container_url(container_url, credential=credential)
+        self.path = path + '/' if path and not path.endswith('/') else path
+        self.local_folder = local_folder
+        self.concurrency = concurrency
+        self.shard_index = shard_index
+        self.num_shards = num_shards
+        self.num_blobs = 0
+        self.num_bytes = 0
+        self.errors = []
+        self._slots = threading.Semaphore(max(1, max_local_files))
+        self._queue = queue.Queue()
+        self._end = object()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._executor = None
+        self._producer = None
+        self._start_time = None
+        self._end_time = None
+
+    def __enter__(self):
+        self._start_time = time.time()
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        self._producer = threading.Thread(target=self._list_and_download, daemon=True)
+        self._producer.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop.set()
+        # unblocks a consumer waiting for the next blob
+        self._queue.put(self._end)
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._producer.join()
+        self._executor.shutdown(wait=True)
+        print(f"Download: {self.stats}")
+        if exc_type is None and self.errors:
+            raise Exception(f"Failed to download {len(self.errors)} blobs, first error: {self.errors[0]}") from self.errors[0]
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        item = self._queue.get()
+        if item is self._end:
+            self._queue.put(self._end)
+            raise StopIteration
+        return item
+
+    def release(self, local_path: str):
+        """Deletes a yielded blob from disk, making room for the next one."""
+        if os.path.isfile(local_path):
+            os.remove(local_path)
+        self._slots.release()
+
+    @property
+    def stats(self) -> dict:
+        elapsed = (self._end_time or time.time()) - self._start_time
+        return {
+            "blobs": self.num_blobs,
+            "megabytes": round(self.num_bytes / 2**20, 1),
+            "seconds": round(elapsed, 1),
+            "blobs_per_second": round(self.num_blobs / elapsed, 2) if elapsed > 0 else 0,
+            "megabytes_per_second": round(self.num_bytes / 2**20 / elapsed, 2) if elapsed > 0 else 0,
+            "errors": len(self.errors),
+        }
+
+    def _download(self, blob, destination_path):
+        try:
+            _download_blob(self.container_client, blob, destination_path)
+        except Exception as e:
+            print(f"Blob ({blob.name}) failed with ", e)
+            with self._lock:
+                self.errors.append(e)
+            self._slots.release()
+            return
+        with self._lock:
+            self.num_blobs += 1
+            self.num_bytes += blob.size or 0
+        self._queue.put(destination_path)
+
+    def _list_and_download(self):
+        futures = []
+        try:
+            for blob in self.container_client.list_blobs(name_starts_with=self.path):
+                if not in_shard(blob.name[len(self.path):], self.shard_index, self.num_shards):
+                    continue
+                # wait for a free slot, i.e. for the consumer to release a processed blob
+                while not self._slots.acquire(timeout=0.1):
+                    if self._stop.is_set():
+                        return
+                if self._stop.is_set():
+                    return
+                destination_path = os.path.join(self.local_folder, blob.name[len(self.path):])
+                futures.append(self._executor.submit(self._download, blob, destination_path))
+            # every downloaded path is queued by the time its future is done
+            for future in futures:
+                future.result()
+        except Exception as e:
+            # downloads cancelled on exit are not errors
+            if not self._stop.is_set():
+                with self._lock:
+                    self.errors.append(e)
+        finally:
+            self._end_time = time.time()
+            self._queue.put(self._end)
 
 def get_files_recursively(directory_path: str) -> List[str]:
     """Gets all files in the given directory recursively.
@@ -511,10 +893,127 @@ def get_files_recursively(directory_path: str) -> List[str]:
     file_paths = []
     for dirpath, _, files in os.walk(directory_path):
         for file_name in files:
+            # left behind by an interrupted blob download
+            if file_name.endswith(PARTIAL_DOWNLOAD_SUFFIX):
+                continue
             file_path = os.path.join(dirpath, file_name)
             file_paths.append(file_path)
     return file_paths
 
+@dataclass
+class ManifestEntry:
+    """What was ingested from one file, see FileManifest.
+
+    Attributes:
+        size (int): File size in bytes.
+        mtime (float): File modification time.
+        content_hash (str): sha256 of the file content.
+        chunk_ids (List[str]): Ids of the chunks produced from the file.
+    """
+    size: int
+    mtime: float
+    content_hash: str
+    chunk_ids: List[str] = field(default_factory=list)
+
+class FileManifest:
+    """Records the files ingested from a directory so that later runs only process changes.
+
+    Files are keyed by their path relative to the directory. A file is unchanged if its
+    size and mtime match, or failing that, its content hash. The manifest is only valid
+    for the chunking parameters it was built with; with different parameters every file
+    counts as changed.
+    """
+    VERSION = 1
+
+    def __init__(self, path: str, chunking_params: Dict[str, Any]):
+        self.path = path
+        self.chunking_params = chunking_params
+        self.files: Dict[str, ManifestEntry] = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == self.VERSION and data.get("chunking_params") == chunking_params:
+                self.files = {rel_path: ManifestEntry(**entry) for rel_path, entry in data["files"].items()}
+            else:
+                print(f"Manifest {path} was built with other chunking parameters, reprocessing all files")
+                # keep the chunk ids so the old chunks still get deleted
+                self.files = {rel_path: ManifestEntry(size=-1, mtime=-1, content_hash="", chunk_ids=entry["chunk_ids"])
+                              for rel_path, entry in data.get("files", {}).items()}
+
+    @staticmethod
+    def hash_file(file_path: str) -> str:
+        file_hash = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                file_hash.update(block)
+        return file_hash.hexdigest()
+
+    def is_unchanged(self, rel_path: str, file_path: str) -> bool:
+        entry = self.files.get(rel_path)
+        if entry is None:
+            return False
+        stat = os.stat(file_path)
+        if entry.size != stat.st_size:
+            return False
+        if entry.mtime == stat.st_mtime:
+            return True
+        # touched or re-downloaded, compare the content
+        if entry.content_hash != self.hash_file(file_path):
+            return False
+        entry.mtime = stat.st_mtime
+        return True
+
+    def stale_chunk_ids(self, rel_path: str, chunk_ids: List[str]) -> List[str]:
+        """Returns the ids of the previous chunks of a file that are not among its new chunk_ids."""
+        previous = self.files.get(rel_path)
+        if previous is None:
+            return []
+        current_ids = set(chunk_ids)
+        return [chunk_id for chunk_id in previous.chunk_ids if chunk_id not in current_ids]
+
+    def update(self, rel_path: str, file_path: str, chunk_ids: List[str]):
+        """Records a processed file."""
+        stat = os.stat(file_path)
+        self.files[rel_path] = ManifestEntry(size=stat.st_size, mtime=stat.st_mtime,
+                                             content_hash=self.hash_file(file_path), chunk_ids=chunk_ids)
+
+    def removed_files(self, rel_paths) -> List[str]:
+        """Returns the recorded files that are not in rel_paths."""
+        rel_paths = set(rel_paths)
+        return [rel_path for rel_path in self.files if rel_path not in rel_paths]
+
+    def remove(self, rel_path: str):
+        self.files.pop(rel_path, None)
+
+    def save(self):
+        data = {
+            "version": self.VERSION,
+            "chunking_params": self.chunking_params,
+            "files": {rel_path: asdict(entry) for rel_path, entry in self.files.items()},
+        }
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+def get_chunk_id(rel_file_path: str, chunk_idx: int) -> str:
+    """Stable, search-index-safe id for the chunk_idx-th chunk of a file."""
+    return base64.urlsafe_b64encode(f"{convert_escaped_to_posix(rel_file_path)}_{chunk_idx}".encode("utf-8")).decode("ascii")
+
+def get_shard_index(rel_file_path: str, num_shards: int) -> int:
+    """The shard a file belongs to, from a hash of its path relative to the data root, so that every
+    machine assigns every file to the same shard without coordinating."""
+    digest = hashlib.sha1(convert_escaped_to_posix(rel_file_path).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % num_shards
+
+def in_shard(rel_file_path: str, shard_index: int = 0, num_shards: int = 1) -> bool:
+    return num_shards == 1 or get_shard_index(rel_file_path, num_shards) == shard_index
+
+def _check_shard(shard_index: int, num_shards: int):
+    if num_shards < 1 or not 0 <= shard_index < num_shards:
+        raise ValueError(f"Invalid shard {shard_index} of {num_shards}")
+
 def convert_escaped_to_posix(escaped_path):
     windows_path = escaped_path.replace("\\\\", "\\")
     posix_path = windows_path.replace("\\", "/")
@@ -537,28 +1036,272 @@ def _get_file_format(file_name: str, extensions_to_process: List[str]) -> Option
         return None
     return FILE_FORMAT_DICT.get(file_extension, None)
 
+class SqliteCache:
+    """Key-value cache in a local SQLite file, shared by all processes that open it.
+
+    The least recently used entries are evicted once the cache grows beyond max_bytes.
+    Subclasses choose the table and how values are stored.
+    """
+    TABLE = "entries"
+    # bump when the table layout or how values are stored changes; tables of another version are dropped
+    SCHEMA_VERSION = 1
+    SQLITE_MAX_VARIABLES = 500
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = None
+        self._total_bytes = 0
+
+    def _encode(self, value) -> bytes:
+        return value
+
+    def _decode(self, data: bytes):
+        return data
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            # one process at a time checks the version, so that a table is not dropped while another fills it
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute("CREATE TABLE IF NOT EXISTS schema_versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+            if self._table_version(connection) != self.SCHEMA_VERSION:
+                connection.execute(f"DROP TABLE IF EXISTS {self.TABLE}")
+            connection.execute(f"CREATE TABLE IF NOT EXISTS {self.TABLE} (key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)")
+            connection.execute(f"CREATE INDEX IF NOT EXISTS {self.TABLE}_last_used ON {self.TABLE} (last_used)")
+            connection.execute("INSERT OR REPLACE INTO schema_versions (name, version) VALUES (?, ?)", (self.TABLE, self.SCHEMA_VERSION))
+            connection.commit()
+            self._total_bytes = connection.execute(f"SELECT COALESCE(SUM(size), 0) FROM {self.TABLE}").fetchone()[0]
+            self._connection = connection
+        return self._connection
+
+    def _table_version(self, connection: sqlite3.Connection) -> Optional[int]:
+        row = connection.execute("SELECT version FROM schema_versions WHERE name = ?", (self.TABLE,)).fetchone()
+        if row is not None:
+            return row[0]
+        columns = [column[1] for column in connection.execute(f"PRAGMA table_info({self.TABLE})")]
+        if not columns:
+            return None
+        # tables from before versioning: the current layout is version 1, the earlier embeddings table
+        # (with a vector column) version 0
+        return 1 if "value" in columns else 0
+
+    def get_many(self, keys: List[str]) -> Dict[str, Any]:
+        """Returns the cached values for the keys that are present."""
+        found = {}
+        with self._lock:
+            connection = self._connect()
+            for start in range(0, len(keys), self.SQLITE_MAX_VARIABLES):
+                key_slice = keys[start:start + self.SQLITE_MAX_VARIABLES]
+                placeholders = ",".join("?" * len(key_slice))
+                for key, value in connection.execute(f"SELECT key, value FROM {self.TABLE} WHERE key IN ({placeholders})", key_slice):
+                    found[key] = self._decode(value)
+            if found:
+                now = time.time()
+                connection.executemany(f"UPDATE {self.TABLE} SET last_used = ? WHERE key = ?", [(now, key) for key in found])
+                connection.commit()
+            hits = sum(1 for key in keys if key in found)
+            self.hits += hits
+            self.misses += len(keys) - hits
+        return found
+
+    def get(self, key: str):
+        return self.get_many([key]).get(key)
+
+    def put_many(self, values: Dict[str, Any]):
+        now = time.time()
+        rows = []
+        for key, value in values.items():
+            blob = self._encode(value)
+            rows.append((key, blob, len(blob), now))
+        with self._lock:
+            connection = self._connect()
+            connection.executemany(f"INSERT OR REPLACE INTO {self.TABLE} (key, value, size, last_used) VALUES (?, ?, ?, ?)", rows)
+            connection.commit()
+            self._total_bytes += sum(row[2] for row in rows)
+            if self._total_bytes > self.max_bytes:
+                self._evict(connection)
+
+    def put(self, key: str, value):
+        self.put_many({key: value})
+
+    def _evict(self, connection: sqlite3.Connection):
+        # other processes may share the file, so start from the real size
+        total_bytes = connection.execute(f"SELECT COALESCE(SUM(size), 0) FROM {self.TABLE}").fetchone()[0]
+        target_bytes = self.max_bytes * 0.9
+        evicted_keys = []
+        for key, size in connection.execute(f"SELECT key, size FROM {self.TABLE} ORDER BY last_used"):
+            if total_bytes <= target_bytes:
+                break
+            evicted_keys.append((key,))
+            total_bytes -= size
+        connection.executemany(f"DELETE FROM {self.TABLE} WHERE key = ?", evicted_keys)
+        connection.commit()
+        self._total_bytes = total_bytes
+
+    @property
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        state["_connection"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+class AnalysisCache(SqliteCache):
+    """Persistent cache of the text extract_pdf_content assembles from a Form Recognizer analysis.
+
+    Entries are keyed by the file content hash, the model and the service API version, so changing
+    chunking parameters never causes a document to be analysed again. Text is stored compressed.
+    """
+    TABLE = "analysis"
+    # bump when extract_pdf_content changes how it assembles the text
+    FORMAT_VERSION = 2
+
+    def __init__(self, path: str, max_bytes: int = FORM_RECOGNIZER_CACHE_MAX_MB * 1024 * 1024):
+        super().__init__(path, max_bytes)
+
+    @classmethod
+    def make_key(cls, document: bytes, model: str, api_version: str) -> str:
+        document_hash = hashlib.sha256(document).hexdigest()
+        return f"{document_hash}|{model}|{api_version}|{cls.FORMAT_VERSION}"
+
+    def _encode(self, value: str) -> bytes:
+        return zlib.compress(value.encode("utf-8"))
+
+    def _decode(self, data: bytes) -> str:
+        return zlib.decompress(data).decode("utf-8")
+
+ANALYSIS_CACHE = None
+
+def get_analysis_cache() -> Optional[AnalysisCache]:
+    """Returns the analysis cache of this process, or None if FORM_RECOGNIZER_CACHE_PATH is not set."""
+    global ANALYSIS_CACHE
+    if ANALYSIS_CACHE is None and FORM_RECOGNIZER_CACHE_PATH:
+        ANALYSIS_CACHE = AnalysisCache(FORM_RECOGNIZER_CACHE_PATH)
+    return ANALYSIS_CACHE
+
 def table_to_html(table):
-    table_html = "<table>"
-    rows = [sorted([cell for cell in table.cells if cell.row_index == i], key=lambda cell: cell.column_index) for i in range(table.row_count)]
+    # group the cells by row once instead of scanning all cells for every row
+    rows = [[] for _ in range(table.row_count)]
+    for cell in table.cells:
+        if 0 <= cell.row_index < table.row_count:
+            rows[cell.row_index].append(cell)
+    table_html = ["<table>"]
     for row_cells in rows:
-        table_html += "<tr>"
-        for cell in row_cells:
+        table_html.append("<tr>")
+        for cell in sorted(row_cells, key=lambda cell: cell.column_index):
             tag = "th" if (cell.kind == "columnHeader" or cell.kind == "rowHeader") else "td"
             cell_spans = ""
             if cell.column_span > 1: cell_spans += f" colSpan={cell.column_span}"
             if cell.row_span > 1: cell_spans += f" rowSpan={cell.row_span}"
-            table_html += f"<{tag}{cell_spans}>{html.escape(cell.content)}</{tag}>"
-        table_html +="</tr>"
-    table_html += "</table>"
-    return table_html
+            table_html.append(f"<{tag}{cell_spans}>{html.escape(cell.content)}</{tag}>")
+        table_html.append("</tr>")
+    table_html.append("</table>")
+    return "".join(table_html)
+
+def _table_segments(tables_on_page, page_offset, page_length) -> List[Tuple[int, int, int]]:
+    """Splits a page into (start, end, table_id) segments, table_id -1 meaning no table.
+    Where table spans overlap, the later table wins."""
+    boundaries = {0, page_length}
+    spans = []
+    for table_id, table in enumerate(tables_on_page):
+        for span in table.spans:
+            start = max(span.offset - page_offset, 0)
+            end = min(span.offset - page_offset + span.length, page_length)
+            if start < end:
+                spans.append((start, end, table_id))
+                boundaries.update((start, end))
+    boundaries = sorted(boundaries)
+    segments = []
+    for start, end in zip(boundaries, boundaries[1:]):
+        table_id = max((span_table_id for span_start, span_end, span_table_id in spans
+                        if span_start <= start and end <= span_end), default=-1)
+        if segments and segments[-1][2] == table_id:
+            segments[-1] = (segments[-1][0], end, table_id)
+        else:
+            segments.append((start, end, table_id))
+    return segments
+
+def _get_analysis_cache_key(document: bytes, model: str, form_recognizer_client) -> Optional[str]:
+    cache = get_analysis_cache()
+    if cache is None:
+        return None
+    api_version = getattr(form_recognizer_client, "_api_version", "")
+    return cache.make_key(document, model, str(getattr(api_version, "value", api_version)))
+
+@lru_cache(maxsize=1)
+def _import_pdf_reader():
+    """Returns pypdf's PdfReader, or None with a warning, printed once, if pypdf is not installed."""
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        print("Warning: pypdf is not installed, so large PDFs are analysed in one piece rather than in page ranges "
+              "(pip install pypdf)")
+        return None
+    return PdfReader
+
+def get_pdf_page_count(document: bytes) -> Optional[int]:
+    """Counts the pages of a PDF, or returns None if it cannot tell (including when pypdf is not installed)."""
+    PdfReader = _import_pdf_reader()
+    if PdfReader is None:
+        return None
+    try:
+        return len(PdfReader(io.BytesIO(document)).pages)
+    except Exception:
+        return None
+
+def get_page_ranges(file_path: str, document: bytes, page_range_size: int = PDF_PAGE_RANGE_SIZE) -> List[Optional[str]]:
+    """Splits a large PDF into values for the pages parameter of begin_analyze_document.
+    Returns [None], i.e. the whole document in one piece, for anything else."""
+    if not file_path.lower().endswith(".pdf") or page_range_size <= 0:
+        return [None]
+    page_count = get_pdf_page_count(document)
+    if page_count is None or page_count <= page_range_size:
+        return [None]
+    return [f"{first_page}-{min(first_page + page_range_size - 1, page_count)}"
+            for first_page in range(1, page_count + 1, page_range_size)]
 
 def extract_pdf_content(file_path, form_recognizer_client, use_layout=False): 
-    offset = 0
-    page_map = []
     model = "prebuilt-layout" if use_layout else "prebuilt-read"
     with open(file_path, "rb") as f:
-        poller = form_recognizer_client.begin_analyze_document(model, document = f)
-    form_recognizer_results = poller.result()
+        document = f.read()
+
+    cache_key = _get_analysis_cache_key(document, model, form_recognizer_client)
+    if cache_key is not None:
+        full_text = get_analysis_cache().get(cache_key)
+        if full_text is not None:
+            return full_text
+
+    # page ranges of a large PDF are all submitted before waiting for any, so the service analyses them in parallel
+    pollers = [form_recognizer_client.begin_analyze_document(model, document = document, pages = pages) if pages else
+               form_recognizer_client.begin_analyze_document(model, document = document)
+               for pages in get_page_ranges(file_path, document)]
+    full_text = "".join(analyze_result_to_text(poller.result()) for poller in pollers)
+    if cache_key is not None:
+        get_analysis_cache().put(cache_key, full_text)
+    return full_text
+
+def analyze_result_to_text(form_recognizer_results) -> str:
+    """Assembles the text of a Form Recognizer analysis, with tables as html and (if using layout) html headers."""
+    offset = 0
+    page_map = []
+    content = form_recognizer_results.content
 
     # (if using layout) mark all the positions of headers
     roles_start = {}
@@ -569,51 +1312,143 @@ def extract_pdf_content(file_path, form_recognizer_client, use_layout=False):
             para_end = paragraph.spans[0].offset + paragraph.spans[0].length
             roles_start[para_start] = paragraph.role
             roles_end[para_end] = paragraph.role
+    header_tags = {}
+    for position, role in roles_start.items():
+        if role in PDF_HEADERS:
+            header_tags[position] = f"<{PDF_HEADERS[role]}>"
+    for position, role in roles_end.items():
+        if role in PDF_HEADERS:
+            header_tags[position] = header_tags.get(position, "") + f"</{PDF_HEADERS[role]}>"
+    header_positions = sorted(header_tags)
+
+    tables_by_page = {}
+    for table in form_recognizer_results.tables:
+        tables_by_page.setdefault(table.bounding_regions[0].page_number, []).append(table)
 
     for page_num, page in enumerate(form_recognizer_results.pages):
-        tables_on_page = [table for table in form_recognizer_results.tables if table.bounding_regions[0].page_number == page_num + 1]
-
-        # (if using layout) mark all positions of the table spans in the page
+        # page_number rather than page_num + 1, since the result may cover only a range of pages
+        tables_on_page = tables_by_page.get(page.page_number, [])
         page_offset = page.spans[0].offset
         page_length = page.spans[0].length
-        table_chars = [-1]*page_length
-        for table_id, table in enumerate(tables_on_page):
-            for span in table.spans:
-                # replace all table spans with "table_id" in table_chars array
-                for i in range(span.length):
-                    idx = span.offset - page_offset + i
-                    if idx >=0 and idx < page_length:
-                        table_chars[idx] = table_id
-
-        # build page text by replacing charcters in table spans with table html and replace the characters corresponding to headers with html headers, if using layout
-        page_text = ""
-        added_tables = set()
-        for idx, table_id in enumerate(table_chars):
-            if table_id == -1:
-                position = page_offset + idx
-                if position in roles_start.keys():
-                    role = roles_start[position]
-                    if role in PDF_HEADERS:
-                        page_text += f"<{PDF_HEADERS[role]}>"
-                if position in roles_end.keys():
-                    role = roles_end[position]
-                    if role in PDF_HEADERS:
-                        page_text += f"</{PDF_HEADERS[role]}>"
-
-                page_text += form_recognizer_results.content[page_offset + idx]
-                
-            elif not table_id in added_tables:
-                page_text += table_to_html(tables_on_page[table_id])
-                added_tables.add(table_id)
 
-        page_text += " "
+        # build page text from slices of the content, replacing table spans with table html and
+        # inserting html headers at paragraph boundaries, if using layout
+        page_text = []
+        added_tables = set()
+        for start, end, table_id in _table_segments(tables_on_page, page_offset, page_length):
+            if table_id != -1:
+                # a table split by another table's span is only added the first time
+                if not table_id in added_tables:
+                    page_text.append(table_to_html(tables_on_page[table_id]))
+                    added_tables.add(table_id)
+                continue
+            position = page_offset + start
+            for tag_position in header_positions[bisect.bisect_left(header_positions, position):
+                                                 bisect.bisect_left(header_positions, page_offset + end)]:
+                page_text.append(content[position:tag_position])
+                page_text.append(header_tags[tag_position])
+                position = tag_position
+            page_text.append(content[position:page_offset + end])
+
+        page_text.append(" ")
+        page_text = "".join(page_text)
         page_map.append((page_num, offset, page_text))
         offset += len(page_text)
 
     full_text = "".join([page_text for _, _, page_text in page_map])
     return full_text
 
-def merge_chunks_serially(chunked_content_list: List[str], num_tokens: int, url_dict: Dict[str, str]={}) -> Generator[Tuple[str, int], None, None]:
+class AsyncDocumentAnalyzer:
+    """Analyses documents with the async Form Recognizer client, so that many documents can be
+    submitted and polled at once from a single event loop instead of one per worker process.
+
+    Use as an async context manager. At most concurrency analyses are in flight; finished
+    analyses go through the same cache and text assembly as extract_pdf_content.
+    Analyses go to the given client if there is one, otherwise to an async client for endpoint
+    and key. A synchronous DocumentAnalysisClient is called from threads; the caller closes it.
+    """
+
+    def __init__(self, endpoint: Optional[str] = None, key: Optional[str] = None, use_layout: bool = False,
+                 extensions_to_process: List[str] = list(FILE_FORMAT_DICT.keys()),
+                 concurrency: int = FORM_RECOGNIZER_CONCURRENCY, client = None):
+        if client is None and not (endpoint and key):
+            raise ValueError("AsyncDocumentAnalyzer needs either a client or an endpoint and key")
+        self.endpoint = endpoint
+        self.key = key
+        self.model = "prebuilt-layout" if use_layout else "prebuilt-read"
+        self.extensions_to_process = extensions_to_process
+        self.concurrency = concurrency
+        self._owns_client = client is None
+        self._client = client
+        self._semaphore = None
+
+    @classmethod
+    def from_env(cls, **kwargs) -> Optional["AsyncDocumentAnalyzer"]:
+        """Returns an analyzer for FORM_RECOGNIZER_ENDPOINT and FORM_RECOGNIZER_KEY, or None if they are not set."""
+        endpoint = os.getenv("FORM_RECOGNIZER_ENDPOINT")
+        key = os.getenv("FORM_RECOGNIZER_KEY")
+        if not endpoint or not key:
+            return None
+        return cls(endpoint, key, **kwargs)
+
+    async def __aenter__(self):
+        if self._owns_client:
+            self._client = AsyncDocumentAnalysisClient(
+                endpoint=self.endpoint, credential=AzureKeyCredential(self.key), headers={"x-ms-useragent": "sample-app-aoai-chatgpt/1.0.0"})
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self
+
+    async def __aexit__(self, *args):
+        if self._owns_client:
+            await self._client.close()
+            self._client = None
+
+    def handles(self, file_path: str) -> bool:
+        return _get_file_format(os.path.basename(file_path), self.extensions_to_process) in FORM_RECOGNIZER_FORMATS
+
+    async def analyze(self, file_path: str) -> str:
+        """Returns the text extract_pdf_content would return for file_path."""
+        # Reading, hashing, cache lookups and page text assembly block, so they run in threads
+        # rather than holding up the polling of every other document on the event loop.
+        loop = asyncio.get_running_loop()
+
+        def read_document():
+            with open(file_path, "rb") as f:
+                document = f.read()
+            cache_key = _get_analysis_cache_key(document, self.model, self._client)
+            full_text = get_analysis_cache().get(cache_key) if cache_key is not None else None
+            return document, cache_key, full_text
+
+        document, cache_key, full_text = await loop.run_in_executor(None, read_document)
+        if full_text is not None:
+            return full_text
+
+        def analyze_pages_sync(pages):
+            if pages:
+                return self._client.begin_analyze_document(self.model, document=document, pages=pages).result()
+            return self._client.begin_analyze_document(self.model, document=document).result()
+
+        async def analyze_pages(pages):
+            async with self._semaphore:
+                if not isinstance(self._client, AsyncDocumentAnalysisClient):
+                    result = await loop.run_in_executor(None, analyze_pages_sync, pages)
+                elif pages:
+                    poller = await self._client.begin_analyze_document(self.model, document=document, pages=pages)
+                    result = await poller.result()
+                else:
+                    poller = await self._client.begin_analyze_document(self.model, document=document)
+                    result = await poller.result()
+            return await loop.run_in_executor(None, analyze_result_to_text, result)
+
+        # page ranges of a large PDF are analysed in parallel and joined back in page order
+        page_ranges = await loop.run_in_executor(None, get_page_ranges, file_path, document)
+        full_text = "".join(await asyncio.gather(*[analyze_pages(pages) for pages in page_ranges]))
+        if cache_key is not None:
+            await loop.run_in_executor(None, get_analysis_cache().put, cache_key, full_text)
+        return full_text
+
+def merge_chunks_serially(chunked_content_list: List[str], num_tokens: int, url_dict: Dict[str, str]={},
+                          length_function: Callable[[str], int] = TOKEN_ESTIMATOR.estimate_tokens) -> Generator[Tuple[str, int], None, None]:
     def unmask_urls(text, url_dict={}):
         if "##URL" in text:
             for key, value in url_dict.items():
@@ -624,7 +1459,7 @@ def merge_chunks_serially(chunked_content_list: List[str], num_tokens: int, url_
     total_size = 0
     for chunked_content in chunked_content_list:
         chunked_content = unmask_urls(chunked_content, url_dict)
-        chunk_size = TOKEN_ESTIMATOR.estimate_tokens(chunked_content)
+        chunk_size = length_function(chunked_content)
         if total_size > 0:
             new_size = total_size + chunk_size
             if new_size > num_tokens:
@@ -636,26 +1471,227 @@ def merge_chunks_serially(chunked_content_list: List[str], num_tokens: int, url_
     if total_size > 0:
         yield current_chunk, total_size
 
+def _find_break(text: str, start: int, end: int) -> int:
+    """Returns the offset just after the last sentence ending in text[start:end], or failing that
+    the last word break (in WORDS_BREAKS order of preference), or -1 if there is neither."""
+    sentence_end = max(text.rfind(ending, start, end) for ending in SENTENCE_ENDINGS)
+    if sentence_end >= 0:
+        return sentence_end + 1
+    for word_break in WORDS_BREAKS:
+        position = text.rfind(word_break, start, end)
+        if position >= 0:
+            return position + 1
+    return -1
+
+def split_by_token_offsets(text: str, tokens: List[int], num_tokens: int, token_overlap: int = 0) -> Generator[Tuple[str, int], None, None]:
+    """Cuts text into chunks of at most num_tokens tokens using the tokens it was already encoded to,
+    so nothing is encoded twice. Cuts snap to the last sentence ending, or else word break, in the
+    second half of each chunk.
+    Args:
+        text (str): The text to chunk.
+        tokens (List[int]): TOKEN_ESTIMATOR.encode(text).
+        num_tokens (int): The maximum number of tokens in a chunk.
+        token_overlap (int): The number of tokens each chunk repeats from the end of the previous one.
+    Returns:
+        Generator[Tuple[str, int]]: (chunk, token count) pairs.
+    """
+    offsets = TOKEN_ESTIMATOR.token_char_offsets(tokens)
+    offsets.append(len(text))
+    token_overlap = min(token_overlap, num_tokens // 2)
+    start = 0
+    while start < len(tokens):
+        end = min(start + num_tokens, len(tokens))
+        if end < len(tokens):
+            char_break = _find_break(text, offsets[start + num_tokens // 2], offsets[end])
+            if char_break > 0:
+                # first token starting at or after the break; a token straddling it goes to the next chunk
+                cut = bisect.bisect_left(offsets, char_break, start + 1, end)
+                if cut > start:
+                    end = cut
+        raw_chunk = text[offsets[start]:offsets[end]]
+        chunk = raw_chunk.strip()
+        if chunk:
+            # leave out the tokens that are only the whitespace stripped off either end
+            first, last = start, end
+            chunk_start = offsets[start] + len(raw_chunk) - len(raw_chunk.lstrip())
+            if chunk_start > offsets[start]:
+                first = bisect.bisect_right(offsets, chunk_start, start, end) - 1
+            if len(raw_chunk.rstrip()) < len(raw_chunk):
+                last = bisect.bisect_left(offsets, chunk_start + len(chunk), start, end)
+            yield chunk, last - first
+        if end == len(tokens):
+            break
+        start = max(end - token_overlap, start + 1)
+
+def count_chunk_tokens(text: str, tokens: List[int], chunks: List[str]) -> Generator[Tuple[str, int], None, None]:
+    """Pairs chunks cut from text with their token counts, taken from the tokens the whole text was already
+    encoded to rather than by encoding every chunk again.
+    Args:
+        text (str): The text the chunks were cut from.
+        tokens (List[int]): TOKEN_ESTIMATOR.encode(text).
+        chunks (List[str]): Substrings of text in order, possibly overlapping. A chunk not found in text is encoded.
+    Returns:
+        Generator[Tuple[str, int]]: (chunk, token count) pairs.
+    """
+    offsets = TOKEN_ESTIMATOR.token_char_offsets(tokens)
+    search_from = 0
+    for chunk in chunks:
+        start = text.find(chunk, search_from)
+        if start < 0:
+            yield chunk, TOKEN_ESTIMATOR.estimate_tokens(chunk)
+            continue
+        # the tokens that overlap the chunk, so one holding the space before its first word is counted
+        yield chunk, bisect.bisect_left(offsets, start + len(chunk)) - (bisect.bisect_right(offsets, start) - 1)
+        search_from = start + 1
+
+class EmbeddingRateLimiter:
+    """Token-bucket limiter for embedding requests.
+
+    Embeddings are requested from threads of the main process (the chunking
+    workers do not embed), so one limiter shared by those threads keeps them
+    all just under the deployment's tokens/requests per minute quota. A 429
+    with Retry-After pauses every thread, not only the one that was throttled.
+    """
+
+    def __init__(self, tokens_per_minute: Optional[float] = None, requests_per_minute: Optional[float] = None, headroom: float = 0.9):
+        self._tpm = float(tokens_per_minute) * headroom if tokens_per_minute else 0.0
+        self._rpm = float(requests_per_minute) * headroom if requests_per_minute else 0.0
+        self._lock = threading.Lock()
+        self._tokens = self._tpm
+        self._requests = self._rpm
+        self._last_refill = time.time()
+        self._paused_until = 0.0
+
+    def _refill(self, now: float):
+        elapsed = max(0.0, now - self._last_refill)
+        self._last_refill = now
+        self._tokens = min(self._tpm, self._tokens + elapsed * self._tpm / 60)
+        self._requests = min(self._rpm, self._requests + elapsed * self._rpm / 60)
+
+    def acquire(self, num_tokens: int = 0):
+        """Blocks until a request of num_tokens tokens fits in the quota."""
+        # a request larger than the whole bucket still goes through once the bucket is full
+        num_tokens = min(num_tokens, self._tpm)
+        while True:
+            with self._lock:
+                now = time.time()
+                self._refill(now)
+                wait = self._paused_until - now
+                if wait <= 0:
+                    token_deficit = num_tokens - self._tokens if self._tpm else 0
+                    request_deficit = 1 - self._requests if self._rpm else 0
+                    if token_deficit <= 0 and request_deficit <= 0:
+                        self._tokens -= num_tokens
+                        self._requests -= 1 if self._rpm else 0
+                        return
+                    wait = max(token_deficit * 60 / self._tpm if token_deficit > 0 else 0,
+                               request_deficit * 60 / self._rpm if request_deficit > 0 else 0)
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        """Holds back all requests for the given number of seconds."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.time() + seconds)
+
+    def update_from_headers(self, headers):
+        """Aligns the buckets with the quota the service reports as remaining."""
+        remaining_tokens = _parse_float_header(headers, "x-ratelimit-remaining-tokens")
+        remaining_requests = _parse_float_header(headers, "x-ratelimit-remaining-requests")
+        with self._lock:
+            if remaining_tokens is not None and self._tpm:
+                self._tokens = min(self._tokens, remaining_tokens)
+            if remaining_requests is not None and self._rpm:
+                self._requests = min(self._requests, remaining_requests)
+        if remaining_tokens == 0 or remaining_requests == 0:
+            reset = _parse_float_header(headers, "x-ratelimit-reset-tokens") or _parse_float_header(headers, "x-ratelimit-reset-requests")
+            self.pause(reset if reset else RETRY_BACKOFF_BASE)
+
+EMBEDDING_RATE_LIMITER = None
+
+def get_embedding_rate_limiter() -> EmbeddingRateLimiter:
+    """Returns the limiter of this process, creating it from EMBEDDING_TPM_LIMIT/EMBEDDING_RPM_LIMIT if needed."""
+    global EMBEDDING_RATE_LIMITER
+    if EMBEDDING_RATE_LIMITER is None:
+        EMBEDDING_RATE_LIMITER = EmbeddingRateLimiter(EMBEDDING_TPM_LIMIT, EMBEDDING_RPM_LIMIT)
+    return EMBEDDING_RATE_LIMITER
+
+def _parse_float_header(headers, name: str) -> Optional[float]:
+    value = headers.get(name) if headers else None
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+def get_retry_after(error: Exception) -> Optional[float]:
+    """Returns the delay in seconds requested by the service for a failed call, if any."""
+    cause = error.__cause__ or error
+    response = getattr(cause, "response", None)
+    headers = getattr(response, "headers", None) or getattr(cause, "headers", None)
+    retry_after_ms = _parse_float_header(headers, "retry-after-ms")
+    if retry_after_ms is not None:
+        return retry_after_ms / 1000
+    return _parse_float_header(headers, "retry-after")
+
+def is_retryable_error(error: Exception) -> bool:
+    """Whether a failed call is worth retrying: throttling (429), a server error (5xx) or a connection error.
+    Other client errors (400, 401, 404, ...) fail the same way on every attempt."""
+    cause = error.__cause__ or error
+    if isinstance(cause, urllib.error.HTTPError):
+        status_code = cause.code
+    else:
+        status_code = getattr(cause, "status_code", None)
+    if status_code is not None:
+        return status_code == 429 or status_code >= 500
+    return isinstance(cause, (APIConnectionError, urllib.error.URLError, ConnectionError, TimeoutError))
+
+def get_backoff_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+    """Exponential backoff with full jitter, never shorter than the service's Retry-After."""
+    delay = random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, retry_after + random.uniform(0, 1))
+    return delay
+
 def get_payload_and_headers_cohere(
-    text, aad_token) -> Tuple[Dict, Dict]:
+    texts, aad_token) -> Tuple[Dict, Dict]:
     oai_headers =  {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {aad_token}",
     }
 
-    cohere_body = { "texts": [text], "input_type": "search_document" }
+    cohere_body = { "texts": texts, "input_type": "search_document" }
     return cohere_body, oai_headers
-    
-def get_embedding(text, embedding_model_endpoint=None, embedding_model_key=None, azure_credential=None):
+
+@lru_cache(maxsize=8)
+def get_aoai_embedding_client(base_url, api_version, api_key=None, azure_credential=None) -> AzureOpenAI:
+    """Returns a cached AzureOpenAI client so the connection pool is reused across requests.
+    Retries are left to embed_document_batch, which coordinates them through the rate limiter."""
+    if azure_credential is not None:
+        return AzureOpenAI(api_version=api_version, azure_endpoint=base_url, max_retries=0,
+                           azure_ad_token_provider=lambda: azure_credential.get_token(COGNITIVE_SERVICES_SCOPE).token)
+    return AzureOpenAI(api_version=api_version, azure_endpoint=base_url, api_key=api_key, max_retries=0)
+
+def get_embeddings(texts: List[str], embedding_model_endpoint=None, embedding_model_key=None, azure_credential=None, num_tokens: Optional[int] = None) -> List[array]:
+    """Embeds several texts with a single request, waiting for the rate limiter first.
+    Args:
+        texts (List[str]): The texts to embed.
+        num_tokens (int): Total tokens in texts, used by the rate limiter. Estimated from the length if None.
+    Returns:
+        List[array]: One float32 embedding per text, in the same order as texts.
+    """
     endpoint = embedding_model_endpoint if embedding_model_endpoint else os.environ.get("EMBEDDING_MODEL_ENDPOINT")
     
     FLAG_EMBEDDING_MODEL = os.getenv("FLAG_EMBEDDING_MODEL", "AOAI")
     FLAG_COHERE = os.getenv("FLAG_COHERE", "ENGLISH")
     FLAG_AOAI = os.getenv("FLAG_AOAI", "V3")
 
-    if azure_credential is None and (endpoint is None or key is None):
+    if endpoint is None:
         raise Exception("EMBEDDING_MODEL_ENDPOINT and EMBEDDING_MODEL_KEY are required for embedding")
 
+    rate_limiter = get_embedding_rate_limiter()
+    rate_limiter.acquire(num_tokens if num_tokens is not None else sum(len(text) for text in texts) // 4)
+
     try:
         if FLAG_EMBEDDING_MODEL == "AOAI":
             endpoint_parts = endpoint.split("/openai/deployments/")
@@ -663,38 +1699,192 @@ def get_embedding(text, embedding_model_endpoint=None, embedding_model_key=None,
             deployment_id = endpoint_parts[1].split("/embeddings")[0]
             api_version = endpoint_parts[1].split("api-version=")[1].split("&")[0]
             if azure_credential is not None:
-                api_key = azure_credential.get_token("https://cognitiveservices.azure.com/.default").token
+                client = get_aoai_embedding_client(base_url, api_version, azure_credential=azure_credential)
             else:
                 api_key = embedding_model_key if embedding_model_key else os.getenv("AZURE_OPENAI_API_KEY")
-            
-            client = AzureOpenAI(api_version=api_version, azure_endpoint=base_url, api_key=api_key)
+                client = get_aoai_embedding_client(base_url, api_version, api_key=api_key)
+
+            # base64 is about a quarter of the size of the JSON floats and decodes straight into float32
             if FLAG_AOAI == "V2":
-                embeddings = client.embeddings.create(model=deployment_id, input=text)
+                raw_response = client.embeddings.with_raw_response.create(model=deployment_id, input=texts,
+                                                                          encoding_format="base64")
             elif FLAG_AOAI == "V3":   
-                embeddings = client.embeddings.create(model=deployment_id, 
-                                                      input=text, 
-                                                      dimensions=int(os.getenv("VECTOR_DIMENSION", 1536)))
+                raw_response = client.embeddings.with_raw_response.create(model=deployment_id, 
+                                                                          input=texts, 
+                                                                          dimensions=int(os.getenv("VECTOR_DIMENSION", 1536)),
+                                                                          encoding_format="base64")
+            rate_limiter.update_from_headers(raw_response.headers)
+            embeddings = raw_response.parse()
             
-            return embeddings.dict()['data'][0]['embedding']
+            return [decode_vector(item.embedding) for item in sorted(embeddings.data, key=lambda item: item.index)]
         
         if FLAG_EMBEDDING_MODEL == "COHERE":
             if FLAG_COHERE == "MULTILINGUAL":
                 key = embedding_model_key if embedding_model_key else os.getenv("COHERE_MULTILINGUAL_API_KEY")
             elif FLAG_COHERE == "ENGLISH":
                 key = embedding_model_key if embedding_model_key else os.getenv("COHERE_ENGLISH_API_KEY")
-            data, headers = get_payload_and_headers_cohere(text, key)
+            data, headers = get_payload_and_headers_cohere(texts, key)
 
             body = str.encode(json.dumps(data))
             req = urllib.request.Request(endpoint, body, headers)
             response = urllib.request.urlopen(req)
+            rate_limiter.update_from_headers(response.headers)
             result = response.read()
             result_content = json.loads(result.decode('utf-8'))
                         
-            return result_content["embeddings"][0]   
+            return [decode_vector(embedding) for embedding in result_content["embeddings"]]
         
 
     except Exception as e:
-        raise Exception(f"Error getting embeddings with endpoint={endpoint} with error={e}")
+        raise Exception(f"Error getting embeddings with endpoint={endpoint} with error={e}") from e
+
+def get_embedding(text, embedding_model_endpoint=None, embedding_model_key=None, azure_credential=None):
+    return get_embeddings([text], embedding_model_endpoint=embedding_model_endpoint,
+                          embedding_model_key=embedding_model_key, azure_credential=azure_credential)[0]
+
+def batch_by_token_budget(token_counts: List[int], max_items: int = EMBEDDING_BATCH_SIZE,
+                          max_tokens: int = EMBEDDING_BATCH_MAX_TOKENS,
+                          indices: Optional[List[int]] = None) -> Generator[List[int], None, None]:
+    """Groups item indices into batches of at most max_items items and max_tokens tokens.
+    An item larger than max_tokens is sent in a batch of its own.
+    Args:
+        token_counts (List[int]): Token count of each item.
+        indices (List[int]): Only batch these items. Defaults to all of them.
+    Returns:
+        Generator[List[int]]: Lists of item indices.
+    """
+    batch = []
+    batch_tokens = 0
+    for idx in (range(len(token_counts)) if indices is None else indices):
+        num_tokens = token_counts[idx]
+        if batch and (len(batch) >= max_items or batch_tokens + num_tokens > max_tokens):
+            yield batch
+            batch = []
+            batch_tokens = 0
+        batch.append(idx)
+        batch_tokens += num_tokens
+    if batch:
+        yield batch
+
+class EmbeddingCache(SqliteCache):
+    """Persistent embedding cache in a local SQLite file.
+
+    Entries are keyed by a hash of the chunk text and the embedding model, see
+    get_embedding_model_id. Vectors are stored as float32.
+    """
+    TABLE = "embeddings"
+
+    def __init__(self, path: str, max_bytes: int = EMBEDDING_CACHE_MAX_MB * 1024 * 1024):
+        super().__init__(path, max_bytes)
+
+    @staticmethod
+    def make_key(text: str, model_id: str) -> str:
+        return hashlib.sha256(f"{model_id}\n{text}".encode("utf-8")).hexdigest()
+
+    def _encode(self, value: array) -> bytes:
+        return decode_vector(value).tobytes()
+
+    def _decode(self, data: bytes) -> array:
+        return array("f", data)
+
+EMBEDDING_CACHE = None
+
+def get_embedding_cache() -> Optional[EmbeddingCache]:
+    """Returns the embedding cache of this process, or None if EMBEDDING_CACHE_PATH is not set."""
+    global EMBEDDING_CACHE
+    if EMBEDDING_CACHE is None and EMBEDDING_CACHE_PATH:
+        EMBEDDING_CACHE = EmbeddingCache(EMBEDDING_CACHE_PATH)
+    return EMBEDDING_CACHE
+
+def get_embedding_model_id(embedding_model_endpoint=None) -> str:
+    """Identifies the embedding model, deployment and dimensions that get_embeddings would use."""
+    endpoint = embedding_model_endpoint if embedding_model_endpoint else os.environ.get("EMBEDDING_MODEL_ENDPOINT")
+    endpoint = (endpoint or "").split("?")[0]
+    FLAG_EMBEDDING_MODEL = os.getenv("FLAG_EMBEDDING_MODEL", "AOAI")
+    if FLAG_EMBEDDING_MODEL == "AOAI":
+        FLAG_AOAI = os.getenv("FLAG_AOAI", "V3")
+        dimensions = os.getenv("VECTOR_DIMENSION", "1536") if FLAG_AOAI == "V3" else "default"
+        return f"{FLAG_EMBEDDING_MODEL}|{FLAG_AOAI}|{endpoint}|{dimensions}"
+    return f"{FLAG_EMBEDDING_MODEL}|{os.getenv('FLAG_COHERE', 'ENGLISH')}|{endpoint}"
+
+def apply_cached_embeddings(documents: List[Document], embedding_endpoint = None) -> List[int]:
+    """Sets contentVector from the embedding cache where possible.
+    Args:
+        documents (List[Document]): The chunks to embed.
+    Returns:
+        List[int]: Indices of the documents that still need an embedding.
+    """
+    cache = get_embedding_cache()
+    if cache is None:
+        return list(range(len(documents)))
+
+    model_id = get_embedding_model_id(embedding_endpoint)
+    keys = [cache.make_key(document.content, model_id) for document in documents]
+    cached_vectors = cache.get_many(keys)
+    missing = []
+    for idx, key in enumerate(keys):
+        if key in cached_vectors:
+            documents[idx].contentVector = cached_vectors[key]
+        else:
+            missing.append(idx)
+    return missing
+
+def add_embeddings_to_documents(
+    documents: List[Document],
+    token_counts: List[int],
+    azure_credential = None,
+    embedding_endpoint = None
+) -> None:
+    """Sets contentVector on each document, embedding them in batches.
+    Args:
+        documents (List[Document]): The chunks to embed.
+        token_counts (List[int]): Token count of each chunk, used for the batch token budget.
+    """
+    missing = apply_cached_embeddings(documents, embedding_endpoint)
+    for batch in batch_by_token_budget(token_counts, indices=missing):
+        embed_document_batch(documents, token_counts, batch, azure_credential=azure_credential,
+                             embedding_endpoint=embedding_endpoint)
+
+def embed_document_batch(
+    documents: List[Document],
+    token_counts: List[int],
+    batch: List[int],
+    azure_credential = None,
+    embedding_endpoint = None
+) -> None:
+    """Embeds documents[idx] for every idx in batch with one request, retrying on errors.
+    Args:
+        documents (List[Document]): The chunks to embed.
+        token_counts (List[int]): Token count of each chunk.
+        batch (List[int]): Indices of the chunks to embed, see batch_by_token_budget.
+    """
+    texts = [documents[idx].content for idx in batch]
+    num_tokens = sum(token_counts[idx] for idx in batch)
+    embeddings = None
+    for i in range(RETRY_COUNT):
+        try:
+            embeddings = get_embeddings(texts, azure_credential=azure_credential, embedding_model_endpoint=embedding_endpoint, num_tokens=num_tokens)
+            break
+        except Exception as e:
+            if not is_retryable_error(e):
+                raise
+            retry_after = get_retry_after(e)
+            if retry_after is not None:
+                get_embedding_rate_limiter().pause(retry_after)
+            if i + 1 < RETRY_COUNT:
+                delay = get_backoff_delay(i, retry_after)
+                print(f"Error getting embeddings for batch of {len(texts)} chunks with error={e}, retrying in {delay:.1f}s, current at {i + 1} retry, {RETRY_COUNT - (i + 1)} retries left")
+                time.sleep(delay)
+    if embeddings is None or len(embeddings) != len(texts):
+        raise Exception(f"Error getting embeddings for batch of {len(texts)} chunks starting with chunk={texts[0]}")
+
+    for idx, embedding in zip(batch, embeddings):
+        documents[idx].contentVector = embedding
+
+    cache = get_embedding_cache()
+    if cache is not None:
+        model_id = get_embedding_model_id(embedding_endpoint)
+        cache.put_many({cache.make_key(text, model_id): embedding for text, embedding in zip(texts, embeddings)})
 
 
 def chunk_content_helper(
@@ -708,7 +1898,8 @@ def chunk_content_helper(
     parser = parser_factory(file_format.split("_pdf")[0]) # to handle cracked pdf converted to html
     doc = parser.parse(content, file_name=file_name)
     # if the original doc after parsing is < num_tokens return as it is
-    doc_content_size = TOKEN_ESTIMATOR.estimate_tokens(doc.content)
+    doc_tokens = TOKEN_ESTIMATOR.encode(doc.content)
+    doc_content_size = len(doc_tokens)
     if doc_content_size < num_tokens:
         yield doc.content, doc_content_size, doc
     else:
@@ -721,20 +1912,19 @@ def chunk_content_helper(
                 chunk_doc = parser.parse(chunked_content, file_name=file_name)
                 chunk_doc.title = doc.title
                 yield chunk_doc.content, chunk_size, chunk_doc
+        elif file_format == "python":
+            splitter = PythonCodeTextSplitter.from_tiktoken_encoder(
+                chunk_size=num_tokens, chunk_overlap=token_overlap)
+            # the chunks are cut from doc.content, so their sizes come from the tokens of the whole document
+            for chunked_content, chunk_size in count_chunk_tokens(doc.content, doc_tokens, splitter.split_text(doc.content)):
+                yield chunked_content, chunk_size, doc
+        elif file_format == "html_pdf": # cracked pdf converted to html
+            splitter = PdfTextSplitter(separator=SENTENCE_ENDINGS + WORDS_BREAKS, chunk_size=num_tokens, chunk_overlap=token_overlap)
+            for chunked_content, chunk_size in splitter.split_text_with_sizes(doc.content):
+                yield chunked_content, chunk_size, doc
         else:
-            if file_format == "python":
-                splitter = PythonCodeTextSplitter.from_tiktoken_encoder(
-                    chunk_size=num_tokens, chunk_overlap=token_overlap)
-            else:
-                if file_format == "html_pdf": # cracked pdf converted to html
-                    splitter = PdfTextSplitter(separator=SENTENCE_ENDINGS + WORDS_BREAKS, chunk_size=num_tokens, chunk_overlap=token_overlap)
-                else:
-                    splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
-                            separators=SENTENCE_ENDINGS + WORDS_BREAKS,
-                            chunk_size=num_tokens, chunk_overlap=token_overlap)
-            chunked_content_list = splitter.split_text(doc.content)
-            for chunked_content in chunked_content_list:
-                chunk_size = TOKEN_ESTIMATOR.estimate_tokens(chunked_content)
+            # reuse the tokens of the whole document instead of re-encoding every piece
+            for chunked_content, chunk_size in split_by_token_offsets(doc.content, doc_tokens, num_tokens, token_overlap):
                 yield chunked_content, chunk_size, doc
 
 def chunk_content(
@@ -785,32 +1975,25 @@ def chunk_content(
             token_overlap=token_overlap
         )
         chunks = []
+        chunk_sizes = []
         skipped_chunks = 0
         for chunk, chunk_size, doc in chunked_context:
             if chunk_size >= min_chunk_size:
-                if add_embeddings:
-                    for i in range(RETRY_COUNT):
-                        try:
-                            doc.contentVector = get_embedding(chunk, azure_credential=azure_credential, embedding_model_endpoint=embedding_endpoint)
-                            break
-                        except Exception as e:
-                            print(f"Error getting embedding for chunk with error={e}, retrying, current at {i + 1} retry, {RETRY_COUNT - (i + 1)} retries left")
-                            time.sleep(30)
-                    if doc.contentVector is None:
-                        raise Exception(f"Error getting embedding for chunk={chunk}")
-                    
-
                 chunks.append(
                     Document(
                         content=chunk,
                         title=doc.title,
-                        url=url,
-                        contentVector=doc.contentVector
+                        url=url
                     )
                 )
+                chunk_sizes.append(chunk_size)
             else:
                 skipped_chunks += 1
 
+        if add_embeddings:
+            add_embeddings_to_documents(chunks, chunk_sizes, azure_credential=azure_credential,
+                                        embedding_endpoint=embedding_endpoint)
+
     except UnsupportedFormatError as e:
         if ignore_errors:
             return ChunkingResult(
@@ -827,6 +2010,7 @@ def chunk_content(
         chunks=chunks,
         total_files=1,
         skipped_chunks=skipped_chunks,
+        token_counts=chunk_sizes,
     )
 
 def chunk_file(
@@ -841,11 +2025,13 @@ def chunk_file(
     use_layout = False,
     add_embeddings=False,
     azure_credential = None,
-    embedding_endpoint = None
+    embedding_endpoint = None,
+    content: Optional[str] = None
 ) -> ChunkingResult:
     """Chunks the given file.
     Args:
         file_path (str): The file to chunk.
+        content (str): For pdf, docx and pptx files, text already extracted by AsyncDocumentAnalyzer.
     Returns:
         List[Document]: List of chunked documents.
     """
@@ -860,7 +2046,9 @@ def chunk_file(
             raise UnsupportedFormatError(f"{file_name} is not supported")
 
     cracked_pdf = False
-    if file_format in ["pdf", "docx", "pptx"]:
+    if file_format in FORM_RECOGNIZER_FORMATS and content is not None:
+        cracked_pdf = True
+    elif file_format in FORM_RECOGNIZER_FORMATS:
         if form_recognizer_client is None:
             raise UnsupportedFormatError("form_recognizer_client is required for pdf files")
         content = extract_pdf_content(file_path, form_recognizer_client, use_layout=use_layout)
@@ -906,7 +2094,8 @@ def process_file(
         use_layout = False,
         add_embeddings = False,
         azure_credential = None,
-        embedding_endpoint = None
+        embedding_endpoint = None,
+        content: Optional[str] = None
     ):
 
     if not form_recognizer_client:
@@ -932,9 +2121,11 @@ def process_file(
             use_layout=use_layout,
             add_embeddings=add_embeddings,
             azure_credential=azure_credential,
-            embedding_endpoint=embedding_endpoint
+            embedding_endpoint=embedding_endpoint,
+            content=content
         )
         for chunk_idx, chunk_doc in enumerate(result.chunks):
+            chunk_doc.id = get_chunk_id(rel_file_path, chunk_idx)
             chunk_doc.filepath = rel_file_path
             chunk_doc.metadata = json.dumps({"chunk_id": str(chunk_idx)})
     except Exception as e:
@@ -960,11 +2151,56 @@ def chunk_blob_container(
         njobs=4,
         add_embeddings = False,
         azure_credential = None,
-        embedding_endpoint = None
+        embedding_endpoint = None,
+        embedding_concurrency: int = EMBEDDING_CONCURRENCY,
+        manifest_path: Optional[str] = None,
+        form_recognizer_concurrency: int = FORM_RECOGNIZER_CONCURRENCY,
+        download_folder: Optional[str] = None,
+        pipelined: bool = False,
+        shard_index: int = 0,
+        num_shards: int = 1
 ):
-    with tempfile.TemporaryDirectory() as local_data_folder:
+    """
+    Downloads the blobs under blob_url and chunks them, see chunk_directory.
+    Args:
+        download_folder (str): Optional folder to keep the downloaded blobs in between runs. Only blobs that changed
+            since the previous run are downloaded again; by default everything goes to a temporary folder.
+        pipelined (bool): If true, each blob is chunked as soon as it is downloaded and deleted once chunked,
+            see iter_chunk_blob_container. Cannot be combined with manifest_path or download_folder.
+        shard_index (int), num_shards (int): Only download and chunk the blobs of this shard, see chunk_directory.
+    """
+    if pipelined:
+        if manifest_path or download_folder:
+            raise ValueError("pipelined cannot be combined with manifest_path or download_folder")
+        return merge_chunking_results(iter_chunk_blob_container(
+            blob_url,
+            credential,
+            ignore_errors=ignore_errors,
+            num_tokens=num_tokens,
+            min_chunk_size=min_chunk_size,
+            url_prefix=url_prefix,
+            token_overlap=token_overlap,
+            extensions_to_process=extensions_to_process,
+            form_recognizer_client=form_recognizer_client,
+            use_layout=use_layout,
+            njobs=njobs,
+            add_embeddings=add_embeddings,
+            azure_credential=azure_credential,
+            embedding_endpoint=embedding_endpoint,
+            embedding_concurrency=embedding_concurrency,
+            form_recognizer_concurrency=form_recognizer_concurrency,
+            shard_index=shard_index,
+            num_shards=num_shards
+        ))
+
+    with tempfile.TemporaryDirectory() if download_folder is None else contextlib.nullcontext(download_folder) as local_data_folder:
         print(f'Downloading {blob_url} to local folder')
-        downloadBlobUrlToLocalFolder(blob_url, local_data_folder, credential)
+        index_path = None
+        if download_folder is not None:
+            # kept outside the folder so that it is not chunked
+            index_path = os.path.abspath(download_folder).rstrip(os.sep) + ".blob_index.json"
+        downloadBlobUrlToLocalFolder(blob_url, local_data_folder, credential, index_path=index_path,
+                                     shard_index=shard_index, num_shards=num_shards)
         print(f'Downloaded.')
 
         result = chunk_directory(
@@ -980,12 +2216,601 @@ def chunk_blob_container(
             njobs=njobs,
             add_embeddings=add_embeddings,
             azure_credential=azure_credential,
-            embedding_endpoint=embedding_endpoint
+            embedding_endpoint=embedding_endpoint,
+            embedding_concurrency=embedding_concurrency,
+            manifest_path=manifest_path,
+            form_recognizer_concurrency=form_recognizer_concurrency
         )
 
     return result
 
 
+def iter_chunk_blob_container(
+        blob_url: str,
+        credential,
+        ignore_errors: bool = True,
+        num_tokens: int = 1024,
+        min_chunk_size: int = 10,
+        url_prefix = None,
+        token_overlap: int = 0,
+        extensions_to_process: List[str] = list(FILE_FORMAT_DICT.keys()),
+        form_recognizer_client = None,
+        use_layout = False,
+        njobs=4,
+        add_embeddings = False,
+        azure_credential = None,
+        embedding_endpoint = None,
+        embedding_concurrency: int = EMBEDDING_CONCURRENCY,
+        form_recognizer_concurrency: int = FORM_RECOGNIZER_CONCURRENCY,
+        max_local_files: int = BLOB_PIPELINE_MAX_LOCAL_FILES,
+        shard_index: int = 0,
+        num_shards: int = 1
+) -> Generator[ChunkingResult, None, None]:
+    """
+    Chunks the blobs under blob_url while they are being downloaded, yielding the chunks of each blob as soon as
+    it is done. Each blob is fed to the workers as soon as it lands and deleted once chunked, so that at most
+    max_local_files blobs are on disk at a time. Takes the same arguments as chunk_directory.
+
+    Returns:
+        Generator[ChunkingResult]: One result per downloaded blob.
+    """
+    with tempfile.TemporaryDirectory() as local_data_folder, \
+            BlobDownloadStream(blob_url, local_data_folder, credential, max_local_files=max_local_files,
+                               shard_index=shard_index, num_shards=num_shards) as blobs:
+        print(f'Chunking {blob_url} while downloading, with up to {max_local_files} blobs on disk')
+        start_time = time.time()
+        num_files = 0
+        num_chunks = 0
+        try:
+            for file_path, result in iter_chunk_files(
+                    blobs, local_data_folder,
+                    ignore_errors=ignore_errors,
+                    num_tokens=num_tokens,
+                    min_chunk_size=min_chunk_size,
+                    url_prefix=url_prefix,
+                    token_overlap=token_overlap,
+                    extensions_to_process=extensions_to_process,
+                    form_recognizer_client=form_recognizer_client,
+                    use_layout=use_layout,
+                    njobs=njobs,
+                    add_embeddings=add_embeddings,
+                    azure_credential=azure_credential,
+                    embedding_endpoint=embedding_endpoint,
+                    embedding_concurrency=embedding_concurrency,
+                    form_recognizer_concurrency=form_recognizer_concurrency):
+                blobs.release(file_path)
+                num_files += 1
+                num_chunks += len(result.chunks)
+                yield result
+        finally:
+            elapsed = time.time() - start_time
+            if elapsed > 0:
+                print(f"Processing: {num_files} files, {num_chunks} chunks in {elapsed:.1f}s "
+                      f"({num_files / elapsed:.2f} files/s, {num_chunks / elapsed:.2f} chunks/s)")
+
+
+def process_files(process_file_partial: Callable, file_paths: List[str]) -> List[Tuple[Optional[ChunkingResult], bool]]:
+    """Runs process_file_partial on several small files in a single call to a worker process."""
+    return [process_file_partial(file_path) for file_path in file_paths]
+
+
+def _report_worker_pid(worker_pids):
+    """ProcessPoolExecutor initializer telling _WorkerPool the pid of each worker as it starts."""
+    worker_pids.put(os.getpid())
+
+
+class _WorkerPool:
+    """Runs files on a ProcessPoolExecutor no more than one per worker at a time, so that a timeout only
+    counts the time spent on the file and not in the executor's queue.
+
+    A ProcessPoolExecutor cannot replace a single worker, so when one hangs or dies the whole pool is replaced
+    and the other files in flight fail with BrokenProcessPool. Those are retried alone on the new pool, so that
+    a file is only given up on if it crashes a worker by itself."""
+
+    def __init__(self, executor_factory: Callable[..., ProcessPoolExecutor], num_workers: int):
+        self.executor_factory = executor_factory
+        self.executor = self._new_executor()
+        self.num_workers = num_workers
+        self.generation = 0
+        self.num_recycles = 0
+        self._workers = asyncio.Semaphore(num_workers)
+        self._isolation = asyncio.Lock()
+
+    async def run(self, fn: Callable, *args, timeout: Optional[float] = None):
+        async with self._workers:
+            try:
+                return await self._run(fn, *args, timeout=timeout)
+            except BrokenProcessPool:
+                pass
+        # retried with every worker to itself
+        async with self._isolation:
+            for _ in range(self.num_workers):
+                await self._workers.acquire()
+            try:
+                return await self._run(fn, *args, timeout=timeout)
+            finally:
+                for _ in range(self.num_workers):
+                    self._workers.release()
+
+    async def _run(self, fn: Callable, *args, timeout: Optional[float] = None):
+        generation = self.generation
+        try:
+            return await asyncio.wait_for(
+                asyncio.get_running_loop().run_in_executor(self.executor, fn, *args), timeout or None)
+        except asyncio.TimeoutError:
+            self.recycle(generation)
+            raise FileTimeoutError(f"Timed out after {timeout}s") from None
+        except BrokenProcessPool:
+            self.recycle(generation)
+            raise
+
+    def recycle(self, generation: int):
+        if generation != self.generation:
+            # already replaced since the call started
+            return
+        self._kill_workers()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.executor = self._new_executor()
+        self.generation += 1
+        self.num_recycles += 1
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        self._worker_pids = multiprocessing.SimpleQueue()
+        return self.executor_factory(initializer=_report_worker_pid, initargs=(self._worker_pids,))
+
+    def _kill_workers(self):
+        # ProcessPoolExecutor has no public way to stop its workers, so they are killed by the pids they reported
+        while not self._worker_pids.empty():
+            with contextlib.suppress(OSError):
+                os.kill(self._worker_pids.get(), getattr(signal, "SIGKILL", signal.SIGTERM))
+
+    def shutdown(self, kill: bool = False):
+        """Waits for the files in flight, or with kill=True stops the workers right away."""
+        if kill:
+            self._kill_workers()
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+async def chunk_and_embed_files(
+        executor_factory: Callable[..., ProcessPoolExecutor],
+        num_workers: int,
+        process_file_partial: Callable,
+        files_to_process: Iterable[str],
+        ignore_errors: bool = True,
+        add_embeddings: bool = True,
+        embedding_concurrency: int = EMBEDDING_CONCURRENCY,
+        azure_credential = None,
+        embedding_endpoint = None,
+        max_pending_files: int = 16,
+        document_analyzer: Optional[AsyncDocumentAnalyzer] = None,
+        file_timeout: Optional[float] = FILE_TIMEOUT
+) -> AsyncGenerator[Tuple[str, Optional[ChunkingResult], bool], None]:
+    """
+    Two-stage pipeline: the executor's processes parse and chunk files (CPU-bound) while up to
+    embedding_concurrency embedding requests (network-bound) run on the chunks of files that are done.
+    With a document_analyzer, the files it handles are first analysed here, many at once, and the
+    workers chunk the extracted text.
+    Files are handed to the workers in the order given, small files SMALL_FILE_BATCH_SIZE at a time when
+    files_to_process is a list. A file that takes a worker longer than file_timeout seconds, or crashes it,
+    is quarantined: it counts as a file with errors, and the workers are replaced.
+    Args:
+        executor_factory (Callable): Creates the pool running process_file_partial, again whenever a worker is stuck.
+                            Called with the initializer and initargs keyword arguments of ProcessPoolExecutor.
+        num_workers (int): The number of worker processes of the pool.
+        process_file_partial (Callable): process_file with everything but file_path bound and add_embeddings=False.
+        files_to_process (Iterable[str]): The files to chunk. Other iterables than lists may block
+                            until the next file is available, e.g. while it is downloaded.
+        add_embeddings (bool): If false, files are only chunked.
+        embedding_concurrency (int): The maximum number of embedding requests in flight.
+        max_pending_files (int): The maximum number of files being analysed, chunked or embedded, or waiting to be consumed.
+        document_analyzer (AsyncDocumentAnalyzer): Optional analyzer, already entered, for pdf, docx and pptx files.
+        file_timeout (float): Seconds a worker may spend on a file, None or 0 for no limit.
+    Returns:
+        AsyncGenerator[Tuple[str, ChunkingResult, bool]]: (file path, result, is_error) for each
+            file, as soon as it is done.
+    """
+    loop = asyncio.get_running_loop()
+    file_paths = []
+    results = {}
+    pending_batches = {}
+    embedding_errors = {}
+    window = asyncio.Semaphore(max_pending_files)
+    batch_queue = asyncio.Queue(maxsize=2 * embedding_concurrency)
+    done_queue = asyncio.Queue()
+    all_submitted = object()
+    worker_pool = _WorkerPool(executor_factory, num_workers)
+
+    def file_done(file_idx):
+        result, is_error = results.pop(file_idx)
+        pending_batches.pop(file_idx, None)
+        # a file whose embeddings failed counts as a file with errors, as in chunk_content
+        if file_idx in embedding_errors:
+            error = embedding_errors.pop(file_idx)
+            if not ignore_errors:
+                done_queue.put_nowait(error)
+                return
+            result, is_error = ChunkingResult(chunks=[], total_files=1, num_files_with_errors=1), False
+        done_queue.put_nowait((file_paths[file_idx], result, is_error))
+
+    async def analyze_file_at(file_idx):
+        try:
+            return await document_analyzer.analyze(file_paths[file_idx]), False
+        except Exception as e:
+            if not ignore_errors:
+                raise
+            print(f"File ({file_paths[file_idx]}) failed with ", e)
+            return None, True
+
+    def quarantine(file_idx, error):
+        print(f"File ({file_paths[file_idx]}) quarantined: ", error)
+        if not ignore_errors:
+            raise error
+        results[file_idx] = (ChunkingResult(chunks=[], total_files=1, num_files_with_errors=1,
+                                            quarantined_files=[file_paths[file_idx]]), False)
+
+    async def chunk_file_at(file_idx):
+        content = None
+        if document_analyzer is not None and document_analyzer.handles(file_paths[file_idx]):
+            content, is_error = await analyze_file_at(file_idx)
+            if is_error:
+                results[file_idx] = (None, True)
+                return
+        try:
+            results[file_idx] = await worker_pool.run(
+                partial(process_file_partial, content=content), file_paths[file_idx], timeout=file_timeout)
+        except (FileTimeoutError, BrokenProcessPool) as e:
+            quarantine(file_idx, e)
+
+    async def chunk_small_files_at(file_idxs):
+        try:
+            batch_results = await worker_pool.run(
+                partial(process_files, process_file_partial), [file_paths[file_idx] for file_idx in file_idxs],
+                timeout=file_timeout * len(file_idxs) if file_timeout else None)
+        except (FileTimeoutError, BrokenProcessPool):
+            # retry the files one at a time, so that only the culprit is quarantined
+            await asyncio.gather(*[chunk_file_at(file_idx) for file_idx in file_idxs])
+            return
+        for file_idx, result in zip(file_idxs, batch_results):
+            results[file_idx] = result
+
+    async def embed_file_at(file_idx, thread_pool):
+        result, is_error = results[file_idx]
+        batches = []
+        if add_embeddings and not is_error:
+            missing = await loop.run_in_executor(thread_pool, apply_cached_embeddings, result.chunks, embedding_endpoint)
+            batches = list(batch_by_token_budget(result.token_counts, indices=missing))
+        if not batches:
+            file_done(file_idx)
+            return
+        pending_batches[file_idx] = len(batches)
+        for batch in batches:
+            await batch_queue.put((file_idx, batch))
+
+    async def process_files_at(file_idxs, thread_pool):
+        try:
+            if len(file_idxs) == 1:
+                await chunk_file_at(file_idxs[0])
+            else:
+                await chunk_small_files_at(file_idxs)
+            for file_idx in file_idxs:
+                await embed_file_at(file_idx, thread_pool)
+        except Exception as e:
+            done_queue.put_nowait(e)
+
+    async def embed_worker(thread_pool):
+        while True:
+            file_idx, batch = await batch_queue.get()
+            if file_idx not in embedding_errors:
+                result, _ = results[file_idx]
+                try:
+                    await loop.run_in_executor(thread_pool, partial(
+                        embed_document_batch, result.chunks, result.token_counts, batch,
+                        azure_credential=azure_credential, embedding_endpoint=embedding_endpoint))
+                except Exception as e:
+                    print(f"File ({file_paths[file_idx]}) failed with ", e)
+                    embedding_errors[file_idx] = e
+            pending_batches[file_idx] -= 1
+            if pending_batches[file_idx] == 0:
+                file_done(file_idx)
+
+    async def next_file_path(file_iterator):
+        if isinstance(files_to_process, list):
+            return next(file_iterator, None)
+        # the iterator may block, e.g. on a download, so it is advanced off the event loop
+        return await loop.run_in_executor(None, next, file_iterator, None)
+
+    def is_small_file(file_path):
+        if not isinstance(files_to_process, list) or SMALL_FILE_BATCH_SIZE <= 1:
+            return False
+        if document_analyzer is not None and document_analyzer.handles(file_path):
+            return False
+        try:
+            return os.path.getsize(file_path) < SMALL_FILE_SIZE
+        except OSError:
+            return False
+
+    async def submit_files(thread_pool):
+        small_file_idxs = []
+
+        def submit(file_idxs):
+            chunk_tasks.add(asyncio.create_task(process_files_at(file_idxs, thread_pool)))
+
+        try:
+            file_iterator = iter(files_to_process)
+            while True:
+                # a partial batch is sent rather than waiting for room for more files
+                if window.locked() and small_file_idxs:
+                    submit(small_file_idxs)
+                    small_file_idxs = []
+                await window.acquire()
+                file_path = await next_file_path(file_iterator)
+                if file_path is None:
+                    break
+                file_paths.append(file_path)
+                if not is_small_file(file_path):
+                    submit([len(file_paths) - 1])
+                    continue
+                small_file_idxs.append(len(file_paths) - 1)
+                if len(small_file_idxs) == SMALL_FILE_BATCH_SIZE:
+                    submit(small_file_idxs)
+                    small_file_idxs = []
+            if small_file_idxs:
+                submit(small_file_idxs)
+            done_queue.put_nowait(all_submitted)
+        except Exception as e:
+            done_queue.put_nowait(e)
+
+    chunk_tasks = set()
+    with ThreadPoolExecutor(max_workers=embedding_concurrency) as thread_pool:
+        tasks = [asyncio.create_task(embed_worker(thread_pool)) for _ in range(embedding_concurrency)]
+        tasks.append(asyncio.create_task(submit_files(thread_pool)))
+        progress = tqdm(total=len(files_to_process) if isinstance(files_to_process, list) else None)
+        finished = False
+        try:
+            num_done = 0
+            submitted = False
+            while not submitted or num_done < len(file_paths):
+                item = await done_queue.get()
+                if item is all_submitted:
+                    submitted = True
+                    continue
+                if isinstance(item, Exception):
+                    raise item
+                num_done += 1
+                progress.update(1)
+                window.release()
+                yield item
+            finished = True
+        finally:
+            progress.close()
+            for task in tasks + list(chunk_tasks):
+                task.cancel()
+            await asyncio.gather(*tasks, *chunk_tasks, return_exceptions=True)
+            # workers still busy after an error or an early close may be stuck on a file
+            worker_pool.shutdown(kill=not finished)
+            if worker_pool.num_recycles:
+                print(f"Replaced the worker processes {worker_pool.num_recycles} times after timeouts or crashes")
+
+
+def _file_chunking_result(result: Optional[ChunkingResult], is_error: bool) -> ChunkingResult:
+    if is_error:
+        return ChunkingResult(chunks=[], total_files=1, num_files_with_errors=1)
+    result.total_files = 1
+    return result
+
+def _file_status(result: ChunkingResult) -> str:
+    """The status of the single file a result of iter_chunk_files is for, see ChunkingResult.file_statuses."""
+    if result.quarantined_files:
+        return "quarantined"
+    if result.num_files_with_errors:
+        return "error"
+    if result.num_unsupported_format_files:
+        return "unsupported"
+    return "chunked" if result.chunks else "empty"
+
+
+def iter_chunk_files(
+        files_to_process: Iterable[str],
+        directory_path: str,
+        ignore_errors: bool = True,
+        num_tokens: int = 1024,
+        min_chunk_size: int = 10,
+        url_prefix = None,
+        token_overlap: int = 0,
+        extensions_to_process: List[str] = list(FILE_FORMAT_DICT.keys()),
+        form_recognizer_client = None,
+        use_layout = False,
+        njobs=4,
+        add_embeddings = False,
+        azure_credential = None,
+        embedding_endpoint = None,
+        embedding_concurrency: int = EMBEDDING_CONCURRENCY,
+        form_recognizer_concurrency: int = FORM_RECOGNIZER_CONCURRENCY
+) -> Generator[Tuple[str, ChunkingResult], None, None]:
+    """
+    Chunks the given files under directory_path, yielding each one as soon as it is done.
+    Takes the same arguments as chunk_directory.
+
+    Returns:
+        Generator[Tuple[str, ChunkingResult]]: (file path, result) for each file.
+    """
+    # Fetch the embedding token up front so that a credential problem shows before any file is chunked
+    azure_credential = as_cached_credential(azure_credential)
+    if add_embeddings and azure_credential is not None:
+        azure_credential.get_token(COGNITIVE_SERVICES_SCOPE)
+
+    try:
+        if njobs==1:
+            print("Single process to chunk and parse the files. --njobs > 1 can help performance.")
+            for file_path in tqdm(files_to_process):
+                result, is_error = process_file(file_path=file_path,directory_path=directory_path, ignore_errors=ignore_errors,
+                                           num_tokens=num_tokens,
+                                           min_chunk_size=min_chunk_size, url_prefix=url_prefix,
+                                           token_overlap=token_overlap,
+                                           extensions_to_process=extensions_to_process,
+                                           form_recognizer_client=form_recognizer_client, use_layout=use_layout, add_embeddings=add_embeddings,
+                                           azure_credential=azure_credential, embedding_endpoint=embedding_endpoint)
+                yield file_path, _file_chunking_result(result, is_error)
+        elif njobs > 1:
+            print(f"Multiprocessing with njobs={njobs}")
+            if add_embeddings:
+                print(f"Embedding with up to {embedding_concurrency} requests in flight")
+            # workers only parse and chunk; embeddings are added by the pipeline in this process
+            process_file_partial = partial(process_file, directory_path=directory_path, ignore_errors=ignore_errors,
+                                           num_tokens=num_tokens,
+                                           min_chunk_size=min_chunk_size, url_prefix=url_prefix,
+                                           token_overlap=token_overlap,
+                                           extensions_to_process=extensions_to_process,
+                                           form_recognizer_client=None, use_layout=use_layout, add_embeddings=False)
+            # documents are analysed asynchronously here, the workers only chunk the extracted text;
+            # with the caller's client if there is one, otherwise with one for the FORM_RECOGNIZER_* settings
+            analyzer_args = dict(use_layout=use_layout, extensions_to_process=extensions_to_process,
+                                 concurrency=form_recognizer_concurrency)
+            if form_recognizer_client is not None:
+                document_analyzer = AsyncDocumentAnalyzer(client=form_recognizer_client, **analyzer_args)
+            else:
+                document_analyzer = AsyncDocumentAnalyzer.from_env(**analyzer_args)
+            if document_analyzer is not None:
+                print(f"Analysing documents with up to {form_recognizer_concurrency} requests in flight")
+            executor_factory = partial(ProcessPoolExecutor, max_workers=njobs)
+            # drive the async pipeline one file at a time so that results can be yielded from here
+            loop = asyncio.new_event_loop()
+            if document_analyzer is not None:
+                loop.run_until_complete(document_analyzer.__aenter__())
+            files = chunk_and_embed_files(
+                executor_factory, njobs, process_file_partial, files_to_process,
+                ignore_errors=ignore_errors, add_embeddings=add_embeddings,
+                embedding_concurrency=embedding_concurrency,
+                azure_credential=azure_credential, embedding_endpoint=embedding_endpoint,
+                max_pending_files=2 * njobs + embedding_concurrency + SMALL_FILE_BATCH_SIZE
+                                  + (form_recognizer_concurrency if document_analyzer is not None else 0),
+                document_analyzer=document_analyzer)
+            try:
+                while True:
+                    try:
+                        file_path, result, is_error = loop.run_until_complete(files.__anext__())
+                    except StopAsyncIteration:
+                        break
+                    yield file_path, _file_chunking_result(result, is_error)
+            finally:
+                loop.run_until_complete(files.aclose())
+                if document_analyzer is not None:
+                    loop.run_until_complete(document_analyzer.__aexit__(None, None, None))
+                loop.close()
+    finally:
+        if azure_credential is not None:
+            print(f"Token cache stats: {azure_credential.stats}")
+        if add_embeddings and get_embedding_cache() is not None:
+            print(f"Embedding cache stats: {get_embedding_cache().stats}")
+        # documents analysed in worker processes are not counted here
+        if get_analysis_cache() is not None and get_analysis_cache().hits + get_analysis_cache().misses > 0:
+            print(f"Form Recognizer cache stats: {get_analysis_cache().stats}")
+
+
+def iter_chunk_directory(
+        directory_path: str,
+        ignore_errors: bool = True,
+        num_tokens: int = 1024,
+        min_chunk_size: int = 10,
+        url_prefix = None,
+        token_overlap: int = 0,
+        extensions_to_process: List[str] = list(FILE_FORMAT_DICT.keys()),
+        form_recognizer_client = None,
+        use_layout = False,
+        njobs=4,
+        add_embeddings = False,
+        azure_credential = None,
+        embedding_endpoint = None,
+        embedding_concurrency: int = EMBEDDING_CONCURRENCY,
+        manifest_path: Optional[str] = None,
+        form_recognizer_concurrency: int = FORM_RECOGNIZER_CONCURRENCY,
+        shard_index: int = 0,
+        num_shards: int = 1
+) -> Generator[ChunkingResult, None, None]:
+    """
+    Chunks the given directory recursively, yielding the chunks of each file as soon as the file is done.
+    Takes the same arguments as chunk_directory. At most a few files per job are held in memory at a time,
+    so the consumer should write each result out (see write_chunks_to_jsonl) rather than keep it.
+
+    Returns:
+        Generator[ChunkingResult]: One result per processed file. With a manifest, the first result carries
+            num_unchanged_files and the ids of the chunks of removed files.
+    """
+    _check_shard(shard_index, num_shards)
+    all_files_directory = get_files_recursively(directory_path)
+    files_to_process = [file_path for file_path in all_files_directory if os.path.isfile(file_path)]
+    if num_shards > 1:
+        files_to_process = [file_path for file_path in files_to_process
+                            if in_shard(os.path.relpath(file_path, directory_path), shard_index, num_shards)]
+        print(f"Shard {shard_index} of {num_shards}: {len(files_to_process)} files")
+
+    manifest = None
+    if manifest_path:
+        manifest = FileManifest(manifest_path, {
+            "num_tokens": num_tokens,
+            "min_chunk_size": min_chunk_size,
+            "token_overlap": token_overlap,
+            "use_layout": use_layout,
+            "url_prefix": url_prefix,
+            "add_embeddings": add_embeddings,
+        })
+        all_files = files_to_process
+        rel_paths = [os.path.relpath(file_path, directory_path) for file_path in files_to_process]
+        removed_files = manifest.removed_files(rel_paths)
+        changed_files = [file_path for file_path, rel_path in zip(files_to_process, rel_paths)
+                         if not manifest.is_unchanged(rel_path, file_path)]
+        num_unchanged_files = len(files_to_process) - len(changed_files)
+        deleted_chunk_ids = [chunk_id for rel_path in removed_files for chunk_id in manifest.files[rel_path].chunk_ids]
+        print(f"Incremental ingestion: {num_unchanged_files} unchanged files, {len(deleted_chunk_ids)} chunks of removed files to delete")
+        files_to_process = changed_files
+
+    print(f"Total files to process={len(files_to_process)} out of total directory size={len(all_files_directory)}")
+    if njobs > 1:
+        # largest files first, so that the last ones to finish are small and no worker is left idle
+        files_to_process.sort(key=os.path.getsize, reverse=True)
+
+    try:
+        if manifest is not None:
+            changed_paths = set(changed_files)
+            yield ChunkingResult(chunks=[], total_files=0, num_unchanged_files=num_unchanged_files,
+                                 deleted_chunk_ids=deleted_chunk_ids,
+                                 file_statuses={rel_path: "unchanged" for file_path, rel_path in zip(all_files, rel_paths)
+                                                if file_path not in changed_paths})
+            for rel_path in removed_files:
+                manifest.remove(rel_path)
+
+        for file_path, result in iter_chunk_files(
+                files_to_process, directory_path,
+                ignore_errors=ignore_errors,
+                num_tokens=num_tokens,
+                min_chunk_size=min_chunk_size,
+                url_prefix=url_prefix,
+                token_overlap=token_overlap,
+                extensions_to_process=extensions_to_process,
+                form_recognizer_client=form_recognizer_client,
+                use_layout=use_layout,
+                njobs=njobs,
+                add_embeddings=add_embeddings,
+                azure_credential=azure_credential,
+                embedding_endpoint=embedding_endpoint,
+                embedding_concurrency=embedding_concurrency,
+                form_recognizer_concurrency=form_recognizer_concurrency):
+            rel_path = os.path.relpath(file_path, directory_path)
+            result.file_statuses = {rel_path: _file_status(result)}
+            # a failed file stays as it was in the manifest, so it is retried on the next run
+            if manifest is None or result.num_files_with_errors > 0:
+                yield result
+                continue
+            chunk_ids = [chunk.id for chunk in result.chunks]
+            result.deleted_chunk_ids = manifest.stale_chunk_ids(rel_path, chunk_ids)
+            yield result
+            # the consumer asked for the next result, i.e. is done with this one
+            manifest.update(rel_path, file_path, chunk_ids)
+    finally:
+        if manifest is not None:
+            manifest.save()
+
+
 def chunk_directory(
         directory_path: str,
         ignore_errors: bool = True,
@@ -999,7 +2824,12 @@ def chunk_directory(
         njobs=4,
         add_embeddings = False,
         azure_credential = None,
-        embedding_endpoint = None
+        embedding_endpoint = None,
+        embedding_concurrency: int = EMBEDDING_CONCURRENCY,
+        manifest_path: Optional[str] = None,
+        form_recognizer_concurrency: int = FORM_RECOGNIZER_CONCURRENCY,
+        shard_index: int = 0,
+        num_shards: int = 1
 ):
     """
     Chunks the given directory recursively
@@ -1013,70 +2843,201 @@ def chunk_directory(
                             then the url for the file /home/user/data/file1.txt will be https://example.com/data/file1.txt
         token_overlap (int): The number of tokens to overlap between chunks.
         extensions_to_process (List[str]): The list of extensions to process. 
-        form_recognizer_client: Optional form recognizer client to use for pdf files.
+        form_recognizer_client: Optional form recognizer client to use for pdf files. With njobs > 1 it is called from
+                            threads of this process, see form_recognizer_concurrency.
         use_layout (bool): If true, uses Layout model for pdf files. Otherwise, uses Read.
         add_embeddings (bool): If true, adds a vector embedding to each chunk using the embedding model endpoint and key.
+        azure_credential: Optional credential for the embedding endpoint. Tokens are cached across chunks.
+        embedding_concurrency (int): With njobs > 1, the maximum number of embedding requests in flight.
+                            Embedding then runs in this process, overlapped with chunking in the worker processes.
+        manifest_path (str): Optional manifest file for incremental ingestion. Only files added or changed since the
+                            manifest was saved are processed, and the chunks to delete from the index are returned in
+                            deleted_chunk_ids. The manifest is updated when chunking completes.
+        form_recognizer_concurrency (int): With njobs > 1, the maximum number of pdf, docx and pptx files analysed at
+                            once by Form Recognizer. Analysis then runs asynchronously in this process.
+        shard_index (int), num_shards (int): Only chunk the files of shard shard_index out of num_shards, chosen by a hash
+                            of their path, so that several machines can each chunk a part of the directory. Use one
+                            manifest per shard, and see write_shard and merge_shards to combine the outputs.
 
     Returns:
         List[Document]: List of chunked documents.
     """
-    chunks = []
-    total_files = 0
-    num_unsupported_format_files = 0
-    num_files_with_errors = 0
-    skipped_chunks = 0
+    return merge_chunking_results(iter_chunk_directory(
+        directory_path,
+        ignore_errors=ignore_errors,
+        num_tokens=num_tokens,
+        min_chunk_size=min_chunk_size,
+        url_prefix=url_prefix,
+        token_overlap=token_overlap,
+        extensions_to_process=extensions_to_process,
+        form_recognizer_client=form_recognizer_client,
+        use_layout=use_layout,
+        njobs=njobs,
+        add_embeddings=add_embeddings,
+        azure_credential=azure_credential,
+        embedding_endpoint=embedding_endpoint,
+        embedding_concurrency=embedding_concurrency,
+        manifest_path=manifest_path,
+        form_recognizer_concurrency=form_recognizer_concurrency,
+        shard_index=shard_index,
+        num_shards=num_shards
+    ))
+
+
+def merge_chunking_results(results: Iterable[ChunkingResult], keep_chunks: bool = True) -> ChunkingResult:
+    """Sums up the results of iter_chunk_directory. With keep_chunks=False only the counts are kept."""
+    merged = ChunkingResult(chunks=[], total_files=0)
+    for result in results:
+        if keep_chunks:
+            merged.chunks.extend(result.chunks)
+            merged.token_counts.extend(result.token_counts)
+        merged.total_files += result.total_files
+        merged.num_unsupported_format_files += result.num_unsupported_format_files
+        merged.num_files_with_errors += result.num_files_with_errors
+        merged.skipped_chunks += result.skipped_chunks
+        merged.num_unchanged_files += result.num_unchanged_files
+        merged.deleted_chunk_ids.extend(result.deleted_chunk_ids)
+        merged.quarantined_files.extend(result.quarantined_files)
+        merged.file_statuses.update(result.file_statuses)
+    return merged
+
+
+def write_chunks_to_jsonl(results: Iterable[ChunkingResult], output_path: str, vector_encoding: str = "base64") -> ChunkingResult:
+    """
+    Writes the chunks of each result to a JSON lines file as they come, one document per line.
+    Args:
+        results (Iterable[ChunkingResult]): Typically iter_chunk_directory(...).
+        output_path (str): The file to write.
+        vector_encoding (str): How to write contentVector, see Document.to_dict. Read base64 back with decode_vector.
+    Returns:
+        ChunkingResult: The merged counts, without the chunks.
+    """
+    def written(results):
+        with open(output_path, "w", encoding="utf-8") as f:
+            for result in results:
+                for chunk in result.chunks:
+                    f.write(json.dumps(chunk.to_dict(vector_encoding)) + "\n")
+                yield result
 
-    all_files_directory = get_files_recursively(directory_path)
-    files_to_process = [file_path for file_path in all_files_directory if os.path.isfile(file_path)]
-    print(f"Total files to process={len(files_to_process)} out of total directory size={len(all_files_directory)}")
+    return merge_chunking_results(written(results), keep_chunks=False)
 
 
-    if njobs==1:
-        print("Single process to chunk and parse the files. --njobs > 1 can help performance.")
-        for file_path in tqdm(files_to_process):
-            total_files += 1
-            result, is_error = process_file(file_path=file_path,directory_path=directory_path, ignore_errors=ignore_errors,
-                                       num_tokens=num_tokens,
-                                       min_chunk_size=min_chunk_size, url_prefix=url_prefix,
-                                       token_overlap=token_overlap,
-                                       extensions_to_process=extensions_to_process,
-                                       form_recognizer_client=form_recognizer_client, use_layout=use_layout, add_embeddings=add_embeddings,
-                                       azure_credential=azure_credential, embedding_endpoint=embedding_endpoint)
-            if is_error:
-                num_files_with_errors += 1
-                continue
-            chunks.extend(result.chunks)
-            num_unsupported_format_files += result.num_unsupported_format_files
-            num_files_with_errors += result.num_files_with_errors
-            skipped_chunks += result.skipped_chunks
-    elif njobs > 1:
-        print(f"Multiprocessing with njobs={njobs}")
-        process_file_partial = partial(process_file, directory_path=directory_path, ignore_errors=ignore_errors,
-                                       num_tokens=num_tokens,
-                                       min_chunk_size=min_chunk_size, url_prefix=url_prefix,
-                                       token_overlap=token_overlap,
-                                       extensions_to_process=extensions_to_process,
-                                       form_recognizer_client=None, use_layout=use_layout, add_embeddings=add_embeddings,
-                                       azure_credential=azure_credential, embedding_endpoint=embedding_endpoint)
-        with ProcessPoolExecutor(max_workers=njobs) as executor:
-            futures = list(tqdm(executor.map(process_file_partial, files_to_process), total=len(files_to_process)))
-            for result, is_error in futures:
-                total_files += 1
-                if is_error:
-                    num_files_with_errors += 1
-                    continue
-                chunks.extend(result.chunks)
-                num_unsupported_format_files += result.num_unsupported_format_files
-                num_files_with_errors += result.num_files_with_errors
-                skipped_chunks += result.skipped_chunks
+def _shard_name(shard_index: int, num_shards: int) -> str:
+    return f"shard-{shard_index:05d}-of-{num_shards:05d}"
 
-    return ChunkingResult(
-            chunks=chunks,
-            total_files=total_files,
-            num_unsupported_format_files=num_unsupported_format_files,
-            num_files_with_errors=num_files_with_errors,
-            skipped_chunks=skipped_chunks,
-        )
+def _chunking_result_counts(result: ChunkingResult) -> dict:
+    return {f.name: getattr(result, f.name) for f in fields(ChunkingResult)
+            if f.name not in ("chunks", "token_counts", "file_statuses")}
+
+def _count_lines(path: str) -> int:
+    count = 0
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            count += block.count(b"\n")
+    return count
+
+def write_shard(results: Iterable[ChunkingResult], output_dir: str, shard_index: int, num_shards: int,
+                vector_encoding: str = "base64") -> ChunkingResult:
+    """
+    Writes the output of one shard of a sharded run to output_dir: the chunks to shard-<i>-of-<n>.jsonl as
+    write_chunks_to_jsonl does, then the counts, the status of every file and the chunk ids to
+    shard-<i>-of-<n>.stats.json for merge_shards.
+    Args:
+        results (Iterable[ChunkingResult]): Typically iter_chunk_directory(..., shard_index=shard_index, num_shards=num_shards).
+    Returns:
+        ChunkingResult: The merged counts of the shard, without the chunks.
+    """
+    _check_shard(shard_index, num_shards)
+    os.makedirs(output_dir, exist_ok=True)
+    name = _shard_name(shard_index, num_shards)
+    chunk_ids = []
+
+    def recorded(results):
+        for result in results:
+            chunk_ids.extend(chunk.id for chunk in result.chunks)
+            yield result
+
+    merged = write_chunks_to_jsonl(recorded(results), os.path.join(output_dir, name + ".jsonl"), vector_encoding)
+    # written last, so that a shard without stats is known to be incomplete
+    stats_path = os.path.join(output_dir, name + ".stats.json")
+    with open(stats_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({
+            "shard_index": shard_index,
+            "num_shards": num_shards,
+            "result": _chunking_result_counts(merged),
+            "files": dict(sorted(merged.file_statuses.items())),
+            "chunk_ids": chunk_ids,
+        }, f)
+    os.replace(stats_path + ".tmp", stats_path)
+    return merged
+
+def merge_shards(output_dir: str, output_path: Optional[str] = None, directory_path: Optional[str] = None) -> ChunkingResult:
+    """
+    Checks and combines the shards written by write_shard to output_dir. Raises ValueError if a shard is missing
+    or incomplete, if a file or chunk shows up in more than one shard or in the wrong one, or if a file of
+    directory_path was not processed by its shard.
+    Args:
+        output_dir (str): The folder the shards were written to.
+        output_path (str): Optional JSON lines file to concatenate the chunks of all shards to.
+        directory_path (str): Optional data directory the shards were chunked from, to check that every file in it
+            is recorded, whatever became of it (see ChunkingResult.file_statuses).
+    Returns:
+        ChunkingResult: The merged counts of all shards, without the chunks.
+    """
+    shards = []
+    for file_name in sorted(os.listdir(output_dir)):
+        if re.fullmatch(r"shard-\d+-of-\d+\.stats\.json", file_name):
+            with open(os.path.join(output_dir, file_name), "r", encoding="utf-8") as f:
+                shards.append(json.load(f))
+    if not shards:
+        raise ValueError(f"No shards found in {output_dir}")
+    num_shards_found = {shard["num_shards"] for shard in shards}
+    if len(num_shards_found) > 1:
+        raise ValueError(f"Shards of runs with different numbers of shards in {output_dir}: {sorted(num_shards_found)}")
+    num_shards = num_shards_found.pop()
+
+    problems = []
+    missing = sorted(set(range(num_shards)) - {shard["shard_index"] for shard in shards})
+    if missing:
+        problems.append(f"missing shards {missing}")
+    shard_of_file = {}
+    shard_of_chunk = {}
+    for shard in shards:
+        shard_index = shard["shard_index"]
+        chunks_path = os.path.join(output_dir, _shard_name(shard_index, num_shards) + ".jsonl")
+        if not os.path.isfile(chunks_path) or _count_lines(chunks_path) != len(shard["chunk_ids"]):
+            problems.append(f"shard {shard_index} does not have the {len(shard['chunk_ids'])} chunks it recorded")
+        num_files = shard["result"]["total_files"] + shard["result"]["num_unchanged_files"]
+        if len(shard["files"]) != num_files:
+            problems.append(f"shard {shard_index} recorded {len(shard['files'])} of its {num_files} files")
+        for file_path in shard["files"]:
+            if get_shard_index(file_path, num_shards) != shard_index:
+                problems.append(f"file {file_path} of shard {get_shard_index(file_path, num_shards)} is in shard {shard_index}")
+            if file_path in shard_of_file:
+                problems.append(f"file {file_path} is in shards {shard_of_file[file_path]} and {shard_index}")
+            shard_of_file[file_path] = shard_index
+        for chunk_id in shard["chunk_ids"]:
+            if chunk_id in shard_of_chunk:
+                problems.append(f"chunk {chunk_id} is in shards {shard_of_chunk[chunk_id]} and {shard_index}")
+            shard_of_chunk[chunk_id] = shard_index
+    if directory_path is not None:
+        for file_path in get_files_recursively(directory_path):
+            rel_path = os.path.relpath(file_path, directory_path)
+            if os.path.isfile(file_path) and rel_path not in shard_of_file:
+                problems.append(f"file {rel_path} of shard {get_shard_index(rel_path, num_shards)} was not processed")
+    if problems:
+        raise ValueError(f"{len(problems)} problems merging {output_dir}, first ones: {problems[:5]}")
+
+    shards.sort(key=lambda shard: shard["shard_index"])
+    if output_path:
+        with open(output_path, "wb") as output:
+            for shard in shards:
+                with open(os.path.join(output_dir, _shard_name(shard["shard_index"], num_shards) + ".jsonl"), "rb") as f:
+                    shutil.copyfileobj(f, output)
+    merged = merge_chunking_results(ChunkingResult(chunks=[], **shard["result"]) for shard in shards)
+    statuses = Counter(status for shard in shards for status in shard["files"].values())
+    print(f"Merged {num_shards} shards: {merged.total_files} files ({dict(statuses)}), {len(shard_of_chunk)} chunks")
+    return merged
 
 
 class SingletonFormRecognizerClient:
@@ -1100,3 +3061,53 @@ class SingletonFormRecognizerClient:
     def __setstate__(self, state):
         url, key = state
         self.instance = DocumentAnalysisClient(endpoint=url, credential=AzureKeyCredential(key), headers={"x-ms-useragent": "sample-app-aoai-chatgpt/1.0.0"})
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Chunk a local folder or blob container, or one shard of it, to JSON lines files",
+        epilog="Example: data_utils.py chunk ./data ./out --shard-index 0 --num-shards 4, then data_utils.py merge ./out --output chunks.jsonl",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    chunk_parser = subparsers.add_parser("chunk", help="Chunk the files of one shard and write them to the output folder")
+    chunk_parser.add_argument("data_path", help="Local folder or blob URL to chunk")
+    chunk_parser.add_argument("output_dir", help="Folder to write the shard's chunks and stats to")
+    chunk_parser.add_argument("--shard-index", type=int, default=0)
+    chunk_parser.add_argument("--num-shards", type=int, default=1)
+    chunk_parser.add_argument("--njobs", type=int, default=4)
+    chunk_parser.add_argument("--chunk-size", type=int, default=1024)
+    chunk_parser.add_argument("--token-overlap", type=int, default=0)
+    chunk_parser.add_argument("--url-prefix", default=None)
+    chunk_parser.add_argument("--use-layout", action="store_true")
+    chunk_parser.add_argument("--embedding-endpoint", default=None,
+                              help="Optional. Adds embeddings to the chunks with this embedding model endpoint.")
+    merge_parser = subparsers.add_parser("merge", help="Check and combine the shards in an output folder")
+    merge_parser.add_argument("output_dir")
+    merge_parser.add_argument("--output", default=None, help="Optional. JSON lines file to write all the chunks to.")
+    merge_parser.add_argument("--data-path", default=None,
+                              help="Optional. Local folder the shards were chunked from, to check that none of its files was missed.")
+    args = parser.parse_args()
+
+    if args.command == "merge":
+        result = merge_shards(args.output_dir, args.output, directory_path=args.data_path)
+    else:
+        chunking_args = dict(
+            num_tokens=args.chunk_size,
+            token_overlap=args.token_overlap,
+            url_prefix=args.url_prefix,
+            use_layout=args.use_layout,
+            njobs=args.njobs,
+            add_embeddings=args.embedding_endpoint is not None,
+            embedding_endpoint=args.embedding_endpoint,
+            shard_index=args.shard_index,
+            num_shards=args.num_shards,
+        )
+        if args.data_path.startswith("https://"):
+            from azure.identity import DefaultAzureCredential
+            results = iter_chunk_blob_container(args.data_path, DefaultAzureCredential(), **chunking_args)
+        else:
+            results = iter_chunk_directory(args.data_path, **chunking_args)
+        result = write_shard(results, args.output_dir, args.shard_index, args.num_shards)
+    print(_chunking_result_counts(result))
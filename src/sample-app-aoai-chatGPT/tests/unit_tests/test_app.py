@@ -0,0 +1,125 @@
+import os
+import asyncio
+import pytest
+from importlib import import_module, reload
+
+
+@pytest.fixture(scope="function")
+def dotenv_name():
+    return "dotenv_no_datasource_1"
+
+
+@pytest.fixture(scope="function")
+def app_module(dotenv_name):
+    # Reload module objects to pick up the new environment
+    os.environ["DOTENV_PATH"] = os.path.join(
+        os.path.dirname(__file__),
+        "dotenv_data",
+        dotenv_name
+    )
+    reload(import_module("backend.settings"))
+    yield reload(import_module("app"))
+
+
+@pytest.mark.asyncio
+async def test_openai_client_is_shared_across_requests(app_module):
+    app = app_module.app
+    async with app.app_context():
+        first = app_module.get_openai_client()
+        second = app_module.get_openai_client()
+        assert first is second
+
+
+@pytest.mark.asyncio
+async def test_openai_client_lifecycle(app_module):
+    app = app_module.app
+    await app.startup()
+    client = app.azure_openai_client
+    assert client is not None
+    async with app.app_context():
+        assert app_module.get_openai_client() is client
+
+    await app.shutdown()
+    assert app.azure_openai_client is None
+    assert client._client.is_closed
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("dotenv_name", ["dotenv_with_chat_history"])
+async def test_cosmos_client_lifecycle(app_module):
+    app = app_module.app
+    await app.startup()
+    client = app.cosmos_conversation_client
+    assert client is not None
+    assert client.cosmosdb_client.client_connection.connection_policy.RetryOptions.MaxRetryAttemptCount == 3
+    async with app.app_context():
+        assert app_module.get_cosmos_conversation_client() is client
+
+    await app.shutdown()
+    assert app.cosmos_conversation_client is None
+
+
+@pytest.mark.asyncio
+async def test_cosmos_client_not_configured(app_module):
+    app = app_module.app
+    await app.startup()
+    assert app.cosmos_conversation_client is None
+    await app.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_add_conversation_generates_title_in_background(app_module, monkeypatch):
+    app = app_module.app
+    title_requested = asyncio.Event()
+    release_title = asyncio.Event()
+    titles = []
+
+    async def generate_title(messages):
+        title_requested.set()
+        await release_title.wait()
+        return "Generated title"
+
+    async def conversation_internal(request_body, request_headers):
+        return app_module.jsonify(dict(request_body["history_metadata"]))
+
+    class ConversationClient:
+        async def create_conversation(self, user_id, title):
+            return {"id": "conversation-1", "createdAt": "2024-01-01T00:00:00"}
+
+        async def create_message(self, **kwargs):
+            return {"id": kwargs["uuid"]}
+
+        async def update_conversation_title(self, user_id, conversation_id, title):
+            titles.append((conversation_id, title))
+
+    monkeypatch.setattr(app_module, "generate_title", generate_title)
+    monkeypatch.setattr(app_module, "conversation_internal", conversation_internal)
+    app.cosmos_conversation_client = ConversationClient()
+
+    response = await app.test_client().post(
+        "/history/generate", json={"messages": [{"role": "user", "content": "Hello there"}]}
+    )
+    # The completion does not wait for the title, which starts under the user's message
+    assert response.status_code == 200
+    assert (await response.get_json())["title"] == "Hello there"
+    assert title_requested.is_set() and not titles
+
+    release_title.set()
+    await asyncio.gather(*app.background_tasks)
+    assert titles == [("conversation-1", "Generated title")]
+
+
+def test_provisional_title(app_module):
+    assert app_module.provisional_title("  Hello there\nand a long question") == "Hello there"
+    title = app_module.provisional_title("word " * 1000)
+    assert len(title) == app_module.PROVISIONAL_TITLE_LENGTH and title.endswith("...")
+
+
+@pytest.mark.asyncio
+async def test_update_conversation_title_logs_cancelled_title(app_module, caplog):
+    title_task = asyncio.create_task(asyncio.sleep(10))
+    title_task.cancel()
+
+    with pytest.raises(asyncio.CancelledError):
+        await app_module.update_conversation_title(None, "user-1", "conversation-1", title_task, {"title": "Hello"})
+    assert "conversation-1 cancelled" in caplog.text
@@ -0,0 +1,85 @@
+import asyncio
+import re
+import pytest
+from azure.cosmos import exceptions
+from backend.history.cosmosdbservice import CosmosConversationClient
+
+
+class ContainerClient:
+    def __init__(self, conversations, upsert_delays=None):
+        self.conversations = conversations
+        self.upsert_delays = upsert_delays or {}
+        self.items = []
+        self.calls = []
+
+    async def upsert_item(self, body):
+        await asyncio.sleep(self.upsert_delays.get(body["id"], 0))
+        self.calls.append(("upsert_item", body["id"]))
+        self.items.append(body)
+        return body
+
+    async def patch_item(self, item, partition_key, patch_operations, **kwargs):
+        self.calls.append(("patch_item", item))
+        if item not in self.conversations:
+            raise exceptions.CosmosResourceNotFoundError(status_code=404, message="Not found")
+        for operation in patch_operations:
+            self.conversations[item][operation["path"].lstrip("/")] = operation["value"]
+        return self.conversations[item]
+
+    async def delete_item(self, item, partition_key):
+        self.calls.append(("delete_item", item))
+
+    async def query_items(self, query, parameters):
+        # items come back in write order unless the query orders them
+        order_by = re.search(r"ORDER BY c\.(\w+) ASC", query)
+        items = sorted(self.items, key=lambda item: item.get(order_by.group(1), "")) if order_by else self.items
+        for item in items:
+            yield item
+
+
+@pytest.fixture
+def conversation_client():
+    client = CosmosConversationClient.__new__(CosmosConversationClient)
+    client.enable_message_feedback = False
+    client.container_client = ContainerClient({"conversation-1": {"id": "conversation-1", "updatedAt": ""}})
+    return client
+
+
+@pytest.mark.asyncio
+async def test_create_messages(conversation_client):
+    resp = await conversation_client.create_messages(
+        "conversation-1",
+        "user-1",
+        [("m1", {"role": "tool", "content": "{}"}), ("m2", {"role": "assistant", "content": "Hi"})],
+    )
+
+    assert [message["id"] for message in resp] == ["m1", "m2"]
+    assert resp[0]["createdAt"] < resp[1]["createdAt"]
+    # the conversation is patched before any message is written
+    calls = conversation_client.container_client.calls
+    assert calls[0] == ("patch_item", "conversation-1")
+    assert sorted(calls[1:]) == [("upsert_item", "m1"), ("upsert_item", "m2")]
+    assert conversation_client.container_client.conversations["conversation-1"]["updatedAt"] == resp[1]["createdAt"]
+
+
+@pytest.mark.asyncio
+async def test_create_message_conversation_not_found(conversation_client):
+    resp = await conversation_client.create_message("m1", "missing", "user-1", {"role": "user", "content": "Hi"})
+
+    assert resp == "Conversation not found"
+    assert conversation_client.container_client.calls == [("patch_item", "missing")]
+
+
+@pytest.mark.asyncio
+async def test_create_messages_keeps_tool_message_first(conversation_client):
+    # the tool message's write finishes last, as it can when the writes run concurrently
+    conversation_client.container_client.upsert_delays = {"tool": 0.05}
+    await conversation_client.create_messages(
+        "conversation-1",
+        "user-1",
+        [("tool", {"role": "tool", "content": "{}"}), ("assistant", {"role": "assistant", "content": "Hi"})],
+    )
+
+    messages = await conversation_client.get_messages("user-1", "conversation-1")
+    assert [message["role"] for message in messages] == ["tool", "assistant"]
+    assert messages[0]["createdAt"] < messages[1]["createdAt"]
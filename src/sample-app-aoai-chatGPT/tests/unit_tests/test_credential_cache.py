@@ -0,0 +1,85 @@
+import asyncio
+import pickle
+import time
+import pytest
+from azure.core.credentials import AccessToken
+from azure.identity import DefaultAzureCredential
+from backend.auth.credential_cache import (
+    AsyncCachedTokenCredential,
+    CachedTokenCredential,
+    as_cached_credential
+)
+
+
+class DummyCredential:
+    def __init__(self, lifetime=3600):
+        self.lifetime = lifetime
+        self.calls = 0
+
+    def get_token(self, *scopes, **kwargs):
+        self.calls += 1
+        return AccessToken(f"token{self.calls}", int(time.time()) + self.lifetime)
+
+    def close(self):
+        pass
+
+
+class DummyAsyncCredential(DummyCredential):
+    async def get_token(self, *scopes, **kwargs):
+        await asyncio.sleep(0)
+        return super().get_token(*scopes, **kwargs)
+
+    async def close(self):
+        pass
+
+
+def test_cached_token_credential_hits():
+    credential = CachedTokenCredential(DummyCredential())
+    assert credential.get_token("scope").token == "token1"
+    assert credential.get_token("scope").token == "token1"
+    assert credential.get_token("other_scope").token == "token2"
+    assert credential.stats["hits"] == 1
+    assert credential.stats["misses"] == 2
+
+
+def test_cached_token_credential_refreshes_ahead_of_expiry():
+    inner = DummyCredential(lifetime=120)
+    credential = CachedTokenCredential(inner, refresh_margin=300)
+    credential.get_token("scope")
+    # still valid, so it is served while a refresh runs in the background
+    assert credential.get_token("scope").token == "token1"
+    for _ in range(100):
+        if credential.refreshes:
+            break
+        time.sleep(0.01)
+    assert credential.refreshes == 1
+    assert inner.calls == 2
+
+
+def test_cached_token_credential_pickles_with_tokens():
+    credential = CachedTokenCredential(DummyCredential())
+    credential.get_token("scope")
+    copy = pickle.loads(pickle.dumps(credential))
+    assert copy.get_token("scope").token == "token1"
+    assert as_cached_credential(copy) is copy
+
+
+def test_cached_token_credential_pickles_default_azure_credential():
+    credential = CachedTokenCredential(DefaultAzureCredential())
+    credential._tokens[credential._cache_key(("scope",), {})] = AccessToken("token1", int(time.time()) + 3600)
+    copy = pickle.loads(pickle.dumps(credential))
+    assert isinstance(copy.credential, DefaultAzureCredential)
+    assert copy.credential is not credential.credential
+    assert copy.get_token("scope").token == "token1"
+
+
+@pytest.mark.asyncio
+async def test_async_cached_token_credential_coalesces_misses():
+    inner = DummyAsyncCredential()
+    credential = AsyncCachedTokenCredential(inner)
+    tokens = await asyncio.gather(*[credential.get_token("scope") for _ in range(10)])
+    assert {t.token for t in tokens} == {"token1"}
+    assert inner.calls == 1
+    await credential.get_token("scope")
+    assert credential.stats["hits"] == 1
+    await credential.close()
@@ -0,0 +1,449 @@
+import asyncio
+import functools
+import html
+import io
+import json
+import os
+import sys
+import time
+import pytest
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from importlib import import_module
+from types import SimpleNamespace
+from unittest import mock
+
+SCRIPTS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "scripts"))
+
+
+class ByteEncoding:
+    # stands in for the gpt2 encoding, which tiktoken would download: one token per UTF-8 byte
+    name = "gpt2"
+
+    def encode(self, text, allowed_special=(), disallowed_special=()):
+        return list(text.encode("utf-8"))
+
+    def decode(self, tokens):
+        return bytes(tokens).decode("utf-8", errors="replace")
+
+    def decode_tokens_bytes(self, tokens):
+        return [bytes([token]) for token in tokens]
+
+
+@pytest.fixture(scope="module")
+def data_utils():
+    sys.path.insert(0, SCRIPTS_DIR)
+    sys.modules.pop("data_utils", None)
+    try:
+        with mock.patch("tiktoken.get_encoding", return_value=ByteEncoding()):
+            yield import_module("data_utils")
+    finally:
+        sys.modules.pop("data_utils", None)
+        sys.path.remove(SCRIPTS_DIR)
+
+
+def test_batch_by_token_budget(data_utils):
+    batch = data_utils.batch_by_token_budget
+    assert list(batch([5, 5, 5, 5], max_items=2, max_tokens=100)) == [[0, 1], [2, 3]]
+    assert list(batch([5, 5, 5], max_items=16, max_tokens=12)) == [[0, 1], [2]]
+    # an item over the token budget goes in a batch of its own
+    assert list(batch([3, 50, 3], max_items=16, max_tokens=10)) == [[0], [1], [2]]
+    assert list(batch([5, 5, 5, 5], max_items=16, max_tokens=100, indices=[1, 3])) == [[1, 3]]
+    assert list(batch([], max_items=16, max_tokens=100)) == []
+
+
+def test_sqlite_cache_evicts_least_recently_used(data_utils, tmp_path, monkeypatch):
+    clock = iter(range(1, 100))
+    monkeypatch.setattr(data_utils.time, "time", lambda: next(clock))
+    cache = data_utils.SqliteCache(str(tmp_path / "cache.db"), max_bytes=100)
+    cache.put("a", b"a" * 40)
+    cache.put("b", b"b" * 40)
+    assert cache.get("a") == b"a" * 40
+
+    # over max_bytes, so entries are evicted from the least recently used until the cache is under 90% of it
+    cache.put("c", b"c" * 40)
+    assert cache.get_many(["a", "b", "c"]) == {"a": b"a" * 40, "c": b"c" * 40}
+    assert cache.stats["hits"] == 3 and cache.stats["misses"] == 1
+
+    # the entries are kept in the file for the next process
+    assert data_utils.SqliteCache(str(tmp_path / "cache.db"), max_bytes=100).get("c") == b"c" * 40
+
+
+def test_file_manifest(data_utils, tmp_path):
+    data_file = tmp_path / "a.txt"
+    data_file.write_text("hello")
+    manifest_path = str(tmp_path / "manifest.json")
+    manifest = data_utils.FileManifest(manifest_path, {"num_tokens": 1024})
+    assert not manifest.is_unchanged("a.txt", str(data_file))
+    manifest.update("a.txt", str(data_file), ["id0", "id1"])
+    manifest.save()
+
+    manifest = data_utils.FileManifest(manifest_path, {"num_tokens": 1024})
+    assert manifest.is_unchanged("a.txt", str(data_file))
+    # touched but not changed
+    os.utime(data_file, (0, 0))
+    assert manifest.is_unchanged("a.txt", str(data_file))
+    assert manifest.stale_chunk_ids("a.txt", ["id0"]) == ["id1"]
+    assert manifest.removed_files(["b.txt"]) == ["a.txt"]
+    data_file.write_text("hello, again")
+    assert not manifest.is_unchanged("a.txt", str(data_file))
+
+    # other chunking parameters: every file is processed again, and its old chunks are still known
+    manifest = data_utils.FileManifest(manifest_path, {"num_tokens": 512})
+    assert not manifest.is_unchanged("a.txt", str(data_file))
+    assert manifest.stale_chunk_ids("a.txt", []) == ["id0", "id1"]
+
+
+def test_iter_chunk_directory_resumes_from_manifest(data_utils, tmp_path):
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+    for i in range(3):
+        (data_dir / f"{i}.txt").write_text(f"Document number {i}. " * 20)
+    manifest_path = str(tmp_path / "manifest.json")
+
+    results = data_utils.iter_chunk_directory(str(data_dir), njobs=1, num_tokens=128, manifest_path=manifest_path)
+    assert next(results).num_unchanged_files == 0
+    next(results)
+    # a file is only recorded once the next result is asked for, i.e. once the first one was written out
+    next(results)
+    results.close()
+
+    results = list(data_utils.iter_chunk_directory(str(data_dir), njobs=1, num_tokens=128, manifest_path=manifest_path))
+    assert results[0].num_unchanged_files == 1
+    assert len(results[1:]) == 2 and all(result.chunks for result in results[1:])
+
+    results = list(data_utils.iter_chunk_directory(str(data_dir), njobs=1, num_tokens=128, manifest_path=manifest_path))
+    assert results[0].num_unchanged_files == 3 and len(results) == 1
+
+
+def test_split_by_token_offsets(data_utils):
+    text = "The first sentence is here. The second one follows it! Then a third sentence ends the text."
+    tokens = data_utils.TOKEN_ESTIMATOR.encode(text)
+    chunks = list(data_utils.split_by_token_offsets(text, tokens, num_tokens=40))
+
+    # cuts snap to the sentence endings
+    assert [chunk for chunk, _ in chunks] == [
+        "The first sentence is here.",
+        "The second one follows it!",
+        "Then a third sentence ends the text.",
+    ]
+    assert all(count == len(chunk.encode("utf-8")) for chunk, count in chunks)
+
+
+def test_split_by_token_offsets_word_breaks(data_utils):
+    text = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor"
+    tokens = data_utils.TOKEN_ESTIMATOR.encode(text)
+
+    # without sentence endings the cuts fall between words
+    chunks = list(data_utils.split_by_token_offsets(text, tokens, num_tokens=20))
+    assert [chunk for chunk, _ in chunks] == [
+        "lorem ipsum dolor", "sit amet consectetur", "adipiscing elit", "sed do eiusmod", "tempor"
+    ]
+    assert [count for _, count in chunks] == [17, 20, 15, 14, 6]
+
+    # the overlap is counted in tokens, so a chunk may start inside a word, but still ends on one
+    chunks = list(data_utils.split_by_token_offsets(text, tokens, num_tokens=20, token_overlap=6))
+    assert all(chunk.split()[-1] in text.split() for chunk, _ in chunks)
+    assert all(count == len(chunk.encode("utf-8")) <= 20 for chunk, count in chunks)
+    assert chunks[-1][0].endswith("eiusmod tempor")
+
+
+def test_count_chunk_tokens(data_utils):
+    text = "Première phrase. Second sentence here. Première phrase."
+    tokens = data_utils.TOKEN_ESTIMATOR.encode(text)
+    chunks = ["Première phrase.", "Second sentence here.", "Première phrase.", "not in the text"]
+    assert list(data_utils.count_chunk_tokens(text, tokens, chunks)) == [
+        (chunk, len(chunk.encode("utf-8"))) for chunk in chunks
+    ]
+
+
+def baseline_extract_pdf_content(form_recognizer_results, pdf_headers):
+    # extract_pdf_content as it was before it assembled pages from content slices, kept to compare against
+    def table_to_html(table):
+        table_html = "<table>"
+        rows = [sorted([cell for cell in table.cells if cell.row_index == i], key=lambda cell: cell.column_index) for i in range(table.row_count)]
+        for row_cells in rows:
+            table_html += "<tr>"
+            for cell in row_cells:
+                tag = "th" if (cell.kind == "columnHeader" or cell.kind == "rowHeader") else "td"
+                cell_spans = ""
+                if cell.column_span > 1: cell_spans += f" colSpan={cell.column_span}"
+                if cell.row_span > 1: cell_spans += f" rowSpan={cell.row_span}"
+                table_html += f"<{tag}{cell_spans}>{html.escape(cell.content)}</{tag}>"
+            table_html += "</tr>"
+        table_html += "</table>"
+        return table_html
+
+    roles_start = {}
+    roles_end = {}
+    for paragraph in form_recognizer_results.paragraphs:
+        if paragraph.role != None:
+            roles_start[paragraph.spans[0].offset] = paragraph.role
+            roles_end[paragraph.spans[0].offset + paragraph.spans[0].length] = paragraph.role
+
+    full_text = ""
+    for page_num, page in enumerate(form_recognizer_results.pages):
+        tables_on_page = [table for table in form_recognizer_results.tables if table.bounding_regions[0].page_number == page_num + 1]
+        page_offset = page.spans[0].offset
+        page_length = page.spans[0].length
+        table_chars = [-1] * page_length
+        for table_id, table in enumerate(tables_on_page):
+            for span in table.spans:
+                for i in range(span.length):
+                    idx = span.offset - page_offset + i
+                    if idx >= 0 and idx < page_length:
+                        table_chars[idx] = table_id
+
+        page_text = ""
+        added_tables = set()
+        for idx, table_id in enumerate(table_chars):
+            if table_id == -1:
+                position = page_offset + idx
+                if position in roles_start and roles_start[position] in pdf_headers:
+                    page_text += f"<{pdf_headers[roles_start[position]]}>"
+                if position in roles_end and roles_end[position] in pdf_headers:
+                    page_text += f"</{pdf_headers[roles_end[position]]}>"
+                page_text += form_recognizer_results.content[page_offset + idx]
+            elif not table_id in added_tables:
+                page_text += table_to_html(tables_on_page[table_id])
+                added_tables.add(table_id)
+        full_text += page_text + " "
+    return full_text
+
+
+def make_analyze_result(pages):
+    # pages: lists of (text, role) parts, role being a paragraph role, "table" or None
+    span = lambda offset, length: SimpleNamespace(offset=offset, length=length)
+    content, result_pages, paragraphs, tables = "", [], [], []
+    for page_number, parts in enumerate(pages, start=1):
+        page_offset = len(content)
+        for text, role in parts:
+            if role == "table":
+                cells = [
+                    SimpleNamespace(row_index=0, column_index=1, kind="columnHeader", column_span=1, row_span=1, content="B"),
+                    SimpleNamespace(row_index=0, column_index=0, kind="columnHeader", column_span=1, row_span=1, content="A & a"),
+                    SimpleNamespace(row_index=1, column_index=0, kind="content", column_span=2, row_span=1, content=text),
+                ]
+                # the table span is cut in two, as a paragraph inside a table would leave it
+                tables.append(SimpleNamespace(
+                    spans=[span(len(content), 2), span(len(content) + 2, len(text) - 2)],
+                    bounding_regions=[SimpleNamespace(page_number=page_number)], cells=cells, row_count=2,
+                ))
+            else:
+                paragraphs.append(SimpleNamespace(role=role, spans=[span(len(content), len(text))]))
+            content += text
+        result_pages.append(SimpleNamespace(page_number=page_number, spans=[span(page_offset, len(content) - page_offset)]))
+    return SimpleNamespace(content=content, pages=result_pages, paragraphs=paragraphs, tables=tables)
+
+
+def test_analyze_result_to_text_matches_baseline(data_utils, tmp_path):
+    result = make_analyze_result([
+        [("Report title", "title"), ("\n", None), ("Intro", "sectionHeading"), ("Some text.\n", None),
+         ("cells of table one", "table"), ("Between.\n", None), ("cells of table two", "table"),
+         ("A footnote", "pageFooter")],
+        [("Second page", "sectionHeading"), ("Body text <b>.", None), ("last table", "table")],
+        [("Plain text only.", None)],
+    ])
+    expected = baseline_extract_pdf_content(result, data_utils.PDF_HEADERS)
+    assert "<h1>Report title</h1>" in expected and expected.count("<table>") == 3
+    assert data_utils.analyze_result_to_text(result) == expected
+
+    form_recognizer_client = mock.Mock()
+    form_recognizer_client.begin_analyze_document.return_value.result.return_value = result
+    document = tmp_path / "document.pdf"
+    document.write_bytes(b"not really a pdf")
+    assert data_utils.extract_pdf_content(str(document), form_recognizer_client, use_layout=True) == expected
+    form_recognizer_client.begin_analyze_document.assert_called_once_with("prebuilt-layout", document=b"not really a pdf")
+
+
+def test_sqlite_cache_drops_tables_of_another_version(data_utils, tmp_path):
+    cache_path = str(tmp_path / "cache.db")
+    cache = data_utils.SqliteCache(cache_path, max_bytes=1024)
+    cache.put("a", b"value")
+    assert data_utils.SqliteCache(cache_path, max_bytes=1024).get("a") == b"value"
+
+    class NewerCache(data_utils.SqliteCache):
+        SCHEMA_VERSION = 2
+
+    assert NewerCache(cache_path, max_bytes=1024).get("a") is None
+    assert data_utils.SqliteCache(cache_path, max_bytes=1024).get("a") is None
+
+
+def test_sqlite_cache_drops_unversioned_embeddings_table(data_utils, tmp_path):
+    cache_path = str(tmp_path / "cache.db")
+    connection = data_utils.sqlite3.connect(cache_path)
+    # the embeddings table from before versioning stored vectors in a column of their own
+    connection.execute("CREATE TABLE embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)")
+    connection.execute("INSERT INTO embeddings VALUES ('a', x'00', 1, 0)")
+    connection.commit()
+    connection.close()
+
+    class EmbeddingsCache(data_utils.SqliteCache):
+        TABLE = "embeddings"
+
+    cache = EmbeddingsCache(cache_path, max_bytes=1024)
+    assert cache.get("a") is None
+    cache.put("a", b"value")
+    assert cache.get("a") == b"value"
+
+
+def test_analysis_cache_key_changes_with_format_version(data_utils, monkeypatch):
+    key = data_utils.AnalysisCache.make_key(b"document", "prebuilt-read", "2023-07-31")
+    assert key == data_utils.AnalysisCache.make_key(b"document", "prebuilt-read", "2023-07-31")
+    assert key != data_utils.AnalysisCache.make_key(b"document", "prebuilt-layout", "2023-07-31")
+    monkeypatch.setattr(data_utils.AnalysisCache, "FORMAT_VERSION", data_utils.AnalysisCache.FORMAT_VERSION + 1)
+    assert key != data_utils.AnalysisCache.make_key(b"document", "prebuilt-read", "2023-07-31")
+
+
+def test_get_page_ranges(data_utils, monkeypatch):
+    assert data_utils.get_page_ranges("notes.txt", b"text", page_range_size=100) == [None]
+    assert data_utils.get_page_ranges("broken.pdf", b"not a pdf", page_range_size=100) == [None]
+
+    monkeypatch.setattr(data_utils, "get_pdf_page_count", lambda document: 250)
+    assert data_utils.get_page_ranges("large.PDF", b"", page_range_size=100) == ["1-100", "101-200", "201-250"]
+    assert data_utils.get_page_ranges("large.pdf", b"", page_range_size=250) == [None]
+    assert data_utils.get_page_ranges("large.pdf", b"", page_range_size=0) == [None]
+
+
+def test_get_pdf_page_count(data_utils):
+    pypdf = pytest.importorskip("pypdf")
+    writer = pypdf.PdfWriter()
+    for _ in range(3):
+        writer.add_blank_page(width=100, height=100)
+    document = io.BytesIO()
+    writer.write(document)
+    assert data_utils.get_pdf_page_count(document.getvalue()) == 3
+    assert data_utils.get_pdf_page_count(b"not a pdf") is None
+
+
+def test_extract_pdf_content_analyses_page_ranges(data_utils, tmp_path, monkeypatch):
+    monkeypatch.setattr(data_utils, "get_pdf_page_count", lambda document: 2 * data_utils.PDF_PAGE_RANGE_SIZE)
+    results = {
+        pages: make_analyze_result([[(f"Pages {pages}.", None)]])
+        for pages in data_utils.get_page_ranges("document.pdf", b"")
+    }
+    form_recognizer_client = mock.Mock()
+    form_recognizer_client.begin_analyze_document.side_effect = (
+        lambda model, document, pages: SimpleNamespace(result=lambda: results[pages])
+    )
+    document = tmp_path / "document.pdf"
+    document.write_bytes(b"%PDF")
+
+    # the ranges are analysed apart and their text joined in page order
+    assert data_utils.extract_pdf_content(str(document), form_recognizer_client) == "".join(
+        f"Pages {pages}. " for pages in results
+    )
+    assert len(results) == 2 and form_recognizer_client.begin_analyze_document.call_count == 2
+
+
+def is_running(pid):
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # the state follows the parenthesised command name; a killed worker may linger as a zombie
+            return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except FileNotFoundError:
+        return False
+
+
+@pytest.mark.asyncio
+async def test_worker_pool_recycles_after_timeout(data_utils):
+    worker_pool = data_utils._WorkerPool(functools.partial(ProcessPoolExecutor, max_workers=1), num_workers=1)
+    try:
+        hung_pid = await worker_pool.run(os.getpid)
+        with pytest.raises(data_utils.FileTimeoutError):
+            await worker_pool.run(time.sleep, 30, timeout=0.5)
+        assert worker_pool.num_recycles == 1 and worker_pool.generation == 1
+
+        # the stuck worker is killed and a new one takes the next file
+        assert await worker_pool.run(os.getpid) != hung_pid
+        if os.path.isdir("/proc"):
+            for _ in range(50):
+                if not is_running(hung_pid):
+                    break
+                await asyncio.sleep(0.1)
+            assert not is_running(hung_pid)
+    finally:
+        worker_pool.shutdown(kill=True)
+
+
+@pytest.mark.asyncio
+async def test_worker_pool_recycles_after_crash(data_utils):
+    worker_pool = data_utils._WorkerPool(functools.partial(ProcessPoolExecutor, max_workers=2), num_workers=2)
+    try:
+        # a file that crashes a worker by itself as well is given up on
+        with pytest.raises(BrokenProcessPool):
+            await worker_pool.run(os._exit, 1)
+        assert worker_pool.num_recycles == 2
+
+        # files in flight when another crashes the pool are retried on the new one
+        results = await asyncio.gather(
+            worker_pool.run(os._exit, 1), worker_pool.run(time.sleep, 0.5), return_exceptions=True)
+        assert isinstance(results[0], BrokenProcessPool) and results[1] is None
+        assert await worker_pool.run(sum, [1, 2]) == 3
+    finally:
+        worker_pool.shutdown(kill=True)
+
+
+def write_shards(data_utils, data_dir, output_dir, num_shards=2):
+    for shard_index in range(num_shards):
+        results = data_utils.iter_chunk_directory(
+            str(data_dir), njobs=1, num_tokens=128, shard_index=shard_index, num_shards=num_shards)
+        data_utils.write_shard(results, str(output_dir), shard_index, num_shards)
+
+
+def test_merge_shards(data_utils, tmp_path):
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+    for i in range(6):
+        (data_dir / f"{i}.txt").write_text(f"Document number {i}. " * 20)
+    (data_dir / "empty.txt").write_text("")
+    (data_dir / "image.bmp").write_bytes(b"BM")
+    output_dir = tmp_path / "shards"
+    write_shards(data_utils, data_dir, output_dir)
+
+    output_path = tmp_path / "chunks.jsonl"
+    merged = data_utils.merge_shards(str(output_dir), str(output_path), str(data_dir))
+    assert merged.total_files == 8 and merged.num_unsupported_format_files == 1
+    stats = [json.loads(path.read_text()) for path in sorted(output_dir.glob("*.stats.json"))]
+    # the chunks of both shards, in shard order
+    assert [json.loads(line)["id"] for line in output_path.read_text().splitlines()] == [
+        chunk_id for shard in stats for chunk_id in shard["chunk_ids"]
+    ]
+    assert {json.loads(line)["filepath"] for line in output_path.read_text().splitlines()} == {f"{i}.txt" for i in range(6)}
+    file_statuses = {file_path: status for shard in stats for file_path, status in shard["files"].items()}
+    assert file_statuses == {**{f"{i}.txt": "chunked" for i in range(6)}, "empty.txt": "empty", "image.bmp": "unsupported"}
+
+
+def test_merge_shards_finds_problems(data_utils, tmp_path):
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+    for i in range(6):
+        (data_dir / f"{i}.txt").write_text(f"Document number {i}. " * 20)
+    output_dir = tmp_path / "shards"
+    write_shards(data_utils, data_dir, output_dir)
+    stats_path = output_dir / (data_utils._shard_name(1, 2) + ".stats.json")
+    stats = json.loads(stats_path.read_text())
+
+    # a file added after the shards ran
+    (data_dir / "new.txt").write_text("A late document.")
+    with pytest.raises(ValueError, match="new.txt of shard .* was not processed"):
+        data_utils.merge_shards(str(output_dir), directory_path=str(data_dir))
+    data_utils.merge_shards(str(output_dir))
+
+    # a file recorded by the wrong shard, and the same file in both shards
+    other_file = next(iter(json.loads((output_dir / (data_utils._shard_name(0, 2) + ".stats.json")).read_text())["files"]))
+    stats_path.write_text(json.dumps({**stats, "files": {**stats["files"], other_file: "chunked"}}))
+    with pytest.raises(ValueError, match=f"file {other_file} of shard 0 is in shard 1"):
+        data_utils.merge_shards(str(output_dir))
+    with pytest.raises(ValueError, match=f"file {other_file} is in shards 0 and 1"):
+        data_utils.merge_shards(str(output_dir))
+
+    # a file not recorded by its shard
+    stats_path.write_text(json.dumps({**stats, "files": dict(list(stats["files"].items())[1:])}))
+    with pytest.raises(ValueError, match="shard 1 recorded"):
+        data_utils.merge_shards(str(output_dir))
+
+    # a shard that did not finish
+    stats_path.unlink()
+    with pytest.raises(ValueError, match=r"missing shards \[1\]"):
+        data_utils.merge_shards(str(output_dir))
@@ -1,5 +1,23 @@
+import asyncio
 import pytest
-from backend.utils import format_as_ndjson, parse_multi_columns
+from types import SimpleNamespace
+from backend.utils import coalesce_stream_response, format_as_ndjson, parse_multi_columns
+
+
+def make_chunk(**delta):
+    return SimpleNamespace(
+        id="chatcmpl-1",
+        model="gpt-4",
+        created=1,
+        object="chat.completion.chunk",
+        choices=[SimpleNamespace(delta=SimpleNamespace(**{"role": None, "content": None, **delta}))],
+    )
+
+
+async def dummy_stream(chunks, delay=0):
+    for chunk in chunks:
+        await asyncio.sleep(delay)
+        yield chunk
 
 
 @pytest.mark.asyncio
@@ -27,3 +45,59 @@ def test_parse_multi_columns():
     assert parse_multi_columns(test_pipes) == ["col1", "col2", "col3"]
     assert parse_multi_columns(test_commas) == ["col1", "col2", "col3"]
     assert parse_multi_columns(test_single) == ["col1"]
+
+
+@pytest.mark.asyncio
+async def test_coalesce_stream_response():
+    chunks = [make_chunk(role="assistant", context={"citations": []})] + [make_chunk(content="ab") for _ in range(6)]
+    frames = [
+        frame async for frame in coalesce_stream_response(
+            dummy_stream(chunks), {"conversation_id": "c1"}, "req-1", interval=60, max_bytes=4
+        )
+    ]
+
+    assert frames[0]["id"] == "chatcmpl-1"
+    assert frames[0]["history_metadata"] == {"conversation_id": "c1"}
+    assert frames[0]["apim-request-id"] == "req-1"
+    assert frames[0]["choices"][0]["messages"] == [{"role": "tool", "content": '{"citations": []}'}]
+    # The first content is sent at once, the rest in frames of max_bytes
+    assert [frame["choices"][0]["messages"][0]["content"] for frame in frames[1:]] == ["ab", "abab", "abab", "ab"]
+    # Every frame keeps the id, the last one with content also carries history_metadata
+    assert all(list(frame) == ["id", "choices"] for frame in frames[1:-1])
+    assert frames[-1]["id"] == "chatcmpl-1"
+    assert frames[-1]["history_metadata"] == {"conversation_id": "c1"}
+
+
+@pytest.mark.asyncio
+async def test_coalesce_stream_response_flushes_after_interval():
+    chunks = [make_chunk(content=token) for token in "abcd"]
+    frames = [
+        frame async for frame in coalesce_stream_response(
+            dummy_stream(chunks, delay=0.05), {}, None, interval=0.01, max_bytes=1024
+        )
+    ]
+
+    assert [[message["content"] for message in frame["choices"][0]["messages"]] for frame in frames] == [["a"], ["b"], ["c"], ["d"]]
+    assert frames[-1]["history_metadata"] == {}
+
+
+@pytest.mark.asyncio
+async def test_coalesce_stream_response_ends_on_content():
+    # The final chunk (finish_reason "stop") has no content, so the last frame must not be empty
+    chunks = [make_chunk(content=token) for token in "abcd"] + [make_chunk()]
+    history_metadata = {"conversation_id": "c1", "title": "provisional"}
+
+    async def stream():
+        async for chunk in dummy_stream(chunks):
+            yield chunk
+        history_metadata["title"] = "Generated title"
+
+    frames = [
+        frame async for frame in coalesce_stream_response(
+            stream(), history_metadata, None, interval=60, max_bytes=2
+        )
+    ]
+
+    assert all(frame["choices"][0]["messages"][0]["content"] for frame in frames)
+    assert "".join(frame["choices"][0]["messages"][0]["content"] for frame in frames) == "abcd"
+    assert frames[-1]["history_metadata"]["title"] == "Generated title"
@@ -0,0 +1,369 @@
+"""
+Ingestion throughput benchmark for scripts/data_utils.py.
+
+Generates a synthetic corpus (markdown, html, text, python, and cracked PDF html with large tables for
+PdfTextSplitter), then chunks it with every combination of the given settings, each run in a fresh process
+and embedding against a local stub endpoint. Reports files/s, tokens/s, chunks/s, peak RSS and the time spent
+in each stage. Everything runs locally; tiktoken only needs its encoding cached once (see TIKTOKEN_CACHE_DIR).
+
+Example:
+    python tools/benchmark_ingestion.py --num-tokens 256 1024 --token-overlap 0 128 --njobs 1 4 --output results.json
+    python tools/benchmark_ingestion.py --baseline results.json
+"""
+import argparse
+import base64
+import contextlib
+import functools
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SCRIPTS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'scripts'))
+RESULT_PREFIX = "BENCHMARK_RESULT "
+STAGES = ["chunk_file", "split", "embed"]
+
+
+def make_vocabulary(rng: random.Random, size: int = 2000) -> list:
+    syllables = ["ka", "lo", "mi", "ne", "ru", "sa", "ti", "vo", "ze", "pa", "qu", "ex", "dor", "len", "tra", "ion"]
+    return ["".join(rng.choice(syllables) for _ in range(rng.randint(1, 4))) for _ in range(size)]
+
+
+def make_sentences(rng: random.Random, vocabulary: list, num_words: int) -> str:
+    sentences = []
+    while num_words > 0:
+        length = min(num_words, rng.randint(6, 24))
+        words = rng.choices(vocabulary, k=length)
+        sentences.append(words[0].capitalize() + " " + " ".join(words[1:]) + rng.choice([".", ".", ".", "?", "!"]))
+        num_words -= length
+    return " ".join(sentences)
+
+
+def make_markdown(rng, vocabulary, num_words):
+    parts = [f"# {make_sentences(rng, vocabulary, 4)}\n"]
+    while num_words > 0:
+        words = rng.randint(40, 160)
+        parts.append(f"\n## {make_sentences(rng, vocabulary, 3)}\n\n{make_sentences(rng, vocabulary, words)}\n")
+        if rng.random() < 0.3:
+            parts.append("".join(f"- {make_sentences(rng, vocabulary, 8)} [link](https://example.com/{rng.choice(vocabulary)})\n"
+                                 for _ in range(rng.randint(2, 6))))
+        if rng.random() < 0.2:
+            parts.append(f"\n```\n{make_sentences(rng, vocabulary, 20)}\n```\n")
+        num_words -= words
+    return "".join(parts)
+
+
+def make_html(rng, vocabulary, num_words):
+    parts = [f"<html><head><title>{make_sentences(rng, vocabulary, 5)}</title></head><body>"]
+    while num_words > 0:
+        words = rng.randint(40, 160)
+        parts.append(f"<h2>{make_sentences(rng, vocabulary, 3)}</h2><p>{make_sentences(rng, vocabulary, words)} "
+                     f"<a href=\"https://example.com/{rng.choice(vocabulary)}\">{rng.choice(vocabulary)}</a></p>")
+        if rng.random() < 0.3:
+            parts.append("<ul>" + "".join(f"<li>{make_sentences(rng, vocabulary, 8)}</li>" for _ in range(rng.randint(2, 6))) + "</ul>")
+        num_words -= words
+    parts.append("</body></html>")
+    return "".join(parts)
+
+
+def make_python(rng, vocabulary, num_words):
+    parts = []
+    while num_words > 0:
+        name = "_".join(rng.choices(vocabulary, k=2))
+        docstring = make_sentences(rng, vocabulary, rng.randint(10, 40))
+        body = "\n".join(f"    {rng.choice(vocabulary)}_{i} = {rng.randint(0, 1000)} * {rng.choice(vocabulary)}"
+                         for i in range(rng.randint(3, 15)))
+        parts.append(f"def {name}({rng.choice(vocabulary)}, {rng.choice(vocabulary)}=None):\n    \"\"\"{docstring}\"\"\"\n{body}\n    return None\n\n")
+        num_words -= 60
+    return "".join(parts)
+
+
+def make_table(rng, vocabulary, num_rows, num_columns):
+    header = "".join(f"<th>{rng.choice(vocabulary)}</th>" for _ in range(num_columns))
+    rows = "".join("<tr>" + "".join(f"<td>{make_sentences(rng, vocabulary, rng.randint(1, 6))}</td>" for _ in range(num_columns)) + "</tr>"
+                   for _ in range(num_rows))
+    return f"<table><tr>{header}</tr>{rows}</table>"
+
+
+def make_cracked_pdf(rng, vocabulary, num_words):
+    """Text as extract_pdf_content returns it with the layout model: html headers, and tables as html."""
+    parts = [f"<h1>{make_sentences(rng, vocabulary, 5)}</h1>"]
+    while num_words > 0:
+        words = rng.randint(60, 200)
+        parts.append(f"<h2>{make_sentences(rng, vocabulary, 3)}</h2>{make_sentences(rng, vocabulary, words)} ")
+        if rng.random() < 0.4:
+            parts.append(f"Table {rng.randint(1, 99)}: {make_sentences(rng, vocabulary, 6)} ")
+            parts.append(make_table(rng, vocabulary, rng.randint(10, 120), rng.randint(3, 8)))
+        num_words -= words
+    return "".join(parts)
+
+
+GENERATORS = {
+    "md": make_markdown,
+    "html": make_html,
+    "txt": make_sentences,
+    "py": make_python,
+}
+
+
+def generate_corpus(folder: str, files_per_format: int, tokens_per_file: int, seed: int):
+    """Writes files_per_format files of each format to folder/docs, and as many cracked PDFs to folder/pdf.
+    File sizes vary around tokens_per_file; the same seed always gives the same corpus."""
+    rng = random.Random(seed)
+    vocabulary = make_vocabulary(rng)
+    for extension, generator in itertools.chain(GENERATORS.items(), [("pdf", make_cracked_pdf)]):
+        subfolder = os.path.join(folder, "pdf" if extension == "pdf" else os.path.join("docs", extension))
+        os.makedirs(subfolder, exist_ok=True)
+        for i in range(files_per_format):
+            num_words = max(10, int(rng.lognormvariate(0, 0.8) * tokens_per_file * 0.75))
+            # cracked PDFs are kept as html and passed to chunk_file as already extracted content
+            file_name = f"{extension}_{i}.html" if extension == "pdf" else f"{extension}_{i}.{extension}"
+            with open(os.path.join(subfolder, file_name), "w", encoding="utf-8") as f:
+                f.write(generator(rng, vocabulary, num_words))
+
+
+class StubEmbeddingHandler(BaseHTTPRequestHandler):
+    """Answers Azure OpenAI embedding requests with zero vectors, after an optional delay."""
+    latency = 0.0
+    vectors = {}
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        dimensions = body.get("dimensions", 1536)
+        if dimensions not in self.vectors:
+            self.vectors[dimensions] = base64.b64encode(bytes(4 * dimensions)).decode("ascii")
+        embedding = self.vectors[dimensions] if body.get("encoding_format") == "base64" else [0.0] * dimensions
+        response = json.dumps({
+            "object": "list",
+            "data": [{"object": "embedding", "index": i, "embedding": embedding} for i in range(len(inputs))],
+            "model": "stub",
+            "usage": {"prompt_tokens": 0, "total_tokens": 0},
+        }).encode("utf-8")
+        if self.latency:
+            time.sleep(self.latency)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+
+def start_stub_embedding_server(latency: float) -> ThreadingHTTPServer:
+    StubEmbeddingHandler.latency = latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubEmbeddingHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def instrument(data_utils, stage_times):
+    """Adds the time spent in each stage to stage_times, shared with the worker processes."""
+    def add_time(stage, start):
+        with stage_times.get_lock():
+            stage_times[STAGES.index(stage)] += time.perf_counter() - start
+
+    def timed(stage, function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                add_time(stage, start)
+        return wrapper
+
+    def timed_generator(stage, function):
+        # the work of a generator happens while it is iterated, not when it is called
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            generator = function(*args, **kwargs)
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(generator)
+                except StopIteration:
+                    return
+                finally:
+                    add_time(stage, start)
+                yield item
+        return wrapper
+
+    data_utils.chunk_file = timed("chunk_file", data_utils.chunk_file)
+    data_utils.chunk_content_helper = timed_generator("split", data_utils.chunk_content_helper)
+    data_utils.get_embeddings = timed("embed", data_utils.get_embeddings)
+
+
+def run_one(config: dict) -> dict:
+    """Runs a single benchmark configuration in this process."""
+    sys.path.insert(0, SCRIPTS_DIR)
+    import data_utils
+
+    # measure the work itself, not the local caches
+    data_utils.EMBEDDING_CACHE_PATH = None
+    data_utils.FORM_RECOGNIZER_CACHE_PATH = None
+    stage_times = multiprocessing.Array("d", len(STAGES))
+    instrument(data_utils, stage_times)
+
+    chunking_args = dict(
+        num_tokens=config["num_tokens"],
+        token_overlap=config["token_overlap"],
+        add_embeddings=config["embedding_endpoint"] is not None,
+        embedding_endpoint=config["embedding_endpoint"],
+    )
+    start = time.perf_counter()
+    if config["kind"] == "directory":
+        result = data_utils.chunk_directory(config["path"], njobs=config["njobs"], **chunking_args)
+    else:
+        file_names = sorted(os.listdir(config["path"]))
+
+        def chunk_cracked_pdf(file_name):
+            with open(os.path.join(config["path"], file_name), "r", encoding="utf-8") as f:
+                content = f.read()
+            return data_utils.chunk_file(file_name[:-len(".html")] + ".pdf", use_layout=True, content=content, **chunking_args)
+
+        result = data_utils.merge_chunking_results(chunk_cracked_pdf(file_name) for file_name in file_names)
+        result.total_files = len(file_names)
+    elapsed = time.perf_counter() - start
+
+    peak_rss_kb = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                      resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return {
+        **{key: value for key, value in config.items() if key not in ("path", "embedding_endpoint")},
+        "embeddings": config["embedding_endpoint"] is not None,
+        "files": result.total_files,
+        "files_with_errors": result.num_files_with_errors,
+        "chunks": len(result.chunks),
+        "tokens": sum(result.token_counts),
+        "seconds": round(elapsed, 3),
+        "files_per_s": round(result.total_files / elapsed, 2),
+        "tokens_per_s": round(sum(result.token_counts) / elapsed, 1),
+        "chunks_per_s": round(len(result.chunks) / elapsed, 2),
+        "peak_rss_mb": round(peak_rss_kb / 1024, 1),
+        # summed over worker processes and threads, so they can add up to more than seconds
+        "stage_seconds": {stage: round(stage_times[i], 3) for i, stage in enumerate(STAGES)},
+    }
+
+
+def run_in_subprocess(config: dict) -> dict:
+    env = dict(os.environ)
+    env.setdefault("AZURE_OPENAI_API_KEY", "stub")
+    for name in ("EMBEDDING_TPM_LIMIT", "EMBEDDING_RPM_LIMIT", "EMBEDDING_CACHE_PATH", "FORM_RECOGNIZER_CACHE_PATH"):
+        env.pop(name, None)
+    process = subprocess.run([sys.executable, os.path.abspath(__file__), "--run-one", json.dumps(config)],
+                             env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    for line in process.stdout.splitlines():
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX):])
+    raise RuntimeError(f"Benchmark run {config} failed with exit code {process.returncode}:\n{process.stderr[-4000:]}")
+
+
+def check_encodings():
+    """Fails early, with a hint, if the tiktoken encoding data_utils.py uses cannot be loaded."""
+    import tiktoken
+    try:
+        tiktoken.get_encoding("gpt2")
+    except Exception as e:
+        sys.exit(f"Could not load the gpt2 tiktoken encoding ({type(e).__name__}: {e}). tiktoken downloads it on first "
+                 f"use: run once with network access, or point TIKTOKEN_CACHE_DIR at a folder holding the cached files.")
+
+
+def run_key(run: dict) -> tuple:
+    return run["kind"], run["num_tokens"], run["token_overlap"], run["njobs"], run["embeddings"]
+
+
+def compare_to_baseline(runs: list, baseline_path: str, tolerance: float) -> list:
+    """Returns the runs whose files/s dropped by more than tolerance from the baseline."""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = {run_key(run): run for run in json.load(f)["runs"]}
+    regressions = []
+    for run in runs:
+        previous = baseline.get(run_key(run))
+        if previous and run["files_per_s"] < previous["files_per_s"] * (1 - tolerance):
+            regressions.append((run, previous))
+    return regressions
+
+
+def print_table(runs: list):
+    columns = ["kind", "num_tokens", "token_overlap", "njobs", "embeddings", "files_per_s", "tokens_per_s",
+               "chunks_per_s", "peak_rss_mb"]
+    rows = [columns + STAGES] + [[str(run[column]) for column in columns] + [str(run["stage_seconds"][stage]) for stage in STAGES]
+                                 for run in runs]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print("  ".join(value.rjust(width) for value, width in zip(row, widths)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark chunking throughput of scripts/data_utils.py on a synthetic corpus",
+        epilog="Example: benchmark_ingestion.py --njobs 1 4 --output results.json",
+    )
+    parser.add_argument("--files-per-format", type=int, default=40)
+    parser.add_argument("--tokens-per-file", type=int, default=3000, help="Typical file size; sizes vary around it.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--num-tokens", type=int, nargs="+", default=[256, 1024])
+    parser.add_argument("--token-overlap", type=int, nargs="+", default=[0, 128])
+    parser.add_argument("--njobs", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--no-embeddings", action="store_true", help="Only chunk, without calling the stub embedding endpoint.")
+    parser.add_argument("--embedding-latency", type=float, default=0.05, help="Seconds the stub endpoint takes per request.")
+    parser.add_argument("--corpus", default=None, help="Optional. Folder to generate the corpus in and keep, instead of a temporary folder.")
+    parser.add_argument("--output", default=None, help="Optional. JSON file to write the results to.")
+    parser.add_argument("--baseline", default=None, help="Optional. Results of an earlier run to compare files/s with.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Slowdown from the baseline reported as a regression.")
+    parser.add_argument("--run-one", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        print(RESULT_PREFIX + json.dumps(run_one(json.loads(args.run_one))))
+        sys.exit(0)
+
+    check_encodings()
+    server = None if args.no_embeddings else start_stub_embedding_server(args.embedding_latency)
+    embedding_endpoint = None if server is None else \
+        f"http://127.0.0.1:{server.server_address[1]}/openai/deployments/stub/embeddings?api-version=2023-05-15"
+
+    with tempfile.TemporaryDirectory() if args.corpus is None else contextlib.nullcontext(args.corpus) as corpus:
+        if not os.path.isdir(os.path.join(corpus, "docs")):
+            print(f"Generating corpus in {corpus}")
+            generate_corpus(corpus, args.files_per_format, args.tokens_per_file, args.seed)
+
+        configs = [dict(kind="directory", path=os.path.join(corpus, "docs"), num_tokens=num_tokens,
+                        token_overlap=token_overlap, njobs=njobs, embedding_endpoint=embedding_endpoint)
+                   for num_tokens, token_overlap, njobs in itertools.product(args.num_tokens, args.token_overlap, args.njobs)]
+        # PdfTextSplitter runs in chunk_file, one process
+        configs += [dict(kind="cracked_pdf", path=os.path.join(corpus, "pdf"), num_tokens=num_tokens,
+                         token_overlap=token_overlap, njobs=1, embedding_endpoint=embedding_endpoint)
+                    for num_tokens, token_overlap in itertools.product(args.num_tokens, args.token_overlap)]
+
+        runs = []
+        for config in configs:
+            print(f"Running {config['kind']} num_tokens={config['num_tokens']} token_overlap={config['token_overlap']} njobs={config['njobs']}")
+            runs.append(run_in_subprocess(config))
+
+    if server is not None:
+        server.shutdown()
+
+    print_table(runs)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"settings": {key: value for key, value in vars(args).items() if key != "run_one"}, "runs": runs}, f, indent=2)
+
+    if args.baseline:
+        regressions = compare_to_baseline(runs, args.baseline, args.tolerance)
+        for run, previous in regressions:
+            print(f"Regression: {run_key(run)} {run['files_per_s']} files/s, was {previous['files_per_s']}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regression beyond {args.tolerance:.0%} of {args.baseline}")
@@ -0,0 +1,483 @@
+"""
+End-to-end load test for the backend (app.py) with local stand-ins for Azure OpenAI and CosmosDB.
+
+Starts a stub server that streams chat completions as server-sent events (with a configurable time to first token,
+token rate and `context` citations) and keeps the conversation history in memory, then starts the app with the real
+gunicorn.conf.py pointed at it. Each virtual user creates a conversation with /history/generate, saves the answer
+with /history/update, reads it back with /history/read, lists its conversations with /history/list and sends a
+follow-up to /conversation. Reports the p50/p95/p99 latency of each route, time to first byte of the streamed
+routes, streamed bytes/s and the CPU used by the gunicorn workers, at each concurrency level.
+
+Example:
+    python tools/load_test.py --concurrency 1 4 16 64 --duration 20 --output results.json
+    python tools/load_test.py --workers 1 --ttft 0.2 --token-rate 100 --tokens 200
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import re
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import aiohttp
+import httpx
+from aiohttp import web
+
+APP_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, APP_DIR)
+
+from azure.cosmos import exceptions  # noqa: E402
+from backend.history.cosmosdbservice import CosmosConversationClient  # noqa: E402
+
+HISTORY_URL_ENV = "LOAD_TEST_HISTORY_URL"
+DEPLOYMENT = "load-test"
+ROUTES = ["/history/generate", "/history/update", "/history/read", "/history/list", "/conversation"]
+STREAMED_ROUTES = ["/history/generate", "/conversation"]
+CLK_TCK = os.sysconf("SC_CLK_TCK")
+
+WORDS = ("the service answers each question from the indexed documents and cites the passages it used "
+         "so that users can check every claim against its source").split()
+
+
+# Azure OpenAI stand-in
+
+def completion_chunk(completion_id, created, delta, finish_reason=None):
+    return {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": DEPLOYMENT,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+
+def make_citations(num_citations):
+    return [
+        {
+            "content": " ".join(WORDS * 4),
+            "title": f"Document {i}",
+            "url": f"https://example.com/docs/{i}.html",
+            "filepath": f"docs/{i}.html",
+            "chunk_id": "0",
+        }
+        for i in range(num_citations)
+    ]
+
+
+async def chat_completions(request):
+    options = request.app["options"]
+    body = await request.json()
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(time.time())
+    headers = {"apim-request-id": str(uuid.uuid4())}
+
+    if not body.get("stream"):
+        await asyncio.sleep(options.ttft)
+        return web.json_response({
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": DEPLOYMENT,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "Load test conversation"},
+                         "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 3, "total_tokens": 3},
+        }, headers=headers)
+
+    response = web.StreamResponse(headers={**headers, "Content-Type": "text/event-stream"})
+    await response.prepare(request)
+
+    async def send(chunk):
+        await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+
+    start = time.monotonic()
+    await asyncio.sleep(options.ttft)
+    delta = {"role": "assistant"}
+    if options.citations:
+        delta["context"] = {"citations": request.app["citations"], "intent": "[]"}
+    await send(completion_chunk(completion_id, created, delta))
+    for i in range(options.tokens):
+        # Sleep to a schedule rather than per token so that timer slack does not lower the rate
+        delay = start + options.ttft + (i + 1) / options.token_rate - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await send(completion_chunk(completion_id, created, {"content": WORDS[i % len(WORDS)] + " "}))
+    await send(completion_chunk(completion_id, created, {}, "stop"))
+    await response.write(b"data: [DONE]\n\n")
+    await response.write_eof()
+    return response
+
+
+# CosmosDB stand-in: items are kept per partition key (the user id), as in the conversations container
+
+QUERY_CONDITION = re.compile(r"c\.(\w+)\s*=\s*(@\w+|'[^']*')", re.IGNORECASE)
+QUERY_ORDER = re.compile(r"order\s+by\s+c\.(\w+)\s+(asc|desc)", re.IGNORECASE)
+QUERY_PAGE = re.compile(r"offset\s+(\d+)\s+limit\s+(\d+)", re.IGNORECASE)
+
+
+def run_query(partitions, query, parameters):
+    """Evaluate the `c.field = value [and ...] [order by] [offset limit]` queries that CosmosConversationClient makes."""
+    values = {parameter["name"]: parameter["value"] for parameter in parameters or []}
+    conditions = [(field, values[value] if value.startswith("@") else value.strip("'"))
+                  for field, value in QUERY_CONDITION.findall(query)]
+    user_id = dict(conditions).get("userId")
+    items = partitions.get(user_id, {}).values() if user_id is not None else \
+        [item for partition in partitions.values() for item in partition.values()]
+    results = [item for item in items if all(item.get(field) == value for field, value in conditions)]
+    order = QUERY_ORDER.search(query)
+    if order:
+        results.sort(key=lambda item: item.get(order.group(1)) or "", reverse=order.group(2).lower() == "desc")
+    page = QUERY_PAGE.search(query)
+    if page:
+        offset, limit = int(page.group(1)), int(page.group(2))
+        results = results[offset:offset + limit]
+    return results
+
+
+async def history_operation(request):
+    partitions = request.app["partitions"]
+    operation = request.match_info["operation"]
+    body = await request.json()
+    await asyncio.sleep(request.app["options"].history_latency)
+
+    if operation == "upsert":
+        item = body["item"]
+        partitions.setdefault(item["userId"], {})[item["id"]] = item
+        return web.json_response(item)
+    if operation == "query":
+        return web.json_response(run_query(partitions, body["query"], body.get("parameters")))
+
+    partition = partitions.get(body["partition_key"], {})
+    if body["item"] not in partition:
+        return web.json_response({"error": "Not found"}, status=404)
+    if operation == "read":
+        return web.json_response(partition[body["item"]])
+    if operation == "patch":
+        item = partition[body["item"]]
+        if not all(item.get(field) == value.strip("'") for field, value in QUERY_CONDITION.findall(body.get("filter_predicate") or "")):
+            return web.json_response({"error": "Precondition failed"}, status=412)
+        for patch_operation in body["patch_operations"]:
+            if patch_operation["op"] != "set":
+                raise web.HTTPBadRequest(text=f"Unsupported patch operation {patch_operation['op']}")
+            item[patch_operation["path"].lstrip("/")] = patch_operation["value"]
+        return web.json_response(item)
+    if operation == "delete":
+        del partition[body["item"]]
+        return web.json_response({})
+    raise web.HTTPNotFound()
+
+
+def serve_stubs(options):
+    app = web.Application()
+    app["options"] = options
+    app["citations"] = make_citations(options.citations)
+    app["partitions"] = {}
+    app.router.add_post("/openai/deployments/{deployment}/chat/completions", chat_completions)
+    app.router.add_post("/history/{operation}", history_operation)
+    web.run_app(app, host="127.0.0.1", port=options.serve_stubs, print=None, access_log=None)
+
+
+# History client used by the app workers, which all share the stub's store
+
+class _LoadTestContainerClient:
+    """Implements the container client calls made by CosmosConversationClient against the history stub."""
+
+    def __init__(self, history_url: str):
+        self.history_url = history_url.rstrip("/")
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=100))
+
+    async def _call(self, operation, **body):
+        async with self.session.post(f"{self.history_url}/{operation}", json=body) as response:
+            if response.status == 404:
+                raise exceptions.CosmosResourceNotFoundError(status_code=404, message="Entity with the specified id does not exist in the system.")
+            if response.status == 412:
+                raise exceptions.CosmosAccessConditionFailedError(status_code=412, message="One of the specified pre-condition is not met.")
+            response.raise_for_status()
+            return await response.json()
+
+    async def read(self):
+        return {}
+
+    async def upsert_item(self, body):
+        return await self._call("upsert", item=body)
+
+    async def read_item(self, item, partition_key):
+        return await self._call("read", item=item, partition_key=partition_key)
+
+    async def patch_item(self, item, partition_key, patch_operations, filter_predicate=None, **kwargs):
+        return await self._call("patch", item=item, partition_key=partition_key, patch_operations=patch_operations,
+                                filter_predicate=filter_predicate)
+
+    async def delete_item(self, item, partition_key):
+        return await self._call("delete", item=item, partition_key=partition_key)
+
+    async def query_items(self, query, parameters=None, **kwargs):
+        for item in await self._call("query", query=query, parameters=parameters):
+            yield item
+
+
+class LoadTestConversationClient(CosmosConversationClient):
+    """CosmosConversationClient with its container calls sent to the history stub instead of CosmosDB."""
+
+    def __init__(self, history_url: str, enable_message_feedback: bool = False):
+        self.cosmosdb_endpoint = history_url
+        self.database_name = "load-test"
+        self.container_name = "conversations"
+        self.enable_message_feedback = enable_message_feedback
+        self.container_client = _LoadTestContainerClient(history_url)
+        self.database_client = self.container_client
+        self.cosmosdb_client = self.container_client
+
+    async def close(self):
+        await self.container_client.session.close()
+
+
+def create_load_test_app():
+    """App factory for gunicorn: the real app, with the history client pointed at the stub."""
+    from app import create_app
+
+    app = create_app()
+
+    @app.before_serving
+    async def init_load_test_history():
+        app.cosmos_conversation_client = LoadTestConversationClient(os.environ[HISTORY_URL_ENV])
+
+    return app
+
+
+# Load driver
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(pct / 100 * len(values)) - 1)]
+
+
+def worker_cpu_times(master_pid):
+    """CPU seconds used so far by each child process of the gunicorn master, from /proc."""
+    times = {}
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # Fields after the parenthesised command name: state ppid ... utime (14th) stime (15th)
+        fields = stat[stat.rindex(")") + 2:].split()
+        if int(fields[1]) == master_pid:
+            times[int(pid)] = (int(fields[11]) + int(fields[12])) / CLK_TCK
+    return times
+
+
+async def wait_until_ready(base_url, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"Process exited with code {process.returncode}")
+            try:
+                await client.get(base_url, timeout=1)
+                return
+            except httpx.HTTPError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f"{base_url} did not start within {timeout}s")
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = {route: [] for route in ROUTES}
+        self.ttfb = {route: [] for route in STREAMED_ROUTES}
+        self.errors = {route: 0 for route in ROUTES}
+        self.streamed_bytes = 0
+
+    def summary(self, duration, cpu_seconds, num_workers):
+        def ms(value):
+            return None if value is None else round(value * 1000, 1)
+
+        routes = {}
+        for route in ROUTES:
+            latencies = self.latencies[route]
+            routes[route] = {
+                "requests": len(latencies),
+                "errors": self.errors[route],
+                "rps": round(len(latencies) / duration, 2),
+                **{f"p{pct}_ms": ms(percentile(latencies, pct)) for pct in (50, 95, 99)},
+            }
+            if route in self.ttfb:
+                routes[route].update({f"ttfb_p{pct}_ms": ms(percentile(self.ttfb[route], pct)) for pct in (50, 95, 99)})
+        return {
+            "routes": routes,
+            "streamed_bytes_per_s": round(self.streamed_bytes / duration),
+            "worker_cpu_pct": round(100 * cpu_seconds / duration, 1),
+            "workers": num_workers,
+        }
+
+
+async def timed_request(client, stats, route, payload=None):
+    """Sends one request, recording its latency and, for streamed routes, time to first byte. Returns the body."""
+    start = time.perf_counter()
+    body = bytearray()
+    try:
+        method = "GET" if route == "/history/list" else "POST"
+        async with client.stream(method, route, json=payload) as response:
+            async for chunk in response.aiter_raw():
+                if not body and route in stats.ttfb:
+                    ttfb = time.perf_counter() - start
+                body += chunk
+            if response.status_code != 200:
+                raise RuntimeError(f"{route} returned {response.status_code}: {body[:200].decode(errors='replace')}")
+    except Exception as e:
+        stats.errors[route] += 1
+        if stats.errors[route] == 1:
+            print(f"  {route} failed: {e}", file=sys.stderr)
+        return None
+    stats.latencies[route].append(time.perf_counter() - start)
+    if route in stats.ttfb:
+        stats.ttfb[route].append(ttfb)
+        stats.streamed_bytes += len(body)
+    return bytes(body)
+
+
+async def virtual_user(base_url, stats, deadline):
+    # Each user has its own principal, so its history lives in its own partition as in production
+    headers = {"X-Ms-Client-Principal-Id": str(uuid.uuid4()), "X-Ms-Client-Principal-Name": "load-test"}
+    question = {"id": str(uuid.uuid4()), "role": "user", "content": "What does the service do?"}
+    async with httpx.AsyncClient(base_url=base_url, headers=headers, timeout=httpx.Timeout(230)) as client:
+        while time.monotonic() < deadline:
+            body = await timed_request(client, stats, "/history/generate", {"messages": [question]})
+            conversation_id = None
+            if body:
+                first_line = json.loads(body.split(b"\n", 1)[0])
+                conversation_id = first_line.get("history_metadata", {}).get("conversation_id")
+            if conversation_id:
+                await timed_request(client, stats, "/history/update", {"conversation_id": conversation_id, "messages": [
+                    question,
+                    {"id": str(uuid.uuid4()), "role": "tool", "content": json.dumps({"citations": []})},
+                    {"id": str(uuid.uuid4()), "role": "assistant", "content": " ".join(WORDS)},
+                ]})
+                await timed_request(client, stats, "/history/read", {"conversation_id": conversation_id})
+            await timed_request(client, stats, "/history/list")
+            await timed_request(client, stats, "/conversation", {"messages": [
+                question,
+                {"id": str(uuid.uuid4()), "role": "assistant", "content": " ".join(WORDS)},
+                {"id": str(uuid.uuid4()), "role": "user", "content": "Which documents say so?"},
+            ]})
+
+
+async def run_level(base_url, master_pid, concurrency, duration):
+    stats = Stats()
+    cpu_before = worker_cpu_times(master_pid)
+    start = time.monotonic()
+    await asyncio.gather(*(virtual_user(base_url, stats, start + duration) for _ in range(concurrency)))
+    elapsed = time.monotonic() - start
+    cpu_after = worker_cpu_times(master_pid)
+    # Workers recycled by max_requests during the level are missed, new ones are counted from zero
+    cpu_seconds = sum(cpu - cpu_before.get(pid, 0) for pid, cpu in cpu_after.items())
+    return {"concurrency": concurrency, "duration_s": round(elapsed, 1), **stats.summary(elapsed, cpu_seconds, len(cpu_after))}
+
+
+def print_level(result):
+    print(f"\nconcurrency {result['concurrency']}: {result['streamed_bytes_per_s'] / 1024:.1f} KiB/s streamed, "
+          f"worker CPU {result['worker_cpu_pct']}% over {result['workers']} workers")
+    print(f"  {'route':<18} {'requests':>8} {'errors':>6} {'rps':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'ttfb p50':>8} {'ttfb p95':>8} {'ttfb p99':>8}")
+    for route, stats in result["routes"].items():
+        cells = [stats.get(key) for key in ("p50_ms", "p95_ms", "p99_ms", "ttfb_p50_ms", "ttfb_p95_ms", "ttfb_p99_ms")]
+        print(f"  {route:<18} {stats['requests']:>8} {stats['errors']:>6} {stats['rps']:>7} "
+              + " ".join(f"{'-' if cell is None else cell:>8}" for cell in cells))
+
+
+def start_process(args, log_path, env=None):
+    log = open(log_path, "w")
+    return subprocess.Popen(args, cwd=APP_DIR, env=env, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+
+
+def stop_process(process):
+    if process.poll() is None:
+        os.killpg(process.pid, signal.SIGTERM)
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+
+
+async def main(args):
+    log_dir = tempfile.mkdtemp(prefix="load_test_")
+    stub_port, app_port = free_port(), free_port()
+    stub_url, base_url = f"http://127.0.0.1:{stub_port}", f"http://127.0.0.1:{app_port}"
+
+    stub_args = [sys.executable, os.path.abspath(__file__), "--serve-stubs", str(stub_port), "--ttft", str(args.ttft),
+                 "--token-rate", str(args.token_rate), "--tokens", str(args.tokens), "--citations", str(args.citations),
+                 "--history-latency", str(args.history_latency)]
+    env = {
+        **os.environ,
+        "AZURE_OPENAI_ENDPOINT": stub_url,
+        "AZURE_OPENAI_KEY": "load-test",
+        "AZURE_OPENAI_MODEL": DEPLOYMENT,
+        "AZURE_OPENAI_STREAM": "true",
+        HISTORY_URL_ENV: stub_url + "/history",
+        "DOTENV_PATH": os.devnull,
+    }
+    gunicorn_args = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "--bind", f"127.0.0.1:{app_port}"]
+    if args.workers:
+        gunicorn_args += ["--workers", str(args.workers)]
+    gunicorn_args.append("tools.load_test:create_load_test_app()")
+
+    stubs = start_process(stub_args, os.path.join(log_dir, "stubs.log"))
+    gunicorn = None
+    results = []
+    try:
+        await wait_until_ready(stub_url, stubs)
+        gunicorn = start_process(gunicorn_args, os.path.join(log_dir, "gunicorn.log"), env)
+        await wait_until_ready(base_url + "/frontend_settings", gunicorn)
+        print(f"Logs in {log_dir}")
+        for concurrency in args.concurrency:
+            result = await run_level(base_url, gunicorn.pid, concurrency, args.duration)
+            print_level(result)
+            results.append(result)
+    finally:
+        for process in (gunicorn, stubs):
+            if process:
+                stop_process(process)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"settings": {k: v for k, v in vars(args).items() if k not in ("output", "serve_stubs")},
+                       "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the backend against local Azure OpenAI and CosmosDB stand-ins.")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64], help="Virtual users at each level.")
+    parser.add_argument("--duration", type=float, default=20, help="Seconds to run each level for.")
+    parser.add_argument("--workers", type=int, default=None, help="Gunicorn workers, defaults to gunicorn.conf.py.")
+    parser.add_argument("--ttft", type=float, default=0.5, help="Seconds before the stub sends the first token.")
+    parser.add_argument("--token-rate", type=float, default=50, help="Tokens per second streamed by the stub.")
+    parser.add_argument("--tokens", type=int, default=100, help="Tokens in each streamed completion.")
+    parser.add_argument("--citations", type=int, default=5, help="Citations sent in the context of each completion.")
+    parser.add_argument("--history-latency", type=float, default=0.005, help="Seconds added to each history operation.")
+    parser.add_argument("--output", type=str, default=None, help="Write the results to this JSON file.")
+    parser.add_argument("--serve-stubs", type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve_stubs:
+        serve_stubs(args)
+    else:
+        asyncio.run(main(args))